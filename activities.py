@@ -5,9 +5,13 @@ import os
 import base64
 import re
 import threading
+import time
 import asyncio
+import contextvars
+import functools
 from pathlib import Path
 from temporalio import activity
+from temporalio.exceptions import ApplicationError
 from typing import List, Dict, Optional, Any
 
 from dotenv import load_dotenv
@@ -18,7 +22,7 @@ logging.getLogger("RapidOCR").setLevel(logging.ERROR)
 logging.getLogger("rapidocr").setLevel(logging.ERROR)
 
 # New Modules
-from llm_service import LLMService
+from llm_service import LLMService, output_schema
 from schemas import (
     ExtractedTZData, 
     AnalysisTZResult, 
@@ -31,11 +35,61 @@ from schemas import (
     ManagerNotesResult
 )
 from utils_text import split_markdown, merge_extracted_data
+from proposal_stream import ProposalStreamWriter
+from token_budget import chunk_token_budget, count_tokens_batch
+from fair_scheduler import gpu_backlog
 
 load_dotenv()
 
 MODEL_NAME = os.getenv("QWEN_MODEL_NAME")
 
+# --- Heartbeats (liveness) ---
+# Workflows set a short heartbeat_timeout, so a crashed worker is detected within
+# about a minute instead of after the full start_to_close_timeout.
+HEARTBEAT_INTERVAL = int(os.getenv("ACTIVITY_HEARTBEAT_INTERVAL", 15))
+# Large PDFs are parsed in page ranges; each finished range is checkpointed in heartbeat details
+PARSE_PAGE_BATCH = int(os.getenv("PARSE_PAGE_BATCH", 20))
+# Final proposal is generated as a token stream that the UI shows while it is being written
+PROPOSAL_STREAMING = os.getenv("PROPOSAL_STREAMING", "true").lower() == "true"
+
+class _Heartbeater:
+    """Sends heartbeats in the background while the activity awaits long work (LLM, threads)."""
+
+    def __init__(self):
+        self.details = None  # Latest checkpoint, re-sent with every heartbeat
+
+    def beat(self):
+        if not activity.in_activity():
+            return  # Called directly (verify_*.py scripts)
+        if self.details is not None:
+            activity.heartbeat(self.details)
+        else:
+            activity.heartbeat()
+
+    async def run(self):
+        while True:
+            self.beat()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+_current_heartbeater: contextvars.ContextVar[Optional[_Heartbeater]] = contextvars.ContextVar(
+    "current_heartbeater", default=None
+)
+
+def heartbeating(fn):
+    """Decorator for long activities: heartbeats every HEARTBEAT_INTERVAL seconds while fn runs.
+    fn can publish a checkpoint via _current_heartbeater.get().details."""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        heartbeater = _Heartbeater()
+        token = _current_heartbeater.set(heartbeater)
+        task = asyncio.create_task(heartbeater.run())
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            task.cancel()
+            _current_heartbeater.reset(token)
+    return wrapper
+
 # --- Global Shared Resources ---
 _doc_converter = None
 _doc_converter_lock = threading.Lock()
@@ -147,7 +201,61 @@ def _convert_docx_to_pdf(docx_path: Path) -> Path:
         return None
 
 
+def _count_pdf_pages(pdf_path: Path) -> int:
+    """Page count via PyPDF2; 0 if the file is not a readable PDF."""
+    if pdf_path.suffix.lower() != ".pdf":
+        return 0
+    try:
+        from PyPDF2 import PdfReader
+        return len(PdfReader(str(pdf_path)).pages)
+    except Exception as e:
+        print(f"PDF page count failed for {pdf_path}: {e}")
+        return 0
+
+
+async def _parse_pdf_in_ranges(doc_converter, input_path: Path, total_pages: int, checkpoint: dict) -> tuple:
+    """Parses a large PDF in PARSE_PAGE_BATCH page ranges, checkpointing each finished range.
+    On retry, ranges already listed in checkpoint["parts"] are not parsed again.
+    Returns (markdown_text, doc_dict)."""
+    heartbeater = _current_heartbeater.get()
+    parts_dir = input_path.parent / f"{input_path.stem}_parts"
+    parts_dir.mkdir(exist_ok=True)
+
+    start = checkpoint.get("next_page", 1)
+    if start > 1:
+        activity.logger.info(f"Docling: Resuming {input_path.name} from page {start}/{total_pages}")
+
+    while start <= total_pages:
+        end = min(start + PARSE_PAGE_BATCH - 1, total_pages)
+        result = await asyncio.to_thread(doc_converter.convert, input_path, page_range=(start, end))
+
+        part_md = parts_dir / f"{start:05d}-{end:05d}.md"
+        part_json = parts_dir / f"{start:05d}-{end:05d}.json"
+        with open(part_md, "w", encoding="utf-8") as f:
+            f.write(result.document.export_to_markdown())
+        with open(part_json, "w", encoding="utf-8") as f:
+            # Only 'texts' (with page provenance) is used by RAG indexing
+            json.dump(result.document.export_to_dict().get("texts", []), f, ensure_ascii=False, default=str)
+
+        checkpoint["parts"].append({"md": str(part_md), "json": str(part_json)})
+        checkpoint["next_page"] = end + 1
+        if heartbeater:
+            heartbeater.details = checkpoint
+            heartbeater.beat()
+        activity.logger.info(f"Docling: Pages {start}-{end}/{total_pages} done")
+        start = end + 1
+
+    md_parts, texts = [], []
+    for part in checkpoint["parts"]:
+        with open(part["md"], "r", encoding="utf-8") as f:
+            md_parts.append(f.read())
+        with open(part["json"], "r", encoding="utf-8") as f:
+            texts.extend(json.load(f))
+    return "\n\n".join(md_parts), {"texts": texts}
+
+
 @activity.defn
+@heartbeating
 async def parse_file_activity(file_path: str, file_name: str, convert_to_pdf_for_pages: bool = True) -> str:
     """Parses document via Docling and saves Markdown to a file. Returns path to MD file.
     
@@ -155,33 +263,50 @@ async def parse_file_activity(file_path: str, file_name: str, convert_to_pdf_for
         file_path: Path to the document
         file_name: Original filename
         convert_to_pdf_for_pages: If True, converts DOCX to PDF before parsing to enable page number extraction
+
+    Large PDFs are parsed in page ranges; progress is kept in heartbeat details,
+    so a retry after a worker crash continues from the last finished range.
     """
     doc_converter = get_docling_converter()
     input_path = Path(file_path)
     original_path = input_path  # Keep for reference
 
-    # DOCX → PDF conversion for page numbers
-    if convert_to_pdf_for_pages and file_path.lower().endswith(('.docx', '.doc')):
-        activity.logger.info(f"Converting DOCX to PDF for page number extraction: {file_path}")
-        pdf_path = await asyncio.to_thread(_convert_docx_to_pdf, input_path)
-        if pdf_path:
-            input_path = pdf_path
-            activity.logger.info(f"Using converted PDF: {pdf_path}")
-        else:
-            activity.logger.warning("DOCX→PDF conversion failed, continuing with original DOCX (no page numbers)")
+    checkpoint = None
+    if activity.in_activity() and activity.info().heartbeat_details:
+        checkpoint = activity.info().heartbeat_details[0]
+
+    if checkpoint and Path(checkpoint.get("input", "")).exists():
+        # Retry: reuse the converted PDF from the previous attempt
+        input_path = Path(checkpoint["input"])
+    else:
+        checkpoint = None
+        # DOCX → PDF conversion for page numbers
+        if convert_to_pdf_for_pages and file_path.lower().endswith(('.docx', '.doc')):
+            activity.logger.info(f"Converting DOCX to PDF for page number extraction: {file_path}")
+            pdf_path = await asyncio.to_thread(_convert_docx_to_pdf, input_path)
+            if pdf_path:
+                input_path = pdf_path
+                activity.logger.info(f"Using converted PDF: {pdf_path}")
+            else:
+                activity.logger.warning("DOCX→PDF conversion failed, continuing with original DOCX (no page numbers)")
 
+    doc_dict = None
     try:
         activity.logger.info(f"Docling: Starting parsing for {input_path}...")
-        
-        # Offload CPU-bound task to a separate thread to prevent blocking Temporal heartbeat
-        def _run_docling():
-            return doc_converter.convert(input_path)
 
-        result = await asyncio.to_thread(_run_docling)
+        total_pages = await asyncio.to_thread(_count_pdf_pages, input_path)
+        if total_pages > PARSE_PAGE_BATCH:
+            checkpoint = checkpoint or {"input": str(input_path), "next_page": 1, "parts": []}
+            markdown_text, doc_dict = await _parse_pdf_in_ranges(doc_converter, input_path, total_pages, checkpoint)
+        else:
+            # Offload CPU-bound task to a separate thread to prevent blocking Temporal heartbeat
+            def _run_docling():
+                return doc_converter.convert(input_path)
+
+            result = await asyncio.to_thread(_run_docling)
+            markdown_text = result.document.export_to_markdown()
         activity.logger.info("Docling: Conversion successful.")
         
-        markdown_text = result.document.export_to_markdown()
-        
     except Exception as e:
         activity.logger.error(f"Docling Error: {e}")
         
@@ -212,7 +337,8 @@ async def parse_file_activity(file_path: str, file_name: str, convert_to_pdf_for
         json_filename = f"{input_path.stem}_parsed.json"
         json_path = input_path.parent / json_filename
         # docling export_to_dict returns a dict, needed for detailed layout info
-        doc_dict = result.document.export_to_dict()
+        if doc_dict is None:
+            doc_dict = result.document.export_to_dict()
         with open(json_path, "w", encoding="utf-8") as f:
             json.dump(doc_dict, f, ensure_ascii=False, default=str)
     except Exception as e:
@@ -221,6 +347,7 @@ async def parse_file_activity(file_path: str, file_name: str, convert_to_pdf_for
     return str(md_path)
 
 @activity.defn
+@heartbeating
 async def ocr_document_activity(file_path: str) -> str:
     """Fallback OCR if standard parsing fails. Handles Images and PDFs."""
     try:
@@ -294,6 +421,56 @@ async def save_budget_stub(data: dict) -> str:
     print(f'Stub saving to Postgres: {data}')
     return "ok"
 
+# --- Content-addressed analysis cache ---
+# Key = SHA-256 of uploaded bytes + processing options (computed by the API).
+ANALYSIS_CACHE_DIR = os.getenv("ANALYSIS_CACHE_DIR", "/shared_data/analysis_cache")
+ANALYSIS_CACHE_TTL_DAYS = int(os.getenv("ANALYSIS_CACHE_TTL_DAYS", 30))
+
+def _analysis_cache_path(cache_key: str) -> Path:
+    # Keys are hex digests; reject anything else to keep paths inside the cache dir
+    if not re.fullmatch(r"[0-9a-f]{64}", cache_key or ""):
+        raise ValueError(f"Invalid analysis cache key: {cache_key!r}")
+    return Path(ANALYSIS_CACHE_DIR) / f"{cache_key}.json"
+
+@activity.defn
+async def load_cached_analysis_activity(cache_key: str) -> Optional[dict]:
+    """Returns cached analysis (extracted data + suggestions) for identical input, or None."""
+    try:
+        cache_path = _analysis_cache_path(cache_key)
+        if not cache_path.exists():
+            return None
+        age_days = (time.time() - cache_path.stat().st_mtime) / 86400
+        if age_days > ANALYSIS_CACHE_TTL_DAYS:
+            activity.logger.info(f"Analysis cache entry expired ({age_days:.1f} days): {cache_key[:12]}")
+            return None
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        activity.logger.info(f"Analysis cache hit: {cache_key[:12]}")
+        return cached
+    except Exception as e:
+        activity.logger.warning(f"Analysis cache read failed: {e}")
+        return None
+
+@activity.defn
+async def store_cached_analysis_activity(cache_key: str, analysis: dict) -> str:
+    """Stores analysis result under its content hash (atomic write)."""
+    try:
+        cache_path = _analysis_cache_path(cache_key)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(f".{activity.info().workflow_id}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(analysis, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+        return "ok"
+    except Exception as e:
+        activity.logger.warning(f"Analysis cache write failed: {e}")
+        return "failed"
+
+@activity.defn
+async def gpu_backlog_activity() -> Optional[int]:
+    """gpu-queue backlog for workflow decisions (speculative draft); None if unknown."""
+    return await gpu_backlog(activity.client())
+
 def _load_reference_data() -> dict:
     """Загружает справочные данные из JSON (парсинг Расчёты по проектам.xlsx)."""
     reference_path = Path(__file__).parent / "reference_data.json"
@@ -329,6 +506,7 @@ def _format_reference_for_prompt(reference: dict, max_projects: int = 3) -> str:
     return "\n".join(lines)
 
 @activity.defn
+@heartbeating
 async def estimate_hours_activity(tz_data: dict, stages: list, roles: list, additional_notes: str = "") -> dict:
     """
     Generates Budget Matrix: Stage -> Role -> Hours
@@ -420,8 +598,10 @@ async def estimate_hours_activity(tz_data: dict, stages: list, roles: list, addi
         return {stage: {role: 0 for role in roles} for stage in stages}
 
 @activity.defn
-async def generate_proposal_activity(data: dict, budget_matrix: dict, rates: dict, additional_notes: str = "") -> str:
-    """Generates Commercial Proposal Markdown"""
+@heartbeating
+async def generate_proposal_activity(data: dict, budget_matrix: dict, rates: dict, additional_notes: str = "", stream_key: str = "") -> str:
+    """Generates Commercial Proposal Markdown.
+    With stream_key the text is streamed into proposal_stream (live view in the UI) as it is generated."""
     llm = LLMService()
     
     # Pre-calculate budget text
@@ -464,10 +644,8 @@ async def generate_proposal_activity(data: dict, budget_matrix: dict, rates: dic
         else:
              k_features_txt = str(k_features)
 
-        proposal: ProposalResult = await llm.create_structured_completion(
-            messages=[
-                {"role": "system", "content": "Ты Менеджер по продажам. Напиши убедительное Коммерческое Предложение в формате Markdown на РУССКОМ языке."},
-                {"role": "user", "content": f"""
+        system_prompt = "Ты Менеджер по продажам. Напиши убедительное Коммерческое Предложение в формате Markdown на РУССКОМ языке."
+        user_prompt = f"""
 Суть проекта: {p_essence}
 Цели: {b_goals}
 Функционал: {k_features_txt}
@@ -480,7 +658,21 @@ async def generate_proposal_activity(data: dict, budget_matrix: dict, rates: dic
 {detailed_budget_text}
 
 Напиши полное КП со структурой: Введение, Понимание задачи, Решение (Стек, Функции), План работ, Бюджет (вставь таблицу), Призыв к действию.
-                """}
+                """
+
+        if stream_key and PROPOSAL_STREAMING:
+            try:
+                return await _stream_proposal(llm, stream_key, [
+                    {"role": "system", "content": system_prompt + " Ответ - только текст КП в Markdown, без JSON и пояснений."},
+                    {"role": "user", "content": user_prompt}
+                ])
+            except Exception as e:
+                activity.logger.warning(f"Proposal streaming failed, falling back to structured generation: {e}")
+
+        proposal: ProposalResult = await llm.create_structured_completion(
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
             ],
             output_model=ProposalResult,
             tool_name="submit_proposal"
@@ -491,14 +683,109 @@ async def generate_proposal_activity(data: dict, budget_matrix: dict, rates: dic
         activity.logger.error(f"Proposal Generation Error: {e}")
         return "Error generating proposal."
 
+async def _stream_proposal(llm: LLMService, stream_key: str, messages: List[Dict[str, str]]) -> str:
+    """Streams the proposal text into the stream file read by the API; returns the full text."""
+    parts = []
+    async with ProposalStreamWriter(stream_key) as writer:
+        async for delta in llm.stream_chat_completion(messages, tool_name="submit_proposal_stream"):
+            parts.append(delta)
+            await writer.write(delta)
+    markdown = "".join(parts).strip()
+    # Some models still wrap the answer in a code fence
+    markdown = re.sub(r"^```(?:markdown|md)?\s*", "", markdown)
+    markdown = re.sub(r"\s*```$", "", markdown)
+    if not markdown:
+        raise ValueError("Empty streamed proposal")
+    return markdown
+
 # --- New Map-Reduce Activities ---
 
-def _split_text_sync(md_file_path: str) -> List[Dict[str, Any]]:
-    """Sync implementation of splitting to be run in thread. Uses BYTES to avoid seek issues."""
-    # Optimization: Increased default chunk size for large-context models (e.g. Qwen3-VL 128k)
-    # 50,000 bytes ~ 15k tokens. Safe for 32k+ context windows.
-    CHUNK_SIZE = int(os.getenv("DOC_CHUNK_SIZE", 50000))
-    OVERLAP = int(os.getenv("DOC_CHUNK_OVERLAP", 2000))
+# System prompts of the two per-chunk LLM passes; the chunk budget reserves room for them
+EXTRACT_SYSTEM_PROMPT = """Ты вдумчивый Системный Аналитик. Твоя задача — внимательно прочитать часть ТЗ и извлечь данные.
+        
+Шаг 1: РАССУЖДЕНИЕ (Reasoning)
+Сначала заполни поле 'reasoning'. В нем опиши своими словами:
+- О чем этот текст?
+- Какие ключевые функции или модули здесь описаны?
+- Видишь ли ты конкретные технологии или цели?
+Только после того, как ты проговоришь это, заполняй остальные поля.
+
+Шаг 2: ИЗВЛЕЧЕНИЕ (Extraction)
+Заполни остальные поля JSON.
+- client_name: Ищи название компании-заказчика. Если не найдено, верни пустую строку "".
+- project_type: Выбери один вариант, который ЛУЧШЕ ВСЕГО подходит: [Web, Mobile, ERP, CRM, AI, Интеграции, Прочее].
+    - Если система обрабатывает документы - скорее всего ERP или AI (если есть LLM).
+    - Если это мобильное приложение - Mobile.
+    - Если сайт - Web.
+- key_features: Разбей найденное на категории.
+
+ВАЖНОЕ ПРАВИЛО ФОРМАТИРОВАНИЯ:
+- В полях 'text' пиши ЧИСТЫЙ ТЕКСТ.
+- ЗАПРЕЩЕНО писать "Unknown", "N/A", "Нет". Просто пустая строка.
+"""
+
+REQUIREMENTS_SYSTEM_PROMPT = """Ты — ведущий системный аналитик и эксперт по технической документации. Твоя задача — анализировать фрагменты Технического Задания (ТЗ) и извлекать из них ключевые требования, риски и ограничения.
+
+Ты работаешь в архитектуре "Reverse RAG". Это значит, что для каждого найденного пункта ты должен предоставить не только анализ, но и специальный поисковый запрос (`search_query`), который позволит алгоритму найти точное место в исходном тексте.
+
+### Твои инструкции:
+1.  **Анализ:** Внимательно прочитай входящий фрагмент текста. Выдели:
+    * Функциональные требования (что система должна делать).
+    * Нефункциональные требования (SLA, безопасность, стек, нагрузка).
+    * Риски и ограничения (бюджет, сроки, юридические аспекты).
+
+2.  **Генерация Search Query (Самое важное):**
+    * Для каждого пункта создай поле `search_query`.
+    * Это должна быть **дословная или максимально близкая к тексту фраза** из исходника, подтверждающая твой анализ.
+    * Цель этого запроса — найти соответствующий вектор в базе данных (cosine similarity) (используется BGE-M3).
+    * Избегай общих слов. Ищи уникальные формулировки, цифры, названия технологий или специфические термины, упомянутые в тексте.
+
+3.  **Формат ответа:**
+    * Отвечай СТРОГО в формате JSON списка.
+    """
+
+@functools.lru_cache(maxsize=1)
+def _chunk_token_budget() -> int:
+    """Tokens per chunk: both per-chunk passes (extraction, requirements) must fit the context."""
+    return chunk_token_budget(
+        [EXTRACT_SYSTEM_PROMPT, REQUIREMENTS_SYSTEM_PROMPT],
+        [output_schema(ExtractedTZData)[1], output_schema(RequirementAnalysisResult)[1]]
+    )
+
+def _line_spans(content: bytes, budget: int) -> List[List[int]]:
+    """[start, end, tokens] per line; lines over the budget are cut into pieces (on UTF-8 boundaries)."""
+    spans = []
+    start = 0
+    while start < len(content):
+        end = content.find(b'\n', start)
+        end = len(content) if end == -1 else end + 1
+        spans.append([start, end])
+        start = end
+    tokens = count_tokens_batch([content[a:b].decode('utf-8', errors='ignore') for a, b in spans])
+
+    result = []
+    for (start, end), n in zip(spans, tokens):
+        if n <= budget:
+            result.append([start, end, n])
+            continue
+        # Huge line (table row, text without newlines): even byte pieces, each under the budget
+        pieces = n // budget + 1
+        step = (end - start) // pieces + 1
+        while start < end:
+            cut = min(start + step, end)
+            while cut < end and (content[cut] & 0xC0 == 0x80):
+                cut += 1
+            result.append([start, cut, n // pieces + 1])
+            start = cut
+    return result
+
+def _split_text_sync(md_file_path: str, budget: int) -> List[Dict[str, Any]]:
+    """
+    Sync implementation of splitting to be run in thread. Uses BYTES to avoid seek issues.
+    Whole lines are packed into a chunk up to the token budget of the model context
+    (token_budget.py), consecutive chunks overlap by DOC_CHUNK_OVERLAP_TOKENS.
+    """
+    OVERLAP_TOKENS = int(os.getenv("DOC_CHUNK_OVERLAP_TOKENS", 500))
     
     chunks_defs = []
     
@@ -511,48 +798,33 @@ def _split_text_sync(md_file_path: str) -> List[Dict[str, Any]]:
         with open(md_file_path, "rb") as f:
             content = f.read()
             
-        text_len = len(content)
-        start = 0
-        
-        if text_len == 0:
+        if not content:
              return []
 
-        while start < text_len:
-            end = min(start + CHUNK_SIZE, text_len)
-            
-            # Smart split: Try to find a newline byte b'\n' to break cleanly
-            if end < text_len:
-                # Look for newline in the last 500 bytes of the chunk
-                # Ensure we don't start search before start
-                search_start = max(start, end - 500)
-                search_window = content[search_start : end]
-                
-                last_newline = search_window.rfind(b'\n')
-                if last_newline != -1:
-                    # Adjust end to the newline. 
-                    # last_newline is relative to search_window start.
-                    end = search_start + last_newline + 1 # +1 to include \n
-            
+        lines = _line_spans(content, budget)
+
+        i = 0
+        while i < len(lines):
+            first = i
+            used = 0
+            while i < len(lines) and (i == first or used + lines[i][2] <= budget):
+                used += lines[i][2]
+                i += 1
+
             chunks_defs.append({
                 "file_path": md_file_path,
-                "start": start,
-                "end": end
+                "start": lines[first][0],
+                "end": lines[i - 1][1]
             })
-            
-            # Move start for next chunk, accounting for overlap
-            if end >= text_len:
-                break
-                
-            # Overlap logic: Move back N bytes
-            start = max(0, end - OVERLAP)
-            
-            # Align new start to a character boundary (avoid continuation bytes 0x80-0xBF)
-            # UTF-8: Multi-byte chars start with 11xxxxxx (0xC0+). Continuation bytes are 10xxxxxx (0x80-0xBF).
-            # ASCII is 0xxxxxxx (<0x80).
-            # So if byte is >= 0x80 and < 0xC0, it's a continuation byte.
-            while start < text_len and (content[start] & 0xC0 == 0x80):
-                start += 1
-            
+
+            # Overlap logic: the next chunk repeats the last lines of this one (at least one line of progress)
+            if i < len(lines):
+                overlap = 0
+                while i - 1 > first and overlap + lines[i - 1][2] <= OVERLAP_TOKENS:
+                    i -= 1
+                    overlap += lines[i][2]
+
+        print(f"Split {md_file_path}: {len(chunks_defs)} chunks, budget {budget} tokens per chunk")
         return chunks_defs
         
     except Exception as e:
@@ -560,98 +832,135 @@ def _split_text_sync(md_file_path: str) -> List[Dict[str, Any]]:
         return []
 
 @activity.defn
-async def index_document_activity(md_file_path: str) -> List[Dict[str, Any]]:
+async def split_document_activity(md_file_path: str) -> List[Dict[str, Any]]:
     """
-    1. Splits markdown for LLM processing (returning chunk defs).
-    2. Indexes the rich content (JSON) into LanceDB for RAG.
+    Fast step: splits markdown for LLM processing and returns chunk defs right away.
+    Vector indexing runs separately (index_document_activity) in parallel with extraction.
     """
-    # 1. Standard Split for LLM (keep existing logic)
-    chunks_defs = await asyncio.to_thread(_split_text_sync, md_file_path)
+    return await _split_document(md_file_path)
+
+async def _split_document(md_file_path: str) -> List[Dict[str, Any]]:
+    try:
+        budget = await asyncio.to_thread(_chunk_token_budget)
+    except ValueError as e:
+        # Context/max_tokens misconfiguration: fails the workflow instead of "No text content found"
+        raise ApplicationError(str(e), type="ContextBudgetError", non_retryable=True) from e
+    return await asyncio.to_thread(_split_text_sync, md_file_path, budget)
+
+def _rag_table_name(workflow_id: str) -> str:
+    # Use workflow_id as the table name for isolation
+    # Sanitize just in case, though Temporal IDs are usually safe strings
+    return f"req_{workflow_id.replace('-', '_')}"
+
+def _rag_chunks(md_file_path: str, chunks_defs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """RAG chunks of one parsed document: Docling JSON elements, or its text chunks as fallback."""
+    # Look for the JSON file we saved earlier
+    input_path = Path(md_file_path)
+    json_path = input_path.parent / f"{input_path.stem.replace('_parsed', '')}_parsed.json"
     
-    # 2. RAG Indexing
-    def _run_indexing():
-        try:
-            # Look for the JSON file we saved earlier
-            input_path = Path(md_file_path)
-            json_path = input_path.parent / f"{input_path.stem.replace('_parsed', '')}_parsed.json"
-            
-            rag_chunks = []
-            
-            if json_path.exists():
-                with open(json_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    
-                # Iterate over Docling structure to create RAG chunks
-                # Docling dict structure: 'pages', 'texts' or 'main_text'
-                # Simplified approach: Iterate 'texts' if available or fallback to parsing the MD logic again
-                # Assuming 'texts' contains paragraph-level info with provenance
-                
-                # If Docling export format is complex, we might just chunk the tokens. 
-                # For this MVP: Use the 'texts' array if present, usually distinct elements.
-                if 'texts' in data:
-                     for item in data['texts']:
-                         # item structure depends on version:
-                         # {'text': '...', 'prov': [{'page_no': 1, 'bbox': ...}]} OR
-                         # {'text': '...', 'prov': [{'page': 1, 'bbox': ...}]}
-                         text_content = item.get('text', '').strip()
-                         if len(text_content) > 20: # Skip noise
-                             prov_list = item.get('prov') or [{}]
-                             prov = prov_list[0]
-                             # Try multiple possible keys for page number
-                             page_num = prov.get('page_no') or prov.get('page_number') or prov.get('page') or 0
-                             rag_chunks.append({
-                                 "text": text_content,
-                                 "page_number": page_num,
-                                 "bbox": str(prov.get('bbox', [])),
-                                 "source_file": str(input_path.name)
-                             })
-            
-            # Fallback if no JSON or empty: Chunk the MD lines
-            if not rag_chunks:
-                activity.logger.warning("No structured JSON found for RAG. Using text chunks.")
-                # We can reuse the chunks_defs logic but we need the actual text
-                with open(md_file_path, "r", encoding="utf-8") as f:
-                    full_text = f.read()
-                
-                # Create simple chunks
-                for c in chunks_defs:
-                    txt = full_text[c['start']:c['end']]
-                    rag_chunks.append({
-                        "text": txt,
-                        "page_number": 0,
-                        "bbox": "",
-                        "source_file": str(input_path.name)
-                    })
-
-            # Create Index
-            from rag_service import RAGService
-            rag = RAGService()
-            # Use workflow_id as the table name for isolation
-            wf_id = activity.info().workflow_id
-            # Sanitize just in case, though Temporal IDs are usually safe strings
-            table_name = f"req_{wf_id.replace('-', '_')}"
-            
-            rag.create_index(chunks=rag_chunks, table_name=table_name)
-            
-            return {
-                "status": "indexed", 
-                "chunks_count": len(rag_chunks),
-                "table_name": table_name
-            }
-        except Exception as e:
-            activity.logger.error(f"Indexing Failed: {e}")
-            return {
-                "status": "failed",
-                "chunks_count": 0,
-                "table_name": None,
-                "error": str(e)
-            }
+    rag_chunks = []
+    
+    if json_path.exists():
+        with open(json_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
             
-    await asyncio.to_thread(_run_indexing)
+        # Iterate over Docling structure to create RAG chunks
+        # Docling dict structure: 'pages', 'texts' or 'main_text'
+        # Simplified approach: Iterate 'texts' if available or fallback to parsing the MD logic again
+        # Assuming 'texts' contains paragraph-level info with provenance
+        
+        # If Docling export format is complex, we might just chunk the tokens. 
+        # For this MVP: Use the 'texts' array if present, usually distinct elements.
+        if 'texts' in data:
+             for item in data['texts']:
+                 # item structure depends on version:
+                 # {'text': '...', 'prov': [{'page_no': 1, 'bbox': ...}]} OR
+                 # {'text': '...', 'prov': [{'page': 1, 'bbox': ...}]}
+                 text_content = item.get('text', '').strip()
+                 if len(text_content) > 20: # Skip noise
+                     prov_list = item.get('prov') or [{}]
+                     prov = prov_list[0]
+                     # Try multiple possible keys for page number
+                     page_num = prov.get('page_no') or prov.get('page_number') or prov.get('page') or 0
+                     rag_chunks.append({
+                         "text": text_content,
+                         "page_number": page_num,
+                         "bbox": str(prov.get('bbox', [])),
+                         "source_file": str(input_path.name)
+                     })
     
-    return chunks_defs
+    # Fallback if no JSON or empty: Chunk the MD lines
+    if not rag_chunks:
+        activity.logger.warning("No structured JSON found for RAG. Using text chunks.")
+        # We can reuse the chunks_defs logic but we need the actual text
+        with open(md_file_path, "rb") as f:
+            full_bytes = f.read()
+        
+        # Create simple chunks (chunk defs are byte offsets; a batch passes the chunks of all files)
+        for c in chunks_defs:
+            if c.get('file_path', md_file_path) != md_file_path:
+                continue
+            txt = full_bytes[c['start']:c['end']].decode('utf-8', errors='ignore')
+            rag_chunks.append({
+                "text": txt,
+                "page_number": 0,
+                "bbox": "",
+                "source_file": str(input_path.name)
+            })
+    return rag_chunks
+
+
+def _index_documents_sync(md_file_paths: List[str], chunks_defs: List[Dict[str, Any]], table_name: str) -> Dict[str, Any]:
+    """Sync implementation of RAG indexing (embedding + LanceDB write) to be run in thread."""
+    try:
+        rag_chunks = []
+        for md_file_path in md_file_paths:
+            rag_chunks.extend(_rag_chunks(md_file_path, chunks_defs))
+
+        # Create Index
+        from rag_service import RAGService
+        rag = RAGService()
+        rag.create_index(chunks=rag_chunks, table_name=table_name)
+        
+        return {
+            "status": "indexed", 
+            "chunks_count": len(rag_chunks),
+            "table_name": table_name
+        }
+    except Exception as e:
+        activity.logger.error(f"Indexing Failed: {e}")
+        return {
+            "status": "failed",
+            "chunks_count": 0,
+            "table_name": None,
+            "error": str(e)
+        }
+
+@activity.defn
+@heartbeating
+async def index_document_activity(md_file_path: str, chunks_defs: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """
+    Indexes the rich content (JSON) into LanceDB for RAG.
+    Runs in parallel with chunk extraction; only RAG enrichment waits for it.
+    chunks_defs (from split_document_activity) are used as fallback RAG chunks when no Docling JSON exists.
+    """
+    if chunks_defs is None:
+        chunks_defs = await _split_document(md_file_path)
+    table_name = _rag_table_name(activity.info().workflow_id)
+    return await asyncio.to_thread(_index_documents_sync, [md_file_path], chunks_defs, table_name)
 
 @activity.defn
+@heartbeating
+async def index_documents_activity(md_file_paths: List[str], chunks_defs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Batch upload (ТЗ + appendices): indexes all parsed files into the workflow's one RAG table,
+    so enrichment finds source quotes in any of them.
+    """
+    table_name = _rag_table_name(activity.info().workflow_id)
+    return await asyncio.to_thread(_index_documents_sync, md_file_paths, chunks_defs, table_name)
+
+@activity.defn
+@heartbeating
 async def refine_requirements_activity(requirements: List[dict]) -> List[dict]:
     """
     Phase 3: Reverse RAG.
@@ -659,8 +968,7 @@ async def refine_requirements_activity(requirements: List[dict]) -> List[dict]:
     """
     from rag_service import RAGService
     rag = RAGService()
-    wf_id = activity.info().workflow_id
-    table_name = f"req_{wf_id.replace('-', '_')}"
+    table_name = _rag_table_name(activity.info().workflow_id)
     
     refined_list = []
     
@@ -691,6 +999,7 @@ async def refine_requirements_activity(requirements: List[dict]) -> List[dict]:
 
 
 @activity.defn
+@heartbeating
 async def enrich_with_rag_activity(merged_data: dict) -> dict:
     """
     Enriches all SourceText items with RAG source quotes.
@@ -698,8 +1007,7 @@ async def enrich_with_rag_activity(merged_data: dict) -> dict:
     """
     from rag_service import RAGService
     rag = RAGService()
-    wf_id = activity.info().workflow_id
-    table_name = f"req_{wf_id.replace('-', '_')}"
+    table_name = _rag_table_name(activity.info().workflow_id)
     
     activity.logger.info(f"Starting RAG enrichment for all fields...")
     
@@ -759,6 +1067,7 @@ async def enrich_with_rag_activity(merged_data: dict) -> dict:
     return merged_data
 
 @activity.defn
+@heartbeating
 async def classify_manager_notes_activity(additional_notes: str, merged_data: dict) -> dict:
     """
     Dedicated activity: classifies manager's free-text notes into structured items.
@@ -838,10 +1147,16 @@ async def classify_manager_notes_activity(additional_notes: str, merged_data: di
         activity.logger.error(f"Manager Notes Classification Failed: {e}")
         return merged_data  # Return unchanged on error
 
+# Result key with the activity's own run time: it starts after the fair GPU slot is taken
+# (fair_scheduler.py), so the extraction window sees model latency, not queueing
+EXTRACT_SECONDS_KEY = "_extract_seconds"
+
 @activity.defn
+@heartbeating
 async def extract_chunk_activity(chunk_def: Dict[str, Any]) -> dict:
     """Phase 1: Extraction for a single chunk (reading from file)."""
     llm = LLMService()
+    started = time.monotonic()
     try:
         file_path = chunk_def["file_path"]
         start = chunk_def["start"]
@@ -857,42 +1172,20 @@ async def extract_chunk_activity(chunk_def: Dict[str, Any]) -> dict:
             
         activity.logger.info(f"Extracting data from chunk ({len(chunk_text)} chars)...")
         
-        system_prompt = """Ты вдумчивый Системный Аналитик. Твоя задача — внимательно прочитать часть ТЗ и извлечь данные.
-        
-Шаг 1: РАССУЖДЕНИЕ (Reasoning)
-Сначала заполни поле 'reasoning'. В нем опиши своими словами:
-- О чем этот текст?
-- Какие ключевые функции или модули здесь описаны?
-- Видишь ли ты конкретные технологии или цели?
-Только после того, как ты проговоришь это, заполняй остальные поля.
-
-Шаг 2: ИЗВЛЕЧЕНИЕ (Extraction)
-Заполни остальные поля JSON.
-- client_name: Ищи название компании-заказчика. Если не найдено, верни пустую строку "".
-- project_type: Выбери один вариант, который ЛУЧШЕ ВСЕГО подходит: [Web, Mobile, ERP, CRM, AI, Интеграции, Прочее].
-    - Если система обрабатывает документы - скорее всего ERP или AI (если есть LLM).
-    - Если это мобильное приложение - Mobile.
-    - Если сайт - Web.
-- key_features: Разбей найденное на категории.
-
-ВАЖНОЕ ПРАВИЛО ФОРМАТИРОВАНИЯ:
-- В полях 'text' пиши ЧИСТЫЙ ТЕКСТ.
-- ЗАПРЕЩЕНО писать "Unknown", "N/A", "Нет". Просто пустая строка.
-"""
-        
         extracted_data: ExtractedTZData = await llm.create_structured_completion(
             messages=[
-                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": EXTRACT_SYSTEM_PROMPT},
                 {"role": "user", "content": f"Часть ТЗ:\n\n{chunk_text}"}
             ],
             output_model=ExtractedTZData,
             tool_name="extract_tz_chunk"
         )
-        return extracted_data.model_dump()
+        return {**extracted_data.model_dump(), EXTRACT_SECONDS_KEY: time.monotonic() - started}
     except Exception as e:
         activity.logger.error(f"Chunk Extraction Failed: {e}")
 
 @activity.defn
+@heartbeating
 async def analyze_requirements_chunk_activity(chunk_def: Dict[str, Any]) -> List[dict]:
     """
     Phase 1.5: Detailed Requirements Analysis (Reverse RAG).
@@ -913,29 +1206,9 @@ async def analyze_requirements_chunk_activity(chunk_def: Dict[str, Any]) -> List
 
         activity.logger.info(f"Analyzing requirements in chunk ({len(chunk_text)} chars)...")
         
-        system_prompt = """Ты — ведущий системный аналитик и эксперт по технической документации. Твоя задача — анализировать фрагменты Технического Задания (ТЗ) и извлекать из них ключевые требования, риски и ограничения.
-
-Ты работаешь в архитектуре "Reverse RAG". Это значит, что для каждого найденного пункта ты должен предоставить не только анализ, но и специальный поисковый запрос (`search_query`), который позволит алгоритму найти точное место в исходном тексте.
-
-### Твои инструкции:
-1.  **Анализ:** Внимательно прочитай входящий фрагмент текста. Выдели:
-    * Функциональные требования (что система должна делать).
-    * Нефункциональные требования (SLA, безопасность, стек, нагрузка).
-    * Риски и ограничения (бюджет, сроки, юридические аспекты).
-
-2.  **Генерация Search Query (Самое важное):**
-    * Для каждого пункта создай поле `search_query`.
-    * Это должна быть **дословная или максимально близкая к тексту фраза** из исходника, подтверждающая твой анализ.
-    * Цель этого запроса — найти соответствующий вектор в базе данных (cosine similarity) (используется BGE-M3).
-    * Избегай общих слов. Ищи уникальные формулировки, цифры, названия технологий или специфические термины, упомянутые в тексте.
-
-3.  **Формат ответа:**
-    * Отвечай СТРОГО в формате JSON списка.
-    """
-
         result: RequirementAnalysisResult = await llm.create_structured_completion(
             messages=[
-                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": REQUIREMENTS_SYSTEM_PROMPT},
                 {"role": "user", "content": f"Проанализируй следующий фрагмент ТЗ и верни JSON согласно системной инструкции.\n\n=== НАЧАЛО ФРАГМЕНТА ===\n{chunk_text}\n=== КОНЕЦ ФРАГМЕНТА ==="}
             ],
             output_model=RequirementAnalysisResult,
@@ -962,6 +1235,7 @@ async def merge_data_activity(data_list: List[dict]) -> dict:
         return ExtractedTZData(project_essence=SourceText(text=f"Merge Error: {e}")).model_dump()
 
 @activity.defn
+@heartbeating
 async def analyze_project_activity(merged_data: dict, additional_notes: str = "") -> dict:
     """
     Phase 2: Analysis based on aggregated data.
@@ -1012,8 +1286,8 @@ async def analyze_project_activity(merged_data: dict, additional_notes: str = ""
         )
     except Exception as e:
         activity.logger.error(f"Analysis Phase Failed: {e}")
-        # Return merged data as is
-        return merged_data
+        # Merged data as is, flagged so the workflow does not cache it as a finished analysis
+        return {**merged_data, "analysis_failed": True}
 
     # Map results back to the main dict
     final_dict = merged_data.copy()
@@ -0,0 +1,191 @@
+"""
+Admission control for new proposals (POST /api/start, resumable uploads).
+
+Load is read from Temporal visibility (KpStatus/KpUser search attributes): documents in
+GPU stages (PROCESSING, DRAFTING, GENERATING) are "active", documents waiting for a slot are QUEUED.
+Plus the gpu-queue activity backlog, which also covers work without search attributes.
+
+- Room left (global and per-user) -> start now.
+- Otherwise the workflow starts in QUEUED state with an estimated start time and waits
+  for the admit signal; dispatch_queued() (API background loop) admits the oldest queued
+  documents as slots free up. ADMISSION_MAX_QUEUE_HOURS is a safety net if nobody admits.
+- Queue full (global or per-user), or ADMISSION_MODE=reject -> 429 with Retry-After.
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+from temporalio.client import Client
+
+from fair_scheduler import gpu_backlog
+from workflows import ProposalWorkflow, KP_USER_ATTR, SEARCH_ATTRIBUTES_ENABLED, DRAFTING_STATUS
+
+logger = logging.getLogger("kp-api")
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true" and SEARCH_ATTRIBUTES_ENABLED
+# "queue": over the limits -> QUEUED with an ETA; "reject": over the limits -> 429
+ADMISSION_MODE = os.getenv("ADMISSION_MODE", "queue")
+# Documents in GPU stages at once (global / per user)
+ADMISSION_MAX_ACTIVE = int(os.getenv("ADMISSION_MAX_ACTIVE", 10))
+ADMISSION_MAX_ACTIVE_PER_USER = int(os.getenv("ADMISSION_MAX_ACTIVE_PER_USER", 3))
+# Queue bounds: beyond them uploads get 429
+ADMISSION_MAX_QUEUED = int(os.getenv("ADMISSION_MAX_QUEUED", 50))
+ADMISSION_MAX_QUEUED_PER_USER = int(os.getenv("ADMISSION_MAX_QUEUED_PER_USER", 10))
+# gpu-queue activity tasks not yet picked up by a worker; above this the GPU fleet is saturated
+ADMISSION_MAX_GPU_BACKLOG = int(os.getenv("ADMISSION_MAX_GPU_BACKLOG", 100))
+# Typical GPU time of one document (parse -> estimate); the ETA is derived from it
+ADMISSION_DOC_SECONDS = int(os.getenv("ADMISSION_DOC_SECONDS", 900))
+ADMISSION_POLL_INTERVAL = int(os.getenv("ADMISSION_POLL_INTERVAL", 15))
+
+# Statuses that occupy LLM capacity (not database.ACTIVE_STATUSES, which is "can be attached to").
+# DRAFTING: waiting for approval while the speculative draft is generated
+ADMISSION_ACTIVE_STATUSES = ("PROCESSING", DRAFTING_STATUS, "GENERATING")
+QUEUED_STATUS = "QUEUED"
+
+# Admitted but possibly not yet visible as PROCESSING (visibility lags): workflow_id -> admitted at
+_recently_admitted: Dict[str, float] = {}
+
+
+def _quote(value: str) -> str:
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def _status_query(statuses, user: Optional[str] = None) -> str:
+    query = f"ExecutionStatus = 'Running' AND KpStatus IN ({', '.join(_quote(s) for s in statuses)})"
+    if user is not None:
+        query += f" AND {KP_USER_ATTR.name} = {_quote(user)}"
+    return query
+
+
+async def _count(client: Client, statuses, user: Optional[str] = None) -> int:
+    result = await client.count_workflows(_status_query(statuses, user), rpc_timeout=timedelta(seconds=3))
+    return result.count
+
+
+def _recent_admissions() -> int:
+    cutoff = time.monotonic() - 2 * ADMISSION_POLL_INTERVAL
+    for wf_id in [w for w, t in _recently_admitted.items() if t < cutoff]:
+        del _recently_admitted[wf_id]
+    return len(_recently_admitted)
+
+
+def _wait_seconds(ahead: int, slots: int) -> int:
+    """Time until `ahead` documents have gone through `slots` parallel slots."""
+    return int(math.ceil(ahead * ADMISSION_DOC_SECONDS / max(1, slots)))
+
+
+def _too_many(detail: str, retry_after: int) -> HTTPException:
+    retry_after = max(ADMISSION_POLL_INTERVAL, retry_after)
+    return HTTPException(
+        status_code=429,
+        detail=f"{detail}. Повторите попытку через {max(1, round(retry_after / 60))} мин.",
+        headers={"Retry-After": str(retry_after)}
+    )
+
+
+async def admit(client: Client, user: str) -> Optional[datetime]:
+    """
+    Decides on a new upload: None -> start now, datetime -> start QUEUED with that ETA.
+    Raises 429 (with Retry-After) when the queue is full. Fails open if visibility is down.
+    """
+    if not ADMISSION_ENABLED:
+        return None
+    try:
+        active, queued, user_active, user_queued, backlog = await asyncio.gather(
+            _count(client, ADMISSION_ACTIVE_STATUSES),
+            _count(client, (QUEUED_STATUS,)),
+            _count(client, ADMISSION_ACTIVE_STATUSES, user),
+            _count(client, (QUEUED_STATUS,), user),
+            gpu_backlog(client)
+        )
+    except Exception as e:
+        logger.warning(f"Admission: visibility unavailable, admitting without limits: {e}", extra={"user": user})
+        return None
+    active += _recent_admissions()
+    saturated = backlog is not None and backlog > ADMISSION_MAX_GPU_BACKLOG
+
+    # Start now only if everything already queued fits as well (queued documents go first)
+    if not saturated and active + queued < ADMISSION_MAX_ACTIVE and user_active < ADMISSION_MAX_ACTIVE_PER_USER and not user_queued:
+        return None
+
+    if ADMISSION_MODE == "reject":
+        raise _too_many("Сервис перегружен", _wait_seconds(1, ADMISSION_MAX_ACTIVE))
+    if user_queued >= ADMISSION_MAX_QUEUED_PER_USER:
+        raise _too_many("Слишком много ваших документов в очереди", _wait_seconds(1, ADMISSION_MAX_ACTIVE_PER_USER))
+    if queued >= ADMISSION_MAX_QUEUED:
+        raise _too_many("Очередь обработки заполнена", _wait_seconds(1, ADMISSION_MAX_ACTIVE))
+
+    # Documents that must get a slot before this one, globally and within the user's own limit
+    wait = max(
+        _wait_seconds(active + queued + 1 - ADMISSION_MAX_ACTIVE, ADMISSION_MAX_ACTIVE),
+        _wait_seconds(user_active + user_queued + 1 - ADMISSION_MAX_ACTIVE_PER_USER, ADMISSION_MAX_ACTIVE_PER_USER),
+        ADMISSION_POLL_INTERVAL
+    )
+    logger.info(f"Admission: queued upload, active={active} queued={queued} backlog={backlog} eta={wait}s", extra={
+        "user": user,
+        "action": "UPLOAD_QUEUED"
+    })
+    return datetime.now(timezone.utc) + timedelta(seconds=wait)
+
+
+async def _list_queued(client: Client) -> List:
+    queued = []
+    async for execution in client.list_workflows(_status_query((QUEUED_STATUS,)), page_size=ADMISSION_MAX_QUEUED):
+        if execution.id not in _recently_admitted:
+            queued.append(execution)
+    queued.sort(key=lambda e: e.start_time)
+    return queued
+
+
+async def dispatch_queued(client: Client) -> int:
+    """Admits the oldest QUEUED documents into free slots (global and per-user). Returns how many."""
+    queued = await _list_queued(client)
+    if not queued:
+        return 0
+    active = await _count(client, ADMISSION_ACTIVE_STATUSES) + _recent_admissions()
+    backlog = await gpu_backlog(client)
+    free = ADMISSION_MAX_ACTIVE - active
+    if free <= 0 or (backlog is not None and backlog > ADMISSION_MAX_GPU_BACKLOG):
+        return 0
+
+    users = {e.typed_search_attributes.get(KP_USER_ATTR) or "" for e in queued}
+    counts = await asyncio.gather(*(_count(client, ADMISSION_ACTIVE_STATUSES, u) for u in users))
+    user_active = dict(zip(users, counts))
+
+    admitted = 0
+    for execution in queued:
+        if admitted >= free:
+            break
+        user = execution.typed_search_attributes.get(KP_USER_ATTR) or ""
+        if user_active[user] >= ADMISSION_MAX_ACTIVE_PER_USER:
+            continue
+        try:
+            await client.get_workflow_handle(execution.id).signal(ProposalWorkflow.admit_signal)
+        except Exception as e:
+            logger.warning(f"Admission: failed to admit {execution.id}: {e}")
+            continue
+        _recently_admitted[execution.id] = time.monotonic()
+        user_active[user] += 1
+        admitted += 1
+    if admitted:
+        logger.info(f"Admission: admitted {admitted} queued document(s), active was {active}")
+    return admitted
+
+
+async def admission_loop(get_client: Callable[[], Awaitable[Client]]):
+    """API background task: admits queued documents as GPU slots free up."""
+    if not ADMISSION_ENABLED:
+        return
+    while True:
+        await asyncio.sleep(ADMISSION_POLL_INTERVAL)
+        try:
+            await dispatch_queued(await get_client())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Admission dispatch failed: {e}")
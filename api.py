@@ -1,26 +1,47 @@
 # api.py
 import asyncio
+import hashlib
+import multiprocessing
 import os
 import json
-from typing import List, Dict, Any
+from collections import OrderedDict
+from datetime import datetime
+from typing import List, Dict, Any, Optional, Tuple
 from fastapi import FastAPI, UploadFile, File, HTTPException, Cookie, Depends, Request, Form
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from temporalio.client import Client
+from temporalio.client import Client, WorkflowExecutionStatus, WorkflowQueryFailedError
+from temporalio.common import SearchAttributePair, TypedSearchAttributes
 
 # Импорт твоих workflow
-from workflows import ProposalWorkflow
-from keycloak_auth import verify_keycloak_token
+from workflows import ProposalWorkflow, KP_STATUS_ATTR, KP_USER_ATTR, SEARCH_ATTRIBUTES_ENABLED, DRAFTING_STATUS
+from fair_scheduler import USER_MEMO_KEY
+from status_stream import StatusHub, STREAM_KEEPALIVE
+from progress import query_progress
+from admission import admit, admission_loop
+from uploads import (
+    save_upload,
+    check_content_length,
+    create_session,
+    session_status,
+    append_chunk,
+    finish_session
+)
+from keycloak_auth import verify_keycloak_token, close_http_client as close_keycloak_client
 from database import (
     save_user_file, 
     update_file_status,
     get_user_files,
     get_file_by_workflow_id,
-    get_file_owner
+    get_file_owner,
+    find_active_file_by_hash,
+    HISTORY_PAGE_SIZE
 )
-from fastapi.responses import StreamingResponse
-from utils_docx import markdown_to_docx
-import shutil
+from fastapi.responses import Response, StreamingResponse
+from utils_docx import markdown_to_docx_bytes
+from utils_cache import LRUCache
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import uuid
 
 SHARED_DIR = "/shared_data"
@@ -78,7 +99,7 @@ class RequestContextMiddleware(BaseHTTPMiddleware):
             
             # Optional: Log success (INFO) or keep silent to reduce noise
             # Silence specific polling endpoints to avoid spam
-            SILENT_PATHS = ["/api/history", "/api/status", "/metrics"]
+            SILENT_PATHS = ["/api/history", "/api/status", "/api/progress", "/api/events", "/metrics"]
             is_silent = any(request.url.path.startswith(p) for p in SILENT_PATHS)
 
             if response.status_code >= 500:
@@ -104,6 +125,17 @@ class RequestContextMiddleware(BaseHTTPMiddleware):
 
 app.add_middleware(RequestContextMiddleware)
 
+
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    """413 from Content-Length before the multipart body is read and spooled."""
+    if request.method == "POST" and request.url.path in ("/api/start", "/api/start_batch"):
+        try:
+            check_content_length(request.headers.get("content-length"), batch=request.url.path == "/api/start_batch")
+        except HTTPException as e:
+            return JSONResponse(status_code=e.status_code, content={"detail": e.detail})
+    return await call_next(request)
+
 # Global Exception Handler
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
@@ -159,6 +191,21 @@ async def startup_event():
     except Exception as e:
         logger.error(f"Failed to connect to Temporal server on startup: {e}", exc_info=True)
 
+_admission_task = None
+
+
+@app.on_event("startup")
+async def start_admission_loop():
+    global _admission_task
+    _admission_task = asyncio.create_task(admission_loop(get_temporal_client))
+
+
+@app.on_event("shutdown")
+async def stop_admission_loop():
+    if _admission_task is not None:
+        _admission_task.cancel()
+
+
 async def get_temporal_client():
     global _temporal_client_instance
     if _temporal_client_instance is None:
@@ -185,53 +232,117 @@ class ApprovalRequest(BaseModel):
 class DownloadRequest(BaseModel):
     text: str
 
-@app.post("/api/start")
-async def start_workflow(
-    file: UploadFile = File(...),
-    convert_to_pdf_for_pages: bool = Form(default=True),  # Convert DOCX→PDF for page numbers
-    additional_notes: str = Form(default=""),  # Free-text user notes/requirements
-    user: str = Depends(verify_auth),
-    request: Request = None
-):
-    client = await get_temporal_client()
-    req_id = getattr(request.state, "request_id", "unknown") if request else "unknown"
-    
-    # Genererate ID and Path
-    unique_id = str(uuid.uuid4())
-    safe_filename = file.filename.replace(" ", "_").replace("/", "")
-    file_path = os.path.join(SHARED_DIR, f"{unique_id}_{safe_filename}")
-    
-    # Stream save to disk (Memory efficient)
+def _content_cache_key(file_sha256: str, convert_to_pdf_for_pages: bool, additional_notes: str) -> str:
+    """Content address of an analysis: uploaded bytes + every option that changes the result."""
+    options = json.dumps(
+        {"convert_to_pdf_for_pages": convert_to_pdf_for_pages, "additional_notes": additional_notes.strip()},
+        sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(f"{file_sha256}:{options}".encode("utf-8")).hexdigest()
+
+
+async def _find_running_duplicate(client: Client, user: str, content_hash: str) -> Optional[str]:
+    """Workflow ID of the user's identical upload that is still running, if any."""
+    existing = find_active_file_by_hash(user, content_hash)
+    if not existing:
+        return None
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        description = await client.get_workflow_handle(existing["workflow_id"]).describe()
+        if description.status == WorkflowExecutionStatus.RUNNING:
+            return existing["workflow_id"]
     except Exception as e:
-         raise HTTPException(status_code=500, detail=f"Failed to save file: {e}")
+        logger.warning(f"Failed to describe duplicate workflow {existing['workflow_id']}: {e}", extra={"user": user})
+    return None
+
+
+def _upload_path(filename: str) -> Tuple[str, str]:
+    """(unique_id, path in SHARED_DIR) for a new upload."""
+    unique_id = str(uuid.uuid4())
+    safe_filename = filename.replace(" ", "_").replace("/", "")
+    return unique_id, os.path.join(SHARED_DIR, f"{unique_id}_{safe_filename}")
+
+
+async def _start_proposal(
+    client: Client,
+    user: str,
+    unique_id: str,
+    file_path: str,
+    filename: str,
+    file_sha256: str,
+    convert_to_pdf_for_pages: bool,
+    additional_notes: str,
+    req_id: str,
+    extra_files: Optional[List[Dict[str, str]]] = None,
+    pre_admitted: bool = False,
+    queued_until: Optional[datetime] = None
+) -> dict:
+    """
+    Starts ProposalWorkflow for a file already saved to SHARED_DIR (or attaches to a running duplicate).
+    extra_files: appendices of a batch upload ([{"file_path", "file_name"}]); file_sha256 then covers all files.
+    pre_admitted: the caller already ran admit() (result in queued_until) before consuming the upload.
+    """
+    content_hash = _content_cache_key(file_sha256, convert_to_pdf_for_pages, additional_notes)
+    saved_paths = [file_path] + [f["file_path"] for f in extra_files or []]
+
+    # Identical document already in progress for this user (refresh / retry) -> attach to it
+    running_wf_id = await _find_running_duplicate(client, user, content_hash)
+    if running_wf_id:
+        for path in saved_paths:
+            await asyncio.to_thread(os.remove, path)
+        logger.info(f"Attached upload to running workflow: {filename}", extra={
+            "user": user,
+            "action": "UPLOAD_DEDUP",
+            "request_id": req_id,
+            "details": {"filename": filename, "workflow_id": running_wf_id}
+        })
+        return {"workflow_id": running_wf_id, "deduplicated": True}
+
+    # Backlog-aware admission: start now, start QUEUED with an ETA, or 429 (admission.py)
+    if not pre_admitted:
+        try:
+            queued_until = await admit(client, user)
+        except HTTPException:
+            for path in saved_paths:
+                await asyncio.to_thread(os.remove, path)
+            raise
+    status = "QUEUED" if queued_until else "PROCESSING"
+    queued_until = queued_until.isoformat() if queued_until else ""
     
     wf_id = f"cp-{unique_id}"
     
     try:
         handle = await client.start_workflow(
             ProposalWorkflow.run,
-            args=[file_path, file.filename, convert_to_pdf_for_pages, additional_notes],  # Pass conversion flag + user notes
+            # Pass conversion flag + user notes; cache_key lets the workflow reuse a finished analysis
+            args=[file_path, filename, convert_to_pdf_for_pages, additional_notes, content_hash, queued_until, extra_files],
             id=wf_id,
             task_queue="proposal-queue", # Важно: совпадает с worker.py
+            memo={USER_MEMO_KEY: user}, # Fair GPU scheduling per user (fair_scheduler.py)
+            search_attributes=TypedSearchAttributes([
+                SearchAttributePair(KP_USER_ATTR, user),
+                SearchAttributePair(KP_STATUS_ATTR, status)
+            ]) if SEARCH_ATTRIBUTES_ENABLED else None,
         )
         
         # Save to user history database
         save_user_file(
             username=user,
             workflow_id=handle.id,
-            original_filename=file.filename
+            # Batch: "ТЗ.pdf (+2)" - the ТЗ and the number of appendices
+            original_filename=f"{filename} (+{len(extra_files)})" if extra_files else filename,
+            content_hash=content_hash,
+            status=status
         )
         
-        logger.info(f"Started workflow for file: {file.filename}", extra={
+        logger.info(f"Started workflow for file: {filename}", extra={
             "user": user, 
             "action": "UPLOAD",
             "request_id": req_id,
-            "details": {"filename": file.filename, "workflow_id": wf_id}
+            "details": {"filename": filename, "workflow_id": wf_id, "status": status}
         })
         
+        if queued_until:
+            return {"workflow_id": handle.id, "queued": True, "estimated_start": queued_until}
         return {"workflow_id": handle.id}
     except Exception as e:
         # Если workflow уже запущен, возвращаем его ID
@@ -239,41 +350,228 @@ async def start_workflow(
              return {"workflow_id": wf_id}
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/history")
-async def get_history(user: str = Depends(verify_auth)):
-    """Get file upload history for the current user with live status sync."""
-    from datetime import timedelta
-    
-    files = get_user_files(user)
+
+@app.post("/api/start")
+async def start_workflow(
+    file: UploadFile = File(...),
+    convert_to_pdf_for_pages: bool = Form(default=True),  # Convert DOCX→PDF for page numbers
+    additional_notes: str = Form(default=""),  # Free-text user notes/requirements
+    user: str = Depends(verify_auth),
+    request: Request = None
+):
     client = await get_temporal_client()
+    req_id = getattr(request.state, "request_id", "unknown") if request else "unknown"
     
-    # For non-completed workflows, try to sync status from Temporal
-    for f in files:
-        if f.get('status') not in ('COMPLETED', None):
-            try:
-                handle = client.get_workflow_handle(f['workflow_id'])
-                state = await handle.query(ProposalWorkflow.get_data, rpc_timeout=timedelta(seconds=2))
-                new_status = state.get('status', 'PROCESSING')
-                
-                # Update cache if status changed
-                if new_status != f.get('status'):
-                    state_to_cache = {k: v for k, v in state.items() if k != 'final_proposal'}
-                    update_file_status(
-                        workflow_id=f['workflow_id'],
-                        status=new_status,
-                        extracted_data=state_to_cache,
-                        final_proposal=state.get('final_proposal')
-                    )
-                    f['status'] = new_status
-            except Exception as e:
-                # On error, keep existing status (workflow might be completed or not found)
-                error_msg = str(e).lower()
-                if 'workflow execution already completed' in error_msg:
-                    # Mark as completed in DB
-                    update_file_status(workflow_id=f['workflow_id'], status='COMPLETED')
-                    f['status'] = 'COMPLETED'
+    # Genererate ID and Path
+    unique_id, file_path = _upload_path(file.filename)
     
-    return {"files": files}
+    # Stream save to disk without blocking the event loop, hashing in the same pass
+    try:
+        file_sha256, _ = await save_upload(file, file_path)
+    except HTTPException:
+        raise
+    except Exception as e:
+         raise HTTPException(status_code=500, detail=f"Failed to save file: {e}")
+    
+    return await _start_proposal(
+        client, user, unique_id, file_path, file.filename, file_sha256,
+        convert_to_pdf_for_pages, additional_notes, req_id
+    )
+
+
+# Batch upload: ТЗ plus appendices analysed together as one tender (one proposal)
+MAX_BATCH_FILES = int(os.getenv("MAX_BATCH_FILES", 10))
+
+
+@app.post("/api/start_batch")
+async def start_batch_workflow(
+    files: List[UploadFile] = File(default=[]),  # First file is the ТЗ, the rest are appendices; none -> 400
+    convert_to_pdf_for_pages: bool = Form(default=True),
+    additional_notes: str = Form(default=""),
+    user: str = Depends(verify_auth),
+    request: Request = None
+):
+    if not files:
+        raise HTTPException(status_code=400, detail="Не выбрано ни одного файла")
+    if len(files) > MAX_BATCH_FILES:
+        raise HTTPException(status_code=400, detail=f"Не больше {MAX_BATCH_FILES} файлов за раз")
+    client = await get_temporal_client()
+    req_id = getattr(request.state, "request_id", "unknown") if request else "unknown"
+
+    saved = []  # (unique_id, path, filename, sha256)
+    try:
+        for file in files:
+            unique_id, file_path = _upload_path(file.filename)
+            file_sha256, _ = await save_upload(file, file_path)
+            saved.append((unique_id, file_path, file.filename, file_sha256))
+    except Exception as e:
+        for _, path, _, _ in saved:
+            await asyncio.to_thread(os.remove, path)
+        if isinstance(e, HTTPException):
+            raise
+        raise HTTPException(status_code=500, detail=f"Failed to save file: {e}")
+
+    unique_id, file_path, filename, file_sha256 = saved[0]
+    extra_files = [{"file_path": path, "file_name": name} for _, path, name, _ in saved[1:]]
+    if extra_files:
+        # Content address of the whole tender: every file's bytes, in upload order
+        batch_sha256 = hashlib.sha256(":".join(sha for _, _, _, sha in saved).encode("utf-8")).hexdigest()
+    else:
+        # Same address as /api/start, so a one-file batch dedups against a single upload
+        batch_sha256 = file_sha256
+
+    return await _start_proposal(
+        client, user, unique_id, file_path, filename, batch_sha256,
+        convert_to_pdf_for_pages, additional_notes, req_id, extra_files=extra_files or None
+    )
+
+
+# --- Resumable uploads (large scans): create session -> PUT chunks at offset -> complete ---
+
+class UploadSessionRequest(BaseModel):
+    filename: str
+    size: int
+
+
+@app.post("/api/uploads")
+async def create_upload(payload: UploadSessionRequest, user: str = Depends(verify_auth)):
+    # Full queue -> 429 before the client sends hundreds of MB (checked again on complete)
+    await admit(await get_temporal_client(), user)
+    return await create_session(user, payload.filename, payload.size)
+
+
+@app.get("/api/uploads/{upload_id}")
+async def get_upload(upload_id: str, user: str = Depends(verify_auth)):
+    """Bytes received so far: the offset to resume from after a dropped connection."""
+    return await session_status(upload_id, user)
+
+
+@app.put("/api/uploads/{upload_id}")
+async def put_upload_chunk(upload_id: str, offset: int, request: Request, user: str = Depends(verify_auth)):
+    """Raw request body appended at offset (must equal the bytes received so far)."""
+    return await append_chunk(upload_id, user, offset, request.stream())
+
+
+@app.post("/api/uploads/{upload_id}/complete")
+async def complete_upload(
+    upload_id: str,
+    convert_to_pdf_for_pages: bool = Form(default=True),
+    additional_notes: str = Form(default=""),
+    user: str = Depends(verify_auth),
+    request: Request = None
+):
+    client = await get_temporal_client()
+    req_id = getattr(request.state, "request_id", "unknown") if request else "unknown"
+
+    session = await session_status(upload_id, user)
+    # Admission before the session is consumed: after a 429 the uploaded bytes stay in the
+    # session and the client repeats /complete after Retry-After instead of re-uploading
+    queued_until = await admit(client, user)
+    unique_id, file_path = _upload_path(session["filename"])
+    file_sha256, _ = await finish_session(upload_id, user, file_path)
+
+    return await _start_proposal(
+        client, user, unique_id, file_path, session["filename"], file_sha256,
+        convert_to_pdf_for_pages, additional_notes, req_id,
+        pre_admitted=True, queued_until=queued_until
+    )
+
+
+# Fallback when visibility is unavailable: per-workflow queries, a few at a time
+HISTORY_QUERY_CONCURRENCY = int(os.getenv("HISTORY_QUERY_CONCURRENCY", 8))
+
+
+async def _statuses_from_visibility(client: Client, workflow_ids: List[str]) -> Dict[str, str]:
+    """Statuses of the given workflows from one visibility list call (KpStatus search attribute).
+    Workflows started before search attributes existed have no KpStatus and are left out."""
+    from datetime import timedelta
+
+    ids = ", ".join(f"'{wid}'" for wid in workflow_ids)
+    statuses = {}
+    async for execution in client.list_workflows(
+        f"WorkflowId IN ({ids})", page_size=len(workflow_ids), rpc_timeout=timedelta(seconds=2)
+    ):
+        if execution.status == WorkflowExecutionStatus.COMPLETED:
+            statuses[execution.id] = "COMPLETED"
+            continue
+        status = execution.typed_search_attributes.get(KP_STATUS_ATTR)
+        if status == DRAFTING_STATUS:
+            status = "WAITING_FOR_HUMAN"  # Draft is internal (admission load); the user still has to approve
+        if status:
+            statuses[execution.id] = status
+    return statuses
+
+
+async def _sync_status_by_query(client: Client, f: dict, semaphore: asyncio.Semaphore):
+    """Old path: query the workflow itself and cache its state on status change."""
+    from datetime import timedelta
+
+    async with semaphore:
+        try:
+            handle = client.get_workflow_handle(f['workflow_id'])
+            state = await handle.query(ProposalWorkflow.get_data, rpc_timeout=timedelta(seconds=2))
+            new_status = state.get('status', 'PROCESSING')
+
+            # Update cache if status changed
+            if new_status != f.get('status'):
+                state_to_cache = {k: v for k, v in state.items() if k != 'final_proposal'}
+                update_file_status(
+                    workflow_id=f['workflow_id'],
+                    status=new_status,
+                    extracted_data=state_to_cache,
+                    final_proposal=state.get('final_proposal')
+                )
+                f['status'] = new_status
+        except Exception as e:
+            # On error, keep existing status (workflow might be completed or not found)
+            error_msg = str(e).lower()
+            if 'workflow execution already completed' in error_msg:
+                # Mark as completed in DB
+                update_file_status(workflow_id=f['workflow_id'], status='COMPLETED')
+                f['status'] = 'COMPLETED'
+
+
+@app.get("/api/history")
+async def get_history(
+    cursor: Optional[str] = None,
+    limit: int = HISTORY_PAGE_SIZE,
+    user: str = Depends(verify_auth)
+):
+    """One page of the current user's upload history (newest first) with live status sync.
+    Pass next_cursor from the response to get the following page."""
+    try:
+        files, next_cursor = get_user_files(user, limit=limit, cursor=cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    pending = [f for f in files if f.get('status') not in ('COMPLETED', None)]
+    if not pending:
+        return {"files": files, "next_cursor": next_cursor}
+
+    client = await get_temporal_client()
+
+    # One visibility call for all non-completed workflows
+    statuses = {}
+    if SEARCH_ATTRIBUTES_ENABLED:
+        try:
+            statuses = await _statuses_from_visibility(client, [f['workflow_id'] for f in pending])
+        except Exception as e:
+            logger.warning(f"History: visibility list failed, falling back to queries: {e}")
+
+    unresolved = []
+    for f in pending:
+        new_status = statuses.get(f['workflow_id'])
+        if new_status is None:
+            unresolved.append(f)
+        elif new_status != f.get('status'):
+            # Details are synced lazily by /api/file and /api/status
+            update_file_status(workflow_id=f['workflow_id'], status=new_status)
+            f['status'] = new_status
+
+    if unresolved:
+        semaphore = asyncio.Semaphore(HISTORY_QUERY_CONCURRENCY)
+        await asyncio.gather(*(_sync_status_by_query(client, f, semaphore) for f in unresolved))
+
+    return {"files": files, "next_cursor": next_cursor}
 
 
 @app.get("/api/file/{workflow_id}")
@@ -317,28 +615,63 @@ async def get_file_details(workflow_id: str, user: str = Depends(verify_auth)):
     return file_data
 
 
+# workflow_id -> last state version written to the DB (bounded, oldest evicted)
+PERSISTED_VERSIONS_MAX = 10000
+_persisted_versions: "OrderedDict[str, int]" = OrderedDict()
+
+
+def _cache_state(workflow_id: str, state: dict):
+    """Caches workflow state in the DB for history and resume, once per state version."""
+    version = state.get("version")
+    if version is not None and _persisted_versions.get(workflow_id) == version:
+        return
+    # Cache the full state (excluding final_proposal which is cached separately)
+    state_to_cache = {k: v for k, v in state.items() if k != 'final_proposal'}
+    update_file_status(
+        workflow_id=workflow_id,
+        status=state.get("status", "PROCESSING"),
+        extracted_data=state_to_cache,  # Full state for analysis restoration
+        final_proposal=state.get("final_proposal")
+    )
+    if version is not None:
+        _persisted_versions[workflow_id] = version
+        _persisted_versions.move_to_end(workflow_id)
+        while len(_persisted_versions) > PERSISTED_VERSIONS_MAX:
+            _persisted_versions.popitem(last=False)
+
+
+def _status_etag(workflow_id: str, version: int) -> str:
+    return f'"{workflow_id}-{version}"'
+
+
 @app.get("/api/status/{workflow_id}")
-async def get_status(workflow_id: str, user: str = Depends(verify_auth)):
+async def get_status(workflow_id: str, request: Request, user: str = Depends(verify_auth)):
+    """Full workflow state with an ETag of its version; If-None-Match on an unchanged version -> 304."""
     from datetime import timedelta
     
     client = await get_temporal_client()
     handle = client.get_workflow_handle(workflow_id)
     
     try:
+        # Cheap query first: status + version, no payload
+        try:
+            head = await handle.query(ProposalWorkflow.get_status_version, rpc_timeout=timedelta(seconds=10))
+        except WorkflowQueryFailedError:
+            head = None  # Started before state versioning: no such query
+        if head is not None:
+            etag = _status_etag(workflow_id, head["version"])
+            if request.headers.get("If-None-Match") == etag:
+                return Response(status_code=304, headers={"ETag": etag})
+
         # Query с коротким timeout - если worker занят, вернём статус "обработка"
         state = await handle.query(ProposalWorkflow.get_data, rpc_timeout=timedelta(seconds=10))
         
-        # Sync status to database for history tracking
-        # Cache the full state (excluding final_proposal which is cached separately)
-        state_to_cache = {k: v for k, v in state.items() if k != 'final_proposal'}
-        update_file_status(
-            workflow_id=workflow_id,
-            status=state.get("status", "PROCESSING"),
-            extracted_data=state_to_cache,  # Full state for analysis restoration
-            final_proposal=state.get("final_proposal")
-        )
+        # Sync status to database for history tracking (only when the version moved)
+        _cache_state(workflow_id, state)
         
-        return state
+        if state.get("version") is None:
+            return state
+        return JSONResponse(content=state, headers={"ETag": _status_etag(workflow_id, state["version"])})
     except Exception as e:
         error_msg = str(e).lower()
         print(f"Query error for {workflow_id}: {type(e).__name__}: {e}")
@@ -367,6 +700,51 @@ async def get_status(workflow_id: str, user: str = Depends(verify_auth)):
             print(f"Workflow not found: {workflow_id}")
             raise HTTPException(status_code=404, detail="Workflow not found")
 
+# One watcher per workflow, shared by every open tab (status_stream.py)
+status_hub = StatusHub(on_state=_cache_state)
+
+
+@app.get("/api/events/{workflow_id}")
+async def stream_events(workflow_id: str, user: str = Depends(verify_auth)):
+    """Server-Sent Events: "state" on status transitions (full get_data), "progress" on workflow activity, then "end"."""
+    client = await get_temporal_client()
+    queue = status_hub.subscribe(client, workflow_id)
+
+    async def event_stream():
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    break
+                name, payload = event
+                yield f"event: {name}\ndata: {json.dumps(payload, ensure_ascii=False, default=str)}\n\n"
+        finally:
+            status_hub.unsubscribe(workflow_id, queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}  # nginx: do not buffer the stream
+    )
+
+@app.get("/api/progress/{workflow_id}")
+async def get_progress(workflow_id: str, user: str = Depends(verify_auth)):
+    """Lightweight progress (stage timings, chunks done/total, ETA). No payload, no DB writes."""
+    client = await get_temporal_client()
+    
+    try:
+        return await query_progress(client, workflow_id)
+    except Exception as e:
+        error_msg = str(e).lower()
+        if "not found" in error_msg:
+            raise HTTPException(status_code=404, detail="Workflow not found")
+        # Worker busy or older workflow without progress tracking
+        return {"status": "PROCESSING", "stage": None, "eta_seconds": None}
+
 @app.post("/api/approve/{workflow_id}")
 async def approve_workflow(
     workflow_id: str, 
@@ -404,6 +782,61 @@ async def approve_workflow(
             )
         raise HTTPException(status_code=500, detail=f"Failed to send signal: {e}")
 
+# --- DOCX rendering: off the event loop in a small process pool, rendered bytes cached by markdown hash ---
+DOCX_RENDER_WORKERS = int(os.getenv("DOCX_RENDER_WORKERS", 2))
+DOCX_CACHE_MB = int(os.getenv("DOCX_CACHE_MB", 64))
+_docx_pool: Optional[ProcessPoolExecutor] = None
+_docx_cache = LRUCache(max_items=512, max_bytes=DOCX_CACHE_MB * 1024 * 1024)
+_docx_inflight: Dict[str, asyncio.Future] = {}  # Same text clicked twice -> rendered once
+
+
+def _get_docx_pool() -> ProcessPoolExecutor:
+    global _docx_pool
+    if _docx_pool is None:
+        # spawn: forking the running event loop process (its threads, sockets, locks) is unsafe
+        _docx_pool = ProcessPoolExecutor(
+            max_workers=DOCX_RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _docx_pool
+
+
+def _docx_rendered(key: str, future: asyncio.Future):
+    global _docx_pool
+    _docx_inflight.pop(key, None)
+    if future.cancelled():
+        return
+    if isinstance(future.exception(), BrokenProcessPool):
+        _docx_pool = None  # A worker died; start a fresh pool on the next render
+    elif future.exception() is None:
+        _docx_cache.put(key, future.result())
+
+
+async def _render_docx(md_text: str) -> bytes:
+    key = hashlib.sha256(md_text.encode("utf-8")).hexdigest()
+    cached = _docx_cache.get(key)
+    if cached is not None:
+        return cached
+    future = _docx_inflight.get(key)
+    if future is None:
+        loop = asyncio.get_running_loop()
+        future = asyncio.ensure_future(loop.run_in_executor(_get_docx_pool(), markdown_to_docx_bytes, md_text))
+        future.add_done_callback(lambda f: _docx_rendered(key, f))
+        _docx_inflight[key] = future
+    # Shielded: a client that disconnects does not cancel the render others are waiting for
+    return await asyncio.shield(future)
+
+
+@app.on_event("shutdown")
+async def shutdown_docx_pool():
+    if _docx_pool is not None:
+        _docx_pool.shutdown(wait=False, cancel_futures=True)
+
+
+@app.on_event("shutdown")
+async def shutdown_keycloak_client():
+    await close_keycloak_client()
+
+
 @app.post("/api/download_docx")
 async def download_docx(request: DownloadRequest, req: Request, user: str = Depends(verify_auth)):
     req_id = getattr(req.state, "request_id", "unknown")
@@ -412,9 +845,9 @@ async def download_docx(request: DownloadRequest, req: Request, user: str = Depe
         "action": "DOWNLOAD",
         "request_id": req_id
     })
-    buffer = markdown_to_docx(request.text)
-    return StreamingResponse(
-        buffer,
+    docx_bytes = await _render_docx(request.text)
+    return Response(
+        content=docx_bytes,
         media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
         headers={"Content-Disposition": "attachment; filename=Commercial_Proposal.docx"}
     )
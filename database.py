@@ -4,11 +4,12 @@ Database layer for user file history.
 Uses SQLite for simplicity, designed for easy migration to PostgreSQL.
 """
 
+import base64
 import os
 import uuid
 from datetime import datetime
-from typing import Optional, List
-from sqlalchemy import create_engine, Column, String, DateTime, Text, JSON
+from typing import Optional, List, Tuple
+from sqlalchemy import create_engine, Column, String, DateTime, Text, JSON, Boolean, Index, inspect, text, tuple_
 from sqlalchemy.orm import sessionmaker, declarative_base
 from contextlib import contextmanager
 
@@ -29,6 +30,13 @@ engine = create_engine(
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# Workflow statuses that mean "still being worked on" (can be attached to instead of re-processing)
+ACTIVE_STATUSES = ("QUEUED", "PROCESSING", "WAITING_FOR_HUMAN")
+
+# History is served in keyset pages of this size (newest first)
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 50))
+HISTORY_MAX_PAGE_SIZE = 200
+
 
 class UserFile(Base):
     """Model for storing user file upload history."""
@@ -41,14 +49,45 @@ class UserFile(Base):
     uploaded_at = Column(DateTime, default=datetime.utcnow)
     status = Column(String(50), default="PROCESSING")
     
+    # SHA-256 of uploaded bytes + processing options (dedup of re-uploads)
+    content_hash = Column(String(64), nullable=True, index=True)
+    
     # Cached results for quick display (avoid querying Temporal for history)
     extracted_data_cache = Column(JSON, nullable=True)
     final_proposal_cache = Column(Text, nullable=True)
 
+    # Kept in sync with the caches above, so history does not have to load them
+    has_extracted_data = Column(Boolean, nullable=False, default=False, server_default=text("FALSE"))
+    has_proposal = Column(Boolean, nullable=False, default=False, server_default=text("FALSE"))
+
+    __table_args__ = (
+        # History pages: WHERE username = ? ORDER BY uploaded_at DESC, id DESC (id breaks ties)
+        Index("ix_user_files_username_uploaded_at", "username", "uploaded_at", "id"),
+    )
+
 
 def init_db():
     """Create database tables."""
     Base.metadata.create_all(bind=engine)
+    _migrate_columns()
+
+
+def _migrate_columns():
+    """Add columns introduced after the table was created (create_all does not alter tables)."""
+    existing = {c["name"] for c in inspect(engine).get_columns(UserFile.__tablename__)}
+    with engine.begin() as conn:
+        if "content_hash" not in existing:
+            conn.execute(text("ALTER TABLE user_files ADD COLUMN content_hash VARCHAR(64)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_user_files_content_hash ON user_files (content_hash)"))
+        if "has_extracted_data" not in existing:
+            conn.execute(text("ALTER TABLE user_files ADD COLUMN has_extracted_data BOOLEAN NOT NULL DEFAULT FALSE"))
+            conn.execute(text("UPDATE user_files SET has_extracted_data = TRUE WHERE extracted_data_cache IS NOT NULL"))
+        if "has_proposal" not in existing:
+            conn.execute(text("ALTER TABLE user_files ADD COLUMN has_proposal BOOLEAN NOT NULL DEFAULT FALSE"))
+            conn.execute(text("UPDATE user_files SET has_proposal = TRUE WHERE final_proposal_cache IS NOT NULL"))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_user_files_username_uploaded_at ON user_files (username, uploaded_at, id)"
+        ))
 
 
 @contextmanager
@@ -64,7 +103,9 @@ def get_db():
 def save_user_file(
     username: str,
     workflow_id: str,
-    original_filename: str
+    original_filename: str,
+    content_hash: Optional[str] = None,
+    status: str = "PROCESSING"
 ) -> UserFile:
     """Save new file upload record."""
     with get_db() as db:
@@ -72,7 +113,8 @@ def save_user_file(
             username=username,
             workflow_id=workflow_id,
             original_filename=original_filename,
-            status="PROCESSING"
+            status=status,
+            content_hash=content_hash
         )
         db.add(user_file)
         db.commit()
@@ -96,32 +138,72 @@ def update_file_status(
             user_file.status = status
             if extracted_data is not None:
                 user_file.extracted_data_cache = extracted_data
+                user_file.has_extracted_data = True
             if final_proposal is not None:
                 user_file.final_proposal_cache = final_proposal
+                user_file.has_proposal = True
             db.commit()
             db.refresh(user_file)
         return user_file
 
 
-def get_user_files(username: str) -> List[dict]:
-    """Get all files for a user, ordered by upload date (newest first)."""
+def _encode_cursor(uploaded_at: datetime, file_id: str) -> str:
+    return base64.urlsafe_b64encode(f"{uploaded_at.isoformat()}|{file_id}".encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Raises ValueError for a malformed cursor."""
+    try:
+        uploaded_at, file_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(uploaded_at), file_id
+    except (UnicodeError, ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def get_user_files(
+    username: str,
+    limit: int = HISTORY_PAGE_SIZE,
+    cursor: Optional[str] = None
+) -> Tuple[List[dict], Optional[str]]:
+    """
+    One page of a user's files, newest first: (files, next_cursor).
+    Keyset pagination over (uploaded_at, id); next_cursor is None on the last page.
+    """
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
     with get_db() as db:
-        files = db.query(UserFile).filter(
-            UserFile.username == username
-        ).order_by(UserFile.uploaded_at.desc()).all()
-        
-        return [
-            {
-                "id": f.id,
-                "workflow_id": f.workflow_id,
-                "filename": f.original_filename,
-                "uploaded_at": f.uploaded_at.isoformat() if f.uploaded_at else None,
-                "status": f.status,
-                "has_extracted_data": f.extracted_data_cache is not None,
-                "has_proposal": f.final_proposal_cache is not None
-            }
-            for f in files
-        ]
+        # Only lightweight columns: the JSON/text caches are never loaded here
+        query = db.query(
+            UserFile.id,
+            UserFile.workflow_id,
+            UserFile.original_filename,
+            UserFile.uploaded_at,
+            UserFile.status,
+            UserFile.has_extracted_data,
+            UserFile.has_proposal
+        ).filter(UserFile.username == username)
+        if cursor:
+            cursor_at, cursor_id = _decode_cursor(cursor)
+            # Row-value comparison: a range seek on the index, not a scan past newer rows
+            query = query.filter(tuple_(UserFile.uploaded_at, UserFile.id) < tuple_(cursor_at, cursor_id))
+        rows = query.order_by(UserFile.uploaded_at.desc(), UserFile.id.desc()).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1].uploaded_at, rows[-1].id)
+    files = [
+        {
+            "id": f.id,
+            "workflow_id": f.workflow_id,
+            "filename": f.original_filename,
+            "uploaded_at": f.uploaded_at.isoformat() if f.uploaded_at else None,
+            "status": f.status,
+            "has_extracted_data": bool(f.has_extracted_data),
+            "has_proposal": bool(f.has_proposal)
+        }
+        for f in rows
+    ]
+    return files, next_cursor
 
 
 def get_file_by_workflow_id(workflow_id: str) -> Optional[dict]:
@@ -146,6 +228,25 @@ def get_file_by_workflow_id(workflow_id: str) -> Optional[dict]:
         }
 
 
+def find_active_file_by_hash(username: str, content_hash: str) -> Optional[dict]:
+    """Get the user's newest upload with the same content hash that is still in progress."""
+    with get_db() as db:
+        f = db.query(UserFile).filter(
+            UserFile.username == username,
+            UserFile.content_hash == content_hash,
+            UserFile.status.in_(ACTIVE_STATUSES)
+        ).order_by(UserFile.uploaded_at.desc()).first()
+        
+        if not f:
+            return None
+        
+        return {
+            "workflow_id": f.workflow_id,
+            "filename": f.original_filename,
+            "status": f.status
+        }
+
+
 def get_file_owner(workflow_id: str) -> Optional[str]:
     """Get username who owns the workflow."""
     with get_db() as db:
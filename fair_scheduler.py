@@ -0,0 +1,237 @@
+"""
+Per-user fair scheduling of gpu-queue activities.
+
+Temporal hands out tasks of a queue in FIFO order, so one user's batch upload would
+occupy every LLM slot until it drains. Instead the GPU worker polls many tasks at once
+and admits them to the LLM through FairScheduler: at most GPU_CONCURRENCY in flight,
+at most GPU_PER_USER_LIMIT per user while other users are waiting, and free slots go
+round-robin to users with waiting activities. A user alone on the worker may use every slot.
+
+The wait for a slot happens inside the activity, so it counts against its
+start_to_close_timeout: workflows.py adds GPU_QUEUE_MAX_WAIT_MINUTES to the timeout of
+every gpu-queue activity, and GPU_WORKER_SLOTS bounds how many tasks can queue up here.
+
+The user travels with the work: api.py puts it into the workflow memo, the workflow
+interceptor copies it into a header of every activity and child workflow it starts,
+and the activity interceptor reads the header on the worker.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from datetime import timedelta
+from typing import Any, Deque, Dict, Optional, Type
+
+from temporalio import activity, workflow
+from temporalio.api.enums.v1 import TaskQueueType
+from temporalio.api.taskqueue.v1 import TaskQueue
+from temporalio.api.workflowservice.v1 import DescribeTaskQueueRequest
+from temporalio.client import Client
+from temporalio.worker import (
+    ActivityInboundInterceptor,
+    ExecuteActivityInput,
+    Interceptor,
+    StartActivityInput,
+    StartChildWorkflowInput,
+    WorkflowInboundInterceptor,
+    WorkflowInterceptorClassInput,
+    WorkflowOutboundInterceptor,
+)
+
+from metrics import GPU_SLOT_WAIT, GPU_SLOTS_IN_USE, GPU_SLOTS_WAITING
+
+logger = logging.getLogger("fair_scheduler")
+
+GPU_TASK_QUEUE = "gpu-queue"
+USER_MEMO_KEY = "user"
+USER_HEADER = "kp-user"
+
+# LLM activities allowed to run at once (the old max_concurrent_activities of the GPU worker)
+GPU_CONCURRENCY = int(os.getenv("GPU_CONCURRENCY", 5))
+# In-flight LLM activities per user while others wait; keeps slots for them during batch uploads
+GPU_PER_USER_LIMIT = int(os.getenv("GPU_PER_USER_LIMIT", 3))
+# Activity tasks the GPU worker holds (running + waiting for a fair slot). The rest stay in
+# the Temporal queue, where waiting does not use up start_to_close_timeout
+GPU_WORKER_SLOTS = int(os.getenv("GPU_WORKER_SLOTS", 40))
+# Waiting activities heartbeat at this interval so heartbeat_timeout does not fire in the queue
+FAIR_WAIT_HEARTBEAT = int(os.getenv("ACTIVITY_HEARTBEAT_INTERVAL", 15))
+
+
+class FairScheduler:
+    """Global + per-user concurrency limit with round-robin hand-off between users."""
+
+    def __init__(self, global_limit: int = GPU_CONCURRENCY, per_user_limit: int = GPU_PER_USER_LIMIT):
+        self.global_limit = global_limit
+        self.per_user_limit = max(1, min(per_user_limit, global_limit))
+        self.running: Dict[str, int] = {}
+        self.in_flight = 0
+        # user -> FIFO of waiters; the order of keys is the round-robin order
+        self._waiting: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+
+    def waiting_count(self) -> int:
+        return sum(len(q) for q in self._waiting.values())
+
+    def _others_waiting(self, user: str) -> bool:
+        """Another user has a live waiter and is under the per-user cap (could take the slot)."""
+        return any(
+            other != user
+            and self.running.get(other, 0) < self.per_user_limit
+            and any(not f.done() for f in queue)
+            for other, queue in self._waiting.items()
+        )
+
+    def _can_run(self, user: str) -> bool:
+        if self.in_flight >= self.global_limit:
+            return False
+        # Over the per-user cap only while that would leave the slot idle
+        return self.running.get(user, 0) < self.per_user_limit or not self._others_waiting(user)
+
+    def _grant(self, user: str):
+        self.in_flight += 1
+        self.running[user] = self.running.get(user, 0) + 1
+        GPU_SLOTS_IN_USE.set(self.in_flight)
+
+    def _dispatch(self):
+        """Hands free slots to waiting users in round-robin order."""
+        progressed = True
+        while progressed and self.in_flight < self.global_limit:
+            progressed = False
+            for user in list(self._waiting):
+                queue = self._waiting[user]
+                while queue and queue[0].done():  # Cancelled while waiting
+                    queue.popleft()
+                if not queue:
+                    del self._waiting[user]
+                    continue
+                if not self._can_run(user):
+                    continue
+                self._grant(user)
+                queue.popleft().set_result(None)
+                # Served user goes to the back of the line
+                self._waiting.move_to_end(user)
+                progressed = True
+                break
+
+    async def acquire(self, user: str):
+        if not self._waiting and self._can_run(user):
+            self._grant(user)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user, deque()).append(future)
+        self._dispatch()  # Others may be waiting only on their per-user cap
+        GPU_SLOTS_WAITING.set(self.waiting_count())
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), timeout=FAIR_WAIT_HEARTBEAT)
+                    return
+                except asyncio.TimeoutError:
+                    if activity.in_activity():
+                        activity.heartbeat()
+        except BaseException:
+            if future.done() and not future.cancelled():
+                self.release(user)  # Granted at the moment we were cancelled
+            else:
+                future.cancel()
+                self._dispatch()
+            raise
+        finally:
+            GPU_SLOTS_WAITING.set(self.waiting_count())
+
+    def release(self, user: str):
+        self.in_flight -= 1
+        self.running[user] -= 1
+        if not self.running[user]:
+            del self.running[user]
+        GPU_SLOTS_IN_USE.set(self.in_flight)
+        self._dispatch()
+
+
+async def gpu_backlog(client: Client) -> Optional[int]:
+    """Approximate gpu-queue activity backlog, None if the server does not report it."""
+    try:
+        response = await client.workflow_service.describe_task_queue(
+            DescribeTaskQueueRequest(
+                namespace=client.namespace,
+                task_queue=TaskQueue(name=GPU_TASK_QUEUE),
+                task_queue_type=TaskQueueType.TASK_QUEUE_TYPE_ACTIVITY,
+                report_stats=True
+            ),
+            timeout=timedelta(seconds=3)
+        )
+    except Exception as e:
+        logger.debug(f"gpu-queue stats unavailable: {e}")
+        return None
+    if not response.HasField("stats"):
+        return None
+    return response.stats.approximate_backlog_count
+
+
+def _user_from_headers(headers) -> str:
+    payload = headers.get(USER_HEADER)
+    if payload is None:
+        return ""
+    return activity.payload_converter().from_payloads([payload])[0] or ""
+
+
+class _FairActivityInbound(ActivityInboundInterceptor):
+    def __init__(self, next: ActivityInboundInterceptor, scheduler: FairScheduler):
+        super().__init__(next)
+        self.scheduler = scheduler
+
+    async def execute_activity(self, input: ExecuteActivityInput) -> Any:
+        user = _user_from_headers(input.headers)
+        start = time.monotonic()
+        await self.scheduler.acquire(user)
+        GPU_SLOT_WAIT.labels(activity.info().activity_type).observe(time.monotonic() - start)
+        try:
+            return await self.next.execute_activity(input)
+        finally:
+            self.scheduler.release(user)
+
+
+class _UserHeaderOutbound(WorkflowOutboundInterceptor):
+    """Stamps the workflow's user (memo) onto the activities and children it starts."""
+
+    def _user(self) -> str:
+        return workflow.memo_value(USER_MEMO_KEY, "")
+
+    def _with_user_header(self, headers):
+        user = self._user()
+        if not user:
+            return headers
+        payload = workflow.payload_converter().to_payloads([user])[0]
+        return {**headers, USER_HEADER: payload}
+
+    def start_activity(self, input: StartActivityInput) -> workflow.ActivityHandle:
+        input.headers = self._with_user_header(input.headers)
+        return super().start_activity(input)
+
+    async def start_child_workflow(self, input: StartChildWorkflowInput) -> workflow.ChildWorkflowHandle:
+        user = self._user()
+        if user:
+            input.memo = {**(input.memo or {}), USER_MEMO_KEY: user}
+        return await super().start_child_workflow(input)
+
+
+class _UserHeaderInbound(WorkflowInboundInterceptor):
+    def init(self, outbound: WorkflowOutboundInterceptor) -> None:
+        super().init(_UserHeaderOutbound(outbound))
+
+
+class UserHeaderInterceptor(Interceptor):
+    """Workflow-side half: register on the worker that runs the workflows."""
+
+    def workflow_interceptor_class(self, input: WorkflowInterceptorClassInput) -> Optional[Type[WorkflowInboundInterceptor]]:
+        return _UserHeaderInbound
+
+
+class FairShareInterceptor(Interceptor):
+    """Activity-side half: register on the gpu-queue worker."""
+
+    def __init__(self, scheduler: Optional[FairScheduler] = None):
+        self.scheduler = scheduler or FairScheduler()
+
+    def intercept_activity(self, next: ActivityInboundInterceptor) -> ActivityInboundInterceptor:
+        return _FairActivityInbound(next, self.scheduler)
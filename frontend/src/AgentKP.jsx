@@ -1,11 +1,11 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import {
   Container, Paper, Typography, Button, TextField,
   Box, CircularProgress, Table, TableBody, TableContainer,
   TableCell, TableHead, TableRow, IconButton, Chip,
   Dialog, DialogTitle, DialogContent, DialogActions,
   AppBar, Toolbar, Avatar, Menu, MenuItem, Divider,
-  Alert, AlertTitle, Collapse
+  Alert, AlertTitle, Collapse, LinearProgress
 } from '@mui/material';
 import {
   CloudUpload, CheckCircle, Add, Delete, Refresh, ArrowBack, Logout, Person, GetApp,
@@ -18,11 +18,18 @@ import { config } from './config';
 import MarkdownEditor from './MarkdownEditor';
 import BudgetMatrix from './BudgetMatrix';
 import keycloak from './keycloak';
+import { streamEvents } from './sse';
+import ReactMarkdown from 'react-markdown';
+import remarkGfm from 'remark-gfm';
 
 // Адрес FastAPI бэкенда (автоматически dev/prod)
 const API_URL = config.API_URL;
 // Note: axios Bearer token is set globally by App.jsx keycloak interceptor
 
+// Файлы больше этого размера загружаются частями (/api/uploads), с докачкой после обрыва
+const RESUMABLE_UPLOAD_THRESHOLD = 20 * 1024 * 1024;
+const RESUMABLE_MAX_RETRIES = 5;
+
 // Helper to format data (arrays) to multiline string
 const formatDataToString = (val) => {
   if (Array.isArray(val)) return val.join('\n');
@@ -36,6 +43,12 @@ const isManagerItem = (item) => {
   return item.source_quote === MANAGER_SOURCE_TAG || item.source === MANAGER_SOURCE_TAG;
 };
 
+// Helper: human-readable ETA from seconds
+const formatEta = (seconds) => {
+  if (seconds < 60) return 'меньше минуты';
+  return `${Math.round(seconds / 60)} мин`;
+};
+
 // Manager item style constants
 const MANAGER_COLOR = '#7B1FA2'; // Purple 700
 const MANAGER_BG = 'rgba(123, 31, 162, 0.06)';
@@ -45,11 +58,16 @@ const MANAGER_BG_SELECTED = 'rgba(123, 31, 162, 0.12)';
 export default function AgentKP() {
   const navigate = useNavigate();
   const [file, setFile] = useState(null);
+  const [appendices, setAppendices] = useState([]); // Приложения к ТЗ: анализируются вместе с ним, одно КП на тендер
   const [additionalNotes, setAdditionalNotes] = useState('');
   const [workflowId, setWorkflowId] = useState(null);
   const [status, setStatus] = useState(null);
   const [data, setData] = useState(null);
   const [finalDoc, setFinalDoc] = useState(null);
+  const [streamingDoc, setStreamingDoc] = useState(''); // Текст КП, приходящий по мере генерации
+  const [progress, setProgress] = useState(null); // {stage, chunks_done, chunks_total, eta_seconds, received_at}
+  const [clock, setClock] = useState(Date.now()); // Тикает, пока показывается ETA: обратный отсчёт между событиями
+  const [queuedUntil, setQueuedUntil] = useState(null); // Ориентировочный старт, если документ в очереди
 
   // User state
   const [username, setUsername] = useState('');
@@ -87,6 +105,9 @@ export default function AgentKP() {
   // --- История файлов ---
   const [historyFiles, setHistoryFiles] = useState([]);
   const [historyLoading, setHistoryLoading] = useState(false);
+  const [historyCursor, setHistoryCursor] = useState(null); // next_cursor следующей страницы истории
+  const [historyLoadingMore, setHistoryLoadingMore] = useState(false);
+  const historyExtraPages = useRef(0); // Сколько страниц догружено кнопкой «Показать ещё»
 
   // --- Флаг локального редактирования (блокирует polling) ---
   const [isLocalEditing, setIsLocalEditing] = useState(false);
@@ -121,6 +142,14 @@ export default function AgentKP() {
     setUsername(user);
   }, []);
 
+  // ETA посчитан сервером в момент события; между событиями (долгий вызов LLM) отсчитываем его сами
+  const hasEta = status === "PROCESSING" && progress?.eta_seconds != null;
+  useEffect(() => {
+    if (!hasEta) return;
+    const timer = setInterval(() => setClock(Date.now()), 10000);
+    return () => clearInterval(timer);
+  }, [hasEta]);
+
   // Check for workflow_id in URL params (for resuming sessions)
   const [searchParams] = useSearchParams();
 
@@ -138,7 +167,19 @@ export default function AgentKP() {
     if (!silent) setHistoryLoading(true);
     try {
       const res = await axios.get(`${API_URL}/history`);
-      setHistoryFiles(res.data.files || []);
+      const page = res.data.files || [];
+      if (historyExtraPages.current === 0) {
+        setHistoryFiles(page);
+        setHistoryCursor(res.data.next_cursor || null);
+      } else {
+        // Обновляем только первую страницу, догруженные старые записи сохраняем
+        const ids = new Set(page.map(f => f.workflow_id));
+        const last = page[page.length - 1];
+        setHistoryFiles(prev => [
+          ...page,
+          ...prev.filter(f => !ids.has(f.workflow_id) && (!last || f.uploaded_at <= last.uploaded_at))
+        ]);
+      }
     } catch (err) {
       console.error('Failed to load history:', err);
     } finally {
@@ -146,6 +187,25 @@ export default function AgentKP() {
     }
   };
 
+  const loadMoreHistory = async () => {
+    if (!historyCursor) return;
+    setHistoryLoadingMore(true);
+    try {
+      const res = await axios.get(`${API_URL}/history`, { params: { cursor: historyCursor } });
+      const page = res.data.files || [];
+      historyExtraPages.current += 1;
+      setHistoryFiles(prev => {
+        const ids = new Set(prev.map(f => f.workflow_id));
+        return [...prev, ...page.filter(f => !ids.has(f.workflow_id))];
+      });
+      setHistoryCursor(res.data.next_cursor || null);
+    } catch (err) {
+      console.error('Failed to load history:', err);
+    } finally {
+      setHistoryLoadingMore(false);
+    }
+  };
+
   useEffect(() => {
     if (!workflowId) {
       fetchHistory(); // Initial load with loading indicator
@@ -171,6 +231,7 @@ export default function AgentKP() {
 
   const getStatusChip = (status) => {
     const statusConfig = {
+      'QUEUED': { label: 'В очереди', color: 'default' },
       'PROCESSING': { label: 'Обработка', color: 'warning' },
       'WAITING_FOR_HUMAN': { label: 'Ожидает проверки', color: 'info' },
       'GENERATING': { label: 'Генерация КП', color: 'primary' },
@@ -185,7 +246,9 @@ export default function AgentKP() {
     // Reset all state for clean resume
     setData(null);
     setFinalDoc(null);
+    setStreamingDoc('');
     setFile(null);
+    setAppendices([]);
     setIsLocalEditing(false); // Reset editing mode
     setWorkflowId(wfId);
 
@@ -388,210 +451,273 @@ export default function AgentKP() {
   };
 
   // --- 1. ЗАГРУЗКА ФАЙЛА ---
+  // Большие сканы грузим частями: при обрыве связи продолжаем с последнего принятого байта
+  const uploadResumable = async (formData) => {
+    const { data: session } = await axios.post(`${API_URL}/uploads`, { filename: file.name, size: file.size });
+    let offset = session.received;
+    let failures = 0;
+    while (offset < file.size) {
+      try {
+        const chunk = file.slice(offset, offset + session.chunk_size);
+        const res = await axios.put(`${API_URL}/uploads/${session.upload_id}`, chunk, {
+          params: { offset },
+          headers: { 'Content-Type': 'application/octet-stream' },
+        });
+        offset = res.data.received;
+        failures = 0;
+      } catch (err) {
+        if (err.response?.status === 413 || ++failures > RESUMABLE_MAX_RETRIES) throw err;
+        await new Promise(resolve => setTimeout(resolve, 2000 * failures));
+        const { data } = await axios.get(`${API_URL}/uploads/${session.upload_id}`);
+        offset = data.received;
+      }
+    }
+    formData.delete('file');
+    return axios.post(`${API_URL}/uploads/${session.upload_id}/complete`, formData);
+  };
+
   const handleUpload = async () => {
     if (!file) return;
     const formData = new FormData();
-    formData.append('file', file);
+    if (appendices.length) {
+      // ТЗ первым, затем приложения
+      [file, ...appendices].forEach(f => formData.append('files', f));
+    } else {
+      formData.append('file', file);
+    }
     if (additionalNotes.trim()) {
       formData.append('additional_notes', additionalNotes.trim());
     }
 
     try {
       // Отправляем файл на FastAPI
-      const res = await axios.post(`${API_URL}/start`, formData);
+      const res = appendices.length
+        ? await axios.post(`${API_URL}/start_batch`, formData)
+        : file.size > RESUMABLE_UPLOAD_THRESHOLD
+        ? await uploadResumable(formData)
+        : await axios.post(`${API_URL}/start`, formData);
       setWorkflowId(res.data.workflow_id);
       setIsLocalEditing(false); // Ensure polling is enabled
-      setStatus("PROCESSING");
+      setQueuedUntil(res.data.estimated_start || null);
+      setStatus(res.data.queued ? "QUEUED" : "PROCESSING");
     } catch (err) {
-      alert("Ошибка соединения с сервером: " + err.message);
+      if (err.response?.status === 413) {
+        alert(err.response.data?.detail || "Файл слишком большой");
+      } else if (err.response?.status === 429) {
+        // Очередь заполнена: сервер сообщает, когда повторить (Retry-After)
+        alert(err.response.data?.detail || "Сервис перегружен, попробуйте позже");
+      } else {
+        alert("Ошибка соединения с сервером: " + err.message);
+      }
     }
   };
 
-  // --- 2. ОПРОС СТАТУСА (Long Polling) ---
+  // --- 2. ПОТОК СТАТУСА (Server-Sent Events) ---
+  // Сервер присылает "state" при смене статуса и "progress" по ходу обработки
+  const dataRef = useRef(data);
+  dataRef.current = data;
+  const isStreaming = !!workflowId && status !== "COMPLETED" && !isLocalEditing;
+
   useEffect(() => {
-    // Don't poll if: no workflow, already completed, or in local editing mode
-    if (!workflowId || status === "COMPLETED" || isLocalEditing) return;
+    // Don't stream if: no workflow, already completed, or in local editing mode
+    if (!isStreaming) return;
 
-    const interval = setInterval(async () => {
-      try {
-        const res = await axios.get(`${API_URL}/status/${workflowId}`);
-        const state = res.data;
-
-        setStatus(state.status);
-
-        // Когда ИИ закончил анализ, сохраняем данные
-        if (state.status === "WAITING_FOR_HUMAN" && state.extracted_data && !data) {
-          const raw = state.extracted_data;
-
-          // Helper: Safely extract string from different formats (string | object)
-          const safelyExtractText = (val) => {
-            if (!val) return '';
-            if (typeof val === 'string') return val;
-            if (typeof val === 'object') return val.text || '';
-            return String(val);
-          };
-
-          // Helper: Extract source from object if available (supports both source_quote from RAG and legacy source)
-          const safelyExtractSource = (val) => {
-            if (val && typeof val === 'object') return val.source_quote || val.source || '';
-            return '';
-          };
-
-          // Helper: Normalize arrays (handles string/array/object mix)
-          const extractTextArray = (val) => {
-            if (!val) return [];
-            if (Array.isArray(val)) {
-              return val.map(item => typeof item === 'object' ? (item.text || '') : item);
+    const controller = new AbortController();
+
+    const applyState = (state) => {
+      setStatus(state.status);
+      setQueuedUntil(state.queued_until || null);
+
+      // Когда ИИ закончил анализ, сохраняем данные
+      if (state.status === "WAITING_FOR_HUMAN" && state.extracted_data && !dataRef.current) {
+        const raw = state.extracted_data;
+
+        // Helper: Safely extract string from different formats (string | object)
+        const safelyExtractText = (val) => {
+          if (!val) return '';
+          if (typeof val === 'string') return val;
+          if (typeof val === 'object') return val.text || '';
+          return String(val);
+        };
+
+        // Helper: Extract source from object if available (supports both source_quote from RAG and legacy source)
+        const safelyExtractSource = (val) => {
+          if (val && typeof val === 'object') return val.source_quote || val.source || '';
+          return '';
+        };
+
+        // Helper: Normalize arrays (handles string/array/object mix)
+        const extractTextArray = (val) => {
+          if (!val) return [];
+          if (Array.isArray(val)) {
+            return val.map(item => typeof item === 'object' ? (item.text || '') : item);
+          }
+          if (typeof val === 'string') return [val]; // Handle single string as array
+          return [];
+        };
+
+        // Helper: Normalize to objects for _original (UI expects {text, source, page_number})
+        const normalizeToObjects = (val) => {
+          if (!val) return [];
+          let arr = [];
+          if (Array.isArray(val)) arr = val;
+          else if (typeof val === 'string') arr = [val];
+
+          return arr.map(item => {
+            if (typeof item === 'string') return { text: item, source: '' };
+            if (typeof item === 'object') return {
+              text: item.text || '',
+              source: item.source_quote || item.source || '',
+              page_number: item.page_number || null,
+              rag_confidence: item.rag_confidence || null
+            };
+            return { text: '', source: '' };
+          });
+        };
+
+        // Извлечение текста из категоризированной структуры key_features
+        const extractCategorizedFeatures = (obj) => {
+          if (!obj || typeof obj !== 'object') return '';
+          if (Array.isArray(obj)) {
+            // Fallback для старой структуры (массив)
+            return extractTextArray(obj).join('\n');
+          }
+          // Новая структура с категориями
+          const allTexts = [];
+          Object.values(obj).forEach(categoryArr => {
+            if (Array.isArray(categoryArr)) {
+              categoryArr.forEach(item => {
+                allTexts.push(typeof item === 'object' ? (item.text || '') : item);
+              });
             }
-            if (typeof val === 'string') return [val]; // Handle single string as array
-            return [];
-          };
-
-          // Helper: Normalize to objects for _original (UI expects {text, source, page_number})
-          const normalizeToObjects = (val) => {
-            if (!val) return [];
-            let arr = [];
-            if (Array.isArray(val)) arr = val;
-            else if (typeof val === 'string') arr = [val];
-
-            return arr.map(item => {
-              if (typeof item === 'string') return { text: item, source: '' };
-              if (typeof item === 'object') return {
-                text: item.text || '',
-                source: item.source_quote || item.source || '',
-                page_number: item.page_number || null,
-                rag_confidence: item.rag_confidence || null
-              };
-              return { text: '', source: '' };
-            });
-          };
-
-          // Извлечение текста из категоризированной структуры key_features
-          const extractCategorizedFeatures = (obj) => {
-            if (!obj || typeof obj !== 'object') return '';
-            if (Array.isArray(obj)) {
-              // Fallback для старой структуры (массив)
-              return extractTextArray(obj).join('\n');
+          });
+          return allTexts.join('\n');
+        };
+
+        // Преобразуем категоризированную структуру в плоский массив для отображения
+        const flattenCategorizedFeatures = (obj) => {
+          if (!obj || typeof obj !== 'object') return [];
+          if (Array.isArray(obj)) return normalizeToObjects(obj); // Fallback for old structure
+          const allItems = [];
+          Object.entries(obj).forEach(([category, items]) => {
+            if (Array.isArray(items)) {
+              items.forEach(item => {
+                const normalized = typeof item === 'string' ? { text: item, source: '' } : (item || { text: '', source: '' });
+                allItems.push({ ...normalized, category });
+              });
             }
-            // Новая структура с категориями
-            const allTexts = [];
-            Object.values(obj).forEach(categoryArr => {
-              if (Array.isArray(categoryArr)) {
-                categoryArr.forEach(item => {
-                  allTexts.push(typeof item === 'object' ? (item.text || '') : item);
-                });
-              }
-            });
-            return allTexts.join('\n');
-          };
-
-          // Преобразуем категоризированную структуру в плоский массив для отображения
-          const flattenCategorizedFeatures = (obj) => {
-            if (!obj || typeof obj !== 'object') return [];
-            if (Array.isArray(obj)) return normalizeToObjects(obj); // Fallback for old structure
-            const allItems = [];
-            Object.entries(obj).forEach(([category, items]) => {
-              if (Array.isArray(items)) {
-                items.forEach(item => {
-                  const normalized = typeof item === 'string' ? { text: item, source: '' } : (item || { text: '', source: '' });
-                  allItems.push({ ...normalized, category });
-                });
-              }
-            });
-            return allItems;
-          };
-
-          const formattedData = {
+          });
+          return allItems;
+        };
+
+        const formattedData = {
+          ...raw,
+          client_name: safelyExtractText(raw.client_name),
+          project_essence: safelyExtractText(raw.project_essence),
+          project_type: safelyExtractText(raw.project_type),
+          business_goals: extractTextArray(raw.business_goals).join('\n'),
+          key_features: extractCategorizedFeatures(raw.key_features),
+          tech_stack: extractTextArray(raw.tech_stack).join('\n'),
+          client_integrations: extractTextArray(raw.client_integrations).join('\n'),
+          // Сохраняем оригинальные массивы для показа цитат
+          _original: {
             ...raw,
-            client_name: safelyExtractText(raw.client_name),
-            project_essence: safelyExtractText(raw.project_essence),
-            project_type: safelyExtractText(raw.project_type),
-            business_goals: extractTextArray(raw.business_goals).join('\n'),
-            key_features: extractCategorizedFeatures(raw.key_features),
-            tech_stack: extractTextArray(raw.tech_stack).join('\n'),
-            client_integrations: extractTextArray(raw.client_integrations).join('\n'),
-            // Сохраняем оригинальные массивы для показа цитат
-            _original: {
-              ...raw,
-              // Top-level fields with source
-              client_name: raw.client_name,
-              project_essence: raw.project_essence,
-              project_type: raw.project_type,
-
-              tech_stack: normalizeToObjects(raw.tech_stack),
-              business_goals: normalizeToObjects(raw.business_goals),
-              client_integrations: normalizeToObjects(raw.client_integrations),
-              key_features_flat: flattenCategorizedFeatures(raw.key_features)
-            }
-          };
-          setData(formattedData);
-
-          // Сохраняем новые данные
-          setRequirementIssues(raw.requirement_issues || []);
-          // sourceExcerpts больше не нужны, берем из _original
-          setRawText(state.raw_text_preview || '');
-          setSuggestedHours(state.suggested_hours || {});
-
-          // Используем этапы и роли, предложенные ИИ
-          const aiStages = state.suggested_stages || ["Сбор данных", "Прототип", "Разработка", "Тестирование"];
-          const aiRoles = state.suggested_roles || ["Менеджер", "Frontend", "Backend", "Дизайнер"];
-
-          setStages(aiStages);
-          // Инициализируем роли с дефолтными ставками
-          const defaultRates = {
-            "Менеджер проекта": 2500,
-            "Системный аналитик": 2800,
-            "Дизайнер UI/UX": 2800,
-            "Frontend-разработчик": 3000,
-            "Backend-разработчик": 3000,
-            "Fullstack-разработчик": 3200,
-            "ML-инженер": 3500,
-            "DevOps-инженер": 3200,
-            "QA-инженер": 2200,
-          };
-          const rolesWithRates = {};
+            // Top-level fields with source
+            client_name: raw.client_name,
+            project_essence: raw.project_essence,
+            project_type: raw.project_type,
+
+            tech_stack: normalizeToObjects(raw.tech_stack),
+            business_goals: normalizeToObjects(raw.business_goals),
+            client_integrations: normalizeToObjects(raw.client_integrations),
+            key_features_flat: flattenCategorizedFeatures(raw.key_features)
+          }
+        };
+        setData(formattedData);
+
+        // Сохраняем новые данные
+        setRequirementIssues(raw.requirement_issues || []);
+        // sourceExcerpts больше не нужны, берем из _original
+        setRawText(state.raw_text_preview || '');
+        setSuggestedHours(state.suggested_hours || {});
+
+        // Используем этапы и роли, предложенные ИИ
+        const aiStages = state.suggested_stages || ["Сбор данных", "Прототип", "Разработка", "Тестирование"];
+        const aiRoles = state.suggested_roles || ["Менеджер", "Frontend", "Backend", "Дизайнер"];
+
+        setStages(aiStages);
+        // Инициализируем роли с дефолтными ставками
+        const defaultRates = {
+          "Менеджер проекта": 2500,
+          "Системный аналитик": 2800,
+          "Дизайнер UI/UX": 2800,
+          "Frontend-разработчик": 3000,
+          "Backend-разработчик": 3000,
+          "Fullstack-разработчик": 3200,
+          "ML-инженер": 3500,
+          "DevOps-инженер": 3200,
+          "QA-инженер": 2200,
+        };
+        const rolesWithRates = {};
+        aiRoles.forEach(r => {
+          rolesWithRates[r] = defaultRates[r] || 2500; // дефолтная ставка если роль неизвестна
+        });
+        setRoles(rolesWithRates);
+
+        // Инициализируем матрицу подсказками от ИИ
+        const initialMatrix = {};
+        const suggestedMatrix = state.suggested_hours || {};
+        aiStages.forEach(s => {
+          initialMatrix[s] = {};
           aiRoles.forEach(r => {
-            rolesWithRates[r] = defaultRates[r] || 2500; // дефолтная ставка если роль неизвестна
-          });
-          setRoles(rolesWithRates);
-
-          // Инициализируем матрицу подсказками от ИИ
-          const initialMatrix = {};
-          const suggestedMatrix = state.suggested_hours || {};
-          aiStages.forEach(s => {
-            initialMatrix[s] = {};
-            aiRoles.forEach(r => {
-              initialMatrix[s][r] = suggestedMatrix[s]?.[r] || 0;
-            });
+            initialMatrix[s][r] = suggestedMatrix[s]?.[r] || 0;
           });
-          setBudgetMatrix(initialMatrix);
+        });
+        setBudgetMatrix(initialMatrix);
+
+        // Инициализируем userModified как false для всех ячеек
+        const initialModified = {};
+        aiStages.forEach(s => {
+          initialModified[s] = {};
+          aiRoles.forEach(r => initialModified[s][r] = false);
+        });
+        setUserModified(initialModified);
+      }
 
-          // Инициализируем userModified как false для всех ячеек
-          const initialModified = {};
-          aiStages.forEach(s => {
-            initialModified[s] = {};
-            aiRoles.forEach(r => initialModified[s][r] = false);
-          });
-          setUserModified(initialModified);
-        }
+      // Когда все готово
+      if (state.status === "COMPLETED") {
+        setFinalDoc(state.final_proposal);
+      }
+    };
 
-        // Когда все готово
-        if (state.status === "COMPLETED") {
-          setFinalDoc(state.final_proposal);
-          clearInterval(interval);
-        }
-      } catch (err) {
-        // При 404 (workflow не найден) останавливаем опрос
-        if (err.response?.status === 404) {
-          clearInterval(interval);
-        } else {
-          console.error("Ошибка опроса:", err);
+    const listen = async () => {
+      while (!controller.signal.aborted) {
+        try {
+          const finished = await streamEvents(`${API_URL}/events/${workflowId}`, {
+            signal: controller.signal,
+            onEvent: (name, payload) => {
+              if (name === 'state') applyState(payload);
+              else if (name === 'progress') setProgress({ ...payload, received_at: Date.now() });
+              // offset = сколько символов уже должно быть у клиента (0 = текст целиком, напр. при переподключении)
+              else if (name === 'proposal') setStreamingDoc(prev => prev.slice(0, payload.offset) + payload.text);
+              else if (name === 'error') console.error("Ошибка потока статуса:", payload.detail);
+            },
+          });
+          if (finished) return;
+        } catch (err) {
+          if (controller.signal.aborted) return;
+          // При 404 (workflow не найден) не переподключаемся
+          if (err.status === 404) return;
+          console.error("Ошибка потока статуса:", err);
         }
+        // Обрыв соединения: переподключаемся через 3 секунды
+        await new Promise(resolve => setTimeout(resolve, 3000));
       }
-    }, 2000); // Спрашиваем каждые 2 секунды
+    };
+    listen();
 
-    return () => clearInterval(interval);
-  }, [workflowId, status, data, isLocalEditing]); // Added isLocalEditing to restart polling when needed
+    return () => controller.abort();
+  }, [workflowId, isStreaming]); // Reconnects only when streaming starts/stops, not on every status change
 
   // --- 3. ЛОГИКА ТАБЛИЦЫ ---
   const handleHourChange = (stage, role, value) => {
@@ -700,6 +826,7 @@ export default function AgentKP() {
       });
       setCachedFinalDoc(null); // Clear cached doc since we're generating new
       setIsLocalEditing(false); // Re-enable polling for generation status
+      setStreamingDoc('');
       setStatus("GENERATING"); // Локально меняем статус, чтобы показать спиннер
     } catch (err) {
       if (err.response?.status === 409) {
@@ -844,6 +971,21 @@ export default function AgentKP() {
                     {file ? file.name : "Выбрать файл"}
                   </Button>
                 </label>
+                <input
+                  accept=".pdf,.docx,.txt"
+                  style={{ display: 'none' }}
+                  id="upload-appendices"
+                  type="file"
+                  multiple
+                  onChange={(e) => setAppendices(Array.from(e.target.files))}
+                />
+                <label htmlFor="upload-appendices">
+                  <Button variant="text" component="span" size="small" disabled={!file}>
+                    {appendices.length
+                      ? `Приложения: ${appendices.length} (${appendices.map(f => f.name).join(', ')})`
+                      : "Добавить приложения (необязательно)"}
+                  </Button>
+                </label>
               </Box>
 
               {/* Дополнительные пожелания */}
@@ -957,7 +1099,7 @@ export default function AgentKP() {
                             >
                               Просмотр
                             </Button>
-                          ) : f.status === 'PROCESSING' || f.status === 'GENERATING' ? (
+                          ) : f.status === 'QUEUED' || f.status === 'PROCESSING' || f.status === 'GENERATING' ? (
                             <Button
                               size="small"
                               variant="contained"
@@ -983,21 +1125,61 @@ export default function AgentKP() {
                 </Table>
               </TableContainer>
             )}
+
+            {!historyLoading && historyCursor && (
+              <Box sx={{ display: 'flex', justifyContent: 'center', mt: 2 }}>
+                <Button size="small" onClick={loadMoreHistory} disabled={historyLoadingMore}>
+                  {historyLoadingMore ? 'Загрузка...' : 'Показать ещё'}
+                </Button>
+              </Box>
+            )}
           </Box>
         )}
 
         {/* БЛОК 2: ЗАГРУЗКА / ОЖИДАНИЕ */}
-        {(status === "PROCESSING" || status === "GENERATING") && (
+        {(status === "QUEUED" || status === "PROCESSING" || status === "GENERATING") && (
           <Paper elevation={0} sx={{ p: 10, textAlign: 'center', borderRadius: 4 }}>
             <CircularProgress size={64} thickness={4} sx={{ color: 'primary.main', mb: 4 }} />
             <Typography variant="h5" color="text.primary" fontWeight={500}>
-              {status === "PROCESSING"
+              {status === "QUEUED"
+                ? "Документ в очереди на обработку"
+                : status === "PROCESSING"
                 ? "ИИ анализирует документ..."
                 : "Генерация финального документа..."}
             </Typography>
-            <Typography variant="body2" color="text.secondary" sx={{ mt: 1 }}>
-              Это может занять несколько минут
-            </Typography>
+            {status === "QUEUED" ? (
+              <Typography variant="body2" color="text.secondary" sx={{ mt: 1 }}>
+                {queuedUntil
+                  ? `Сервер загружен. Ориентировочное начало обработки: ${formatDate(queuedUntil)}`
+                  : "Сервер загружен, обработка начнётся, как только освободится место"}
+              </Typography>
+            ) : status === "PROCESSING" && progress?.chunks_total > 0 ? (
+              <Box sx={{ mt: 3, mx: 'auto', maxWidth: 420 }}>
+                <LinearProgress
+                  variant="determinate"
+                  value={Math.min(100, (progress.chunks_done / progress.chunks_total) * 100)}
+                  sx={{ height: 8, borderRadius: 4 }}
+                />
+                <Typography variant="body2" color="text.secondary" sx={{ mt: 1 }}>
+                  {progress.stage === "extraction"
+                    ? `Обработано фрагментов: ${progress.chunks_done} из ${progress.chunks_total}`
+                    : "Все фрагменты обработаны, идёт анализ и оценка"}
+                  {progress.eta_seconds != null &&
+                    ` · осталось ~${formatEta(Math.max(0, progress.eta_seconds - Math.max(0, clock - progress.received_at) / 1000))}`}
+                </Typography>
+              </Box>
+            ) : status === "GENERATING" && streamingDoc ? (
+              <Paper
+                variant="outlined"
+                sx={{ mt: 4, p: 3, textAlign: 'left', maxHeight: '60vh', overflowY: 'auto', borderRadius: 2 }}
+              >
+                <ReactMarkdown remarkPlugins={[remarkGfm]}>{streamingDoc}</ReactMarkdown>
+              </Paper>
+            ) : (
+              <Typography variant="body2" color="text.secondary" sx={{ mt: 1 }}>
+                Это может занять несколько минут
+              </Typography>
+            )}
           </Paper>
         )}
 
@@ -0,0 +1,44 @@
+// src/sse.js
+// Чтение Server-Sent Events через fetch: EventSource не умеет передавать Bearer-токен.
+import keycloak from './keycloak';
+
+// Вызывает onEvent(name, data) для каждого события потока.
+// Возвращает true, если сервер прислал "end" (поток завершён штатно, переподключаться не нужно).
+export async function streamEvents(url, { onEvent, signal }) {
+  await keycloak.updateToken(30);
+  const res = await fetch(url, {
+    headers: { Authorization: `Bearer ${keycloak.token}`, Accept: 'text/event-stream' },
+    signal,
+  });
+  if (!res.ok) {
+    const err = new Error(`SSE ${res.status}`);
+    err.status = res.status;
+    throw err;
+  }
+
+  const reader = res.body.pipeThrough(new TextDecoderStream()).getReader();
+  let buffer = '';
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) return false;
+    buffer += value;
+
+    let sep;
+    while ((sep = buffer.indexOf('\n\n')) !== -1) {
+      const block = buffer.slice(0, sep);
+      buffer = buffer.slice(sep + 2);
+
+      let name = 'message';
+      const dataLines = [];
+      block.split('\n').forEach(line => {
+        if (line.startsWith('event:')) name = line.slice(6).trim();
+        else if (line.startsWith('data:')) dataLines.push(line.slice(5).trimStart());
+      });
+      if (!dataLines.length) continue; // keepalive-комментарий
+      if (name === 'end') return true;
+      onEvent(name, JSON.parse(dataLines.join('\n')));
+    }
+  }
+}
+
+export default streamEvents;
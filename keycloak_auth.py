@@ -4,6 +4,8 @@ Keycloak JWT token validation for FastAPI.
 Validates access tokens issued by the corporate Keycloak server.
 """
 
+import asyncio
+import hashlib
 import os
 import time
 import logging
@@ -14,6 +16,8 @@ from jose import jwt, JWTError, jwk
 from jose.utils import base64url_decode
 from fastapi import Request, HTTPException
 
+from utils_cache import LRUCache
+
 logger = logging.getLogger("kp-api")
 
 # --- Configuration ---
@@ -29,38 +33,89 @@ ISSUER = f"{KEYCLOAK_URL}/realms/{KEYCLOAK_REALM}"
 _jwks_cache: Optional[dict] = None
 _jwks_cache_time: float = 0
 JWKS_CACHE_TTL = 3600  # Refresh keys every 60 minutes
+JWKS_FETCH_TIMEOUT = 5
+# Unknown kid forces a refresh, at most this often (garbage tokens must not hammer Keycloak)
+JWKS_MIN_REFRESH_INTERVAL = 30
 
+_http_client: Optional[httpx.AsyncClient] = None
+_jwks_refresh_task: Optional[asyncio.Task] = None  # Single-flight: concurrent requests share one fetch
+_jwks_last_attempt: float = 0
 
-def _fetch_jwks() -> dict:
-    """Fetch JSON Web Key Set from Keycloak."""
-    global _jwks_cache, _jwks_cache_time
+# --- Verified token cache: sha256(token) -> claims, valid until the token's exp ---
+VERIFIED_TOKEN_CACHE_SIZE = int(os.getenv("VERIFIED_TOKEN_CACHE_SIZE", 4096))
+_verified_tokens = LRUCache(max_items=VERIFIED_TOKEN_CACHE_SIZE)
 
-    now = time.time()
-    if _jwks_cache and (now - _jwks_cache_time) < JWKS_CACHE_TTL:
-        return _jwks_cache
+
+def _get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=JWKS_FETCH_TIMEOUT)
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+async def _fetch_jwks() -> Optional[dict]:
+    """Fetch JSON Web Key Set from Keycloak. Keeps the previous keys on failure."""
+    global _jwks_cache, _jwks_cache_time
 
     try:
-        response = httpx.get(JWKS_URL, timeout=10)
+        response = await _get_http_client().get(JWKS_URL)
         response.raise_for_status()
         _jwks_cache = response.json()
-        _jwks_cache_time = now
+        _jwks_cache_time = time.time()
         logger.info(f"Fetched JWKS keys from Keycloak ({len(_jwks_cache.get('keys', []))} keys)")
-        return _jwks_cache
     except Exception as e:
         logger.error(f"Failed to fetch JWKS from {JWKS_URL}: {e}")
-        # If we have cached keys, use them even if expired
         if _jwks_cache:
             logger.warning("Using expired JWKS cache as fallback")
-            return _jwks_cache
+    return _jwks_cache
+
+
+def _refresh_jwks() -> asyncio.Task:
+    """Starts a JWKS fetch unless one is already running; returns the running fetch."""
+    global _jwks_refresh_task, _jwks_last_attempt
+    if _jwks_refresh_task is None or _jwks_refresh_task.done():
+        _jwks_last_attempt = time.time()
+        _jwks_refresh_task = asyncio.create_task(_fetch_jwks())
+    return _jwks_refresh_task
+
+
+async def _get_jwks(force_refresh: bool = False) -> dict:
+    now = time.time()
+    if _jwks_cache and not force_refresh:
+        if now - _jwks_cache_time >= JWKS_CACHE_TTL and now - _jwks_last_attempt >= JWKS_MIN_REFRESH_INTERVAL:
+            _refresh_jwks()  # Stale: refresh in the background, keep serving current keys
+        return _jwks_cache
+
+    if _jwks_cache and now - _jwks_last_attempt < JWKS_MIN_REFRESH_INTERVAL:
+        return _jwks_cache  # Refreshed moments ago; the kid is simply unknown
+
+    # No keys yet, or key rotation: wait for the (shared) fetch
+    jwks = await asyncio.shield(_refresh_jwks())
+    if not jwks:
         raise HTTPException(
             status_code=503,
             detail="Authentication service unavailable"
         )
+    return jwks
+
 
+def _find_key(jwks: dict, kid: str) -> Optional[dict]:
+    for key in jwks.get("keys", []):
+        if key.get("kid") == kid:
+            return key
+    return None
 
-def _get_signing_key(token: str) -> dict:
+
+async def _get_signing_key(token: str) -> dict:
     """Extract the correct signing key for the given token from JWKS."""
-    jwks = _fetch_jwks()
+    jwks = await _get_jwks()
     
     # Decode token header to get key ID (kid)
     try:
@@ -73,26 +128,20 @@ def _get_signing_key(token: str) -> dict:
         raise HTTPException(status_code=401, detail="Token missing key ID (kid)")
 
     # Find matching key
-    for key in jwks.get("keys", []):
-        if key.get("kid") == kid:
-            return key
+    key = _find_key(jwks, kid)
+    if key:
+        return key
 
     # Key not found — maybe keys rotated, force refresh
-    global _jwks_cache_time
-    _jwks_cache_time = 0
-    jwks = _fetch_jwks()
-
-    for key in jwks.get("keys", []):
-        if key.get("kid") == kid:
-            return key
+    key = _find_key(await _get_jwks(force_refresh=True), kid)
+    if key:
+        return key
 
     raise HTTPException(status_code=401, detail="Token signing key not found in JWKS")
 
 
-def decode_token(token: str) -> dict:
-    """Decode and validate a Keycloak JWT access token."""
-    signing_key = _get_signing_key(token)
-
+def _verify_token(token: str, signing_key: dict) -> dict:
+    """Validate signature and claims of a Keycloak JWT access token."""
     try:
         payload = jwt.decode(
             token,
@@ -113,6 +162,24 @@ def decode_token(token: str) -> dict:
         raise HTTPException(status_code=401, detail=f"Invalid token: {e}")
 
 
+async def decode_token(token: str) -> dict:
+    """Decode and validate a Keycloak JWT access token (verified claims are cached until exp)."""
+    token_hash = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    cached = _verified_tokens.get(token_hash)
+    if cached is not None:
+        payload, expires_at = cached
+        if time.time() < expires_at:
+            return payload
+        _verified_tokens.pop(token_hash)
+        raise HTTPException(status_code=401, detail="Token expired")
+
+    signing_key = await _get_signing_key(token)
+    payload = _verify_token(token, signing_key)
+    if isinstance(payload.get("exp"), (int, float)):
+        _verified_tokens.put(token_hash, (payload, payload["exp"]))
+    return payload
+
+
 async def verify_keycloak_token(request: Request) -> str:
     """
     FastAPI dependency: validates Keycloak JWT from Authorization header.
@@ -126,7 +193,7 @@ async def verify_keycloak_token(request: Request) -> str:
         )
 
     token = auth_header.split(" ", 1)[1]
-    payload = decode_token(token)
+    payload = await decode_token(token)
 
     # Extract username from token claims
     username = payload.get("preferred_username")
@@ -0,0 +1,141 @@
+"""
+Persistent content-addressed cache of LLM completions (used by LLMService).
+
+Key: sha256 of (model, messages, output schema, temperature), so a re-uploaded document,
+a Temporal retry of an activity after a worker restart or the same manager notes cost a
+lookup instead of a generation. Only tools listed in LLM_CACHE_TOOLS are cached.
+
+Storage is one SQLite file on the shared volume (all worker processes use it):
+entries expire after LLM_CACHE_TTL_DAYS, and the least recently used ones are evicted
+once the stored values exceed LLM_CACHE_MAX_MB. Cache failures never fail the LLM call.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from metrics import LLM_CACHE_EVICTIONS, LLM_CACHE_REQUESTS
+
+logger = logging.getLogger("llm_service")
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "/shared_data/llm_cache/completions.db")
+LLM_CACHE_MAX_MB = int(os.getenv("LLM_CACHE_MAX_MB", 512))
+LLM_CACHE_TTL_DAYS = int(os.getenv("LLM_CACHE_TTL_DAYS", 30))
+# Opt-in per tool_name. Not the proposal: regenerating it is expected to give a new text
+LLM_CACHE_TOOLS = {
+    t.strip() for t in os.getenv(
+        "LLM_CACHE_TOOLS",
+        "extract_tz_chunk,analyze_requirements,classify_manager_notes,submit_analysis_v2,submit_budget"
+    ).split(",") if t.strip()
+}
+# Eviction brings the cache down to this share of LLM_CACHE_MAX_MB (not after every put)
+_EVICT_TARGET = 0.9
+_EVICT_BATCH = 100
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS completions (
+    key TEXT PRIMARY KEY,
+    tool_name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_completions_accessed_at ON completions (accessed_at);
+"""
+
+_local = threading.local()
+
+
+def is_cacheable(tool_name: str) -> bool:
+    return LLM_CACHE_ENABLED and tool_name in LLM_CACHE_TOOLS
+
+
+def make_key(model: str, messages: List[Dict[str, Any]], schema: Optional[dict], temperature: float) -> str:
+    payload = json.dumps([model, messages, schema, temperature], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _connect() -> sqlite3.Connection:
+    """One connection per thread (sqlite3 connections are not shared across threads)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(LLM_CACHE_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(LLM_CACHE_PATH, timeout=30, isolation_level=None)
+        # WAL: readers in other worker processes are not blocked by a writer
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        _local.conn = conn
+    return conn
+
+
+def _get_sync(key: str) -> Optional[str]:
+    conn = _connect()
+    row = conn.execute("SELECT value, created_at FROM completions WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+    value, created_at = row
+    now = time.time()
+    if now - created_at > LLM_CACHE_TTL_DAYS * 86400:
+        conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+        return None
+    conn.execute("UPDATE completions SET accessed_at = ? WHERE key = ?", (now, key))
+    return value
+
+
+def _evict_sync(conn: sqlite3.Connection):
+    max_bytes = LLM_CACHE_MAX_MB * 1024 * 1024
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+    if total <= max_bytes:
+        return
+    # Expired entries first, then the least recently used ones
+    evicted = conn.execute(
+        "DELETE FROM completions WHERE created_at < ?", (time.time() - LLM_CACHE_TTL_DAYS * 86400,)
+    ).rowcount
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+    while total > max_bytes * _EVICT_TARGET:
+        rows = conn.execute(
+            "SELECT key, size FROM completions ORDER BY accessed_at LIMIT ?", (_EVICT_BATCH,)
+        ).fetchall()
+        if not rows:
+            break
+        conn.executemany("DELETE FROM completions WHERE key = ?", [(k,) for k, _ in rows])
+        evicted += len(rows)
+        total -= sum(size for _, size in rows)
+    LLM_CACHE_EVICTIONS.inc(evicted)
+    logger.info(f"LLM cache: evicted {evicted} entries, {total // (1024 * 1024)} MB left")
+
+
+def _put_sync(key: str, tool_name: str, value: str):
+    conn = _connect()
+    now = time.time()
+    conn.execute(
+        "INSERT OR REPLACE INTO completions (key, tool_name, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (key, tool_name, value, len(value.encode("utf-8")), now, now)
+    )
+    _evict_sync(conn)
+
+
+async def get(key: str, tool_name: str) -> Optional[str]:
+    """Cached completion text or None (miss, expired, or cache unavailable)."""
+    try:
+        value = await asyncio.to_thread(_get_sync, key)
+    except Exception as e:
+        logger.warning(f"LLM cache read failed: {e}")
+        value = None
+    LLM_CACHE_REQUESTS.labels(tool_name, "hit" if value is not None else "miss").inc()
+    return value
+
+
+async def put(key: str, tool_name: str, value: str):
+    try:
+        await asyncio.to_thread(_put_sync, key, tool_name, value)
+    except Exception as e:
+        logger.warning(f"LLM cache write failed: {e}")
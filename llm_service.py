@@ -3,11 +3,28 @@ import json
 import logging
 import asyncio
 import re
-from typing import Type, TypeVar, List, Dict, Any, Optional
+import functools
+from types import SimpleNamespace
+from typing import Type, TypeVar, List, Dict, Any, Optional, AsyncIterator, Tuple
+import httpx
 from dotenv import load_dotenv
-from openai import OpenAI, RateLimitError, APITimeoutError, APIError
+from openai import AsyncOpenAI, RateLimitError, APITimeoutError, APIError
 from pydantic import BaseModel, ValidationError
 
+import llm_cache
+from utils_json import parse_llm_json, LOSSLESS_REPAIRS
+from metrics import (
+    LLM_CALL_DURATION,
+    LLM_CONTEXT_LIMIT_ERRORS,
+    LLM_JSON_REPAIRS,
+    LLM_REQUEST_DURATION,
+    LLM_REQUESTS_IN_FLIGHT,
+    LLM_RETRIES,
+    LLM_TIME_TO_FIRST_TOKEN,
+    LLM_VALIDATION_FAILURES,
+    observe_llm_usage,
+)
+
 load_dotenv()
 
 # Setup Structured Logging
@@ -21,6 +38,29 @@ logger.setLevel(logging.DEBUG)
 
 T = TypeVar("T", bound=BaseModel)
 
+# --- HTTP connection pool to the LLM server (one per worker process) ---
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 32))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", 16))
+# Idle keep-alive connections are closed after this many seconds
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", 60))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 10))
+# LLM requests in flight per process; the rest wait here (never in the pool, never in a thread)
+LLM_MAX_CONCURRENCY = min(int(os.getenv("LLM_MAX_CONCURRENCY", LLM_MAX_CONNECTIONS)), LLM_MAX_CONNECTIONS)
+
+# Structured output: "off" - schema inlined in the prompt + json_object mode (works everywhere);
+# "json_schema" - response_format json_schema; "guided_json" - vLLM guided_json extra param.
+# Guided modes constrain decoding to the schema on the server, the prompt carries no schema text.
+LLM_GUIDED_JSON = os.getenv("LLM_GUIDED_JSON", "off")
+# Completion tokens reserved for structured responses (also reserved in the chunk budget, token_budget.py)
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", 8192))
+
+
+@functools.lru_cache(maxsize=None)
+def output_schema(output_model: Type[BaseModel]) -> Tuple[dict, str]:
+    """JSON schema of an output model, computed once per model: (dict, compact JSON text)."""
+    schema = output_model.model_json_schema()
+    return schema, json.dumps(schema, ensure_ascii=False, separators=(",", ":"))
+
 class LLMProcessingError(Exception):
     def __init__(self, message: str, code: str):
         self.message = message
@@ -30,6 +70,8 @@ class LLMProcessingError(Exception):
 class LLMService:
     _instance = None
     _client = None
+    _semaphore = None
+    _guided_unsupported = False
 
     def __new__(cls):
         if cls._instance is None:
@@ -46,12 +88,73 @@ class LLMService:
         if not base_url or not api_key:
             logger.warning("Missing QWEN_BASE_URL or QWEN_API_KEY. LLM calls will fail.")
         
-        self._client = OpenAI(
+        self._client = AsyncOpenAI(
             base_url=base_url,
             api_key=api_key,
-            max_retries=0 # We handle retries manually
+            max_retries=0, # We handle retries manually
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=LLM_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=LLM_KEEPALIVE_EXPIRY
+                ),
+                timeout=httpx.Timeout(1200, connect=LLM_CONNECT_TIMEOUT)
+            )
         )
-        logger.info(f"LLMService initialized with model: {self.model_name}")
+        self._semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+        logger.info(f"LLMService initialized with model: {self.model_name}, max concurrency {LLM_MAX_CONCURRENCY}")
+
+    async def close(self):
+        """Closes pooled connections (worker shutdown)."""
+        await self._client.close()
+
+    async def _create(self, timeout: float, **kwargs):
+        """One chat.completions request, bounded by LLM_MAX_CONCURRENCY."""
+        async with self._semaphore:
+            LLM_REQUESTS_IN_FLIGHT.inc()
+            try:
+                return await self._client.chat.completions.create(
+                    model=self.model_name,
+                    timeout=httpx.Timeout(timeout, connect=LLM_CONNECT_TIMEOUT),
+                    **kwargs
+                )
+            finally:
+                LLM_REQUESTS_IN_FLIGHT.dec()
+
+    def _guided_mode(self) -> str:
+        return "off" if self._guided_unsupported else LLM_GUIDED_JSON
+
+    @staticmethod
+    def _with_schema_instruction(messages: List[Dict[str, Any]], schema_json: Optional[str]) -> List[Dict[str, Any]]:
+        """Copy of messages with the JSON output instruction; the schema text only without guided decoding."""
+        current_messages = [m.copy() for m in messages]
+        if schema_json is not None:
+            schema_instruction = (
+                f"\n\nIMPORTANT: Output MUST be a valid JSON object strictly matching this schema:\n"
+                f"```json\n{schema_json}\n```\n"
+                "Do NOT output markdown blocks (like ```json ... ```) nicely, just raw JSON is preferred but markdown is acceptable if valid.\n"
+                "Do NOT write any explanations."
+            )
+        else:
+            schema_instruction = "\n\nIMPORTANT: Output only the JSON object, no explanations."
+
+        if current_messages and current_messages[0]['role'] == 'system':
+            current_messages[0]['content'] += schema_instruction
+        else:
+            current_messages.insert(0, {"role": "system", "content": schema_instruction})
+        return current_messages
+
+    @staticmethod
+    def _structured_output_params(guided: str, tool_name: str, schema: dict) -> Dict[str, Any]:
+        if guided == "json_schema":
+            return {"response_format": {
+                "type": "json_schema",
+                "json_schema": {"name": tool_name, "schema": schema, "strict": True}
+            }}
+        if guided == "guided_json":
+            # vLLM allows only one kind of guided decoding per request: no response_format here
+            return {"extra_body": {"guided_json": schema}}
+        return {"response_format": {"type": "json_object"}}
 
     def _clean_json_string(self, content: str) -> str:
         """Cleans Markdown code blocks and common formatting issues from JSON string."""
@@ -76,51 +179,84 @@ class LLMService:
         Validates result against the provided Pydantic model.
         Handles retries for transient errors.
         Raises LLMProcessingError for specific failures.
+        Results of tools in LLM_CACHE_TOOLS are served from / stored in llm_cache.
         """
-        # Prepare Schema for Prompting
-        schema_json = json.dumps(output_model.model_json_schema(), ensure_ascii=False, indent=2)
-        
-        # Inject Schema
-        current_messages = [m.copy() for m in messages]
-        schema_instruction = (
-            f"\n\nIMPORTANT: Output MUST be a valid JSON object strictly matching this schema:\n"
-            f"```json\n{schema_json}\n```\n"
-            "Do NOT output markdown blocks (like ```json ... ```) nicely, just raw JSON is preferred but markdown is acceptable if valid.\n"
-            "Do NOT write any explanations."
-        )
+        start_time = asyncio.get_running_loop().time()
+        outcome = "error"
+        try:
+            cache_key = None
+            if llm_cache.is_cacheable(tool_name):
+                cache_key = llm_cache.make_key(self.model_name, messages, output_schema(output_model)[0], temperature)
+                cached = await llm_cache.get(cache_key, tool_name)
+                if cached is not None:
+                    try:
+                        result = output_model.model_validate_json(cached)
+                        outcome = "cached"
+                        return result
+                    except ValidationError as e:
+                        # Written by an older version of the schema
+                        logger.warning(f"Ignoring stale cache entry for '{tool_name}': {e}")
 
-        if current_messages and current_messages[0]['role'] == 'system':
-            current_messages[0]['content'] += schema_instruction
-        else:
-            current_messages.insert(0, {"role": "system", "content": schema_instruction})
+            result, complete = await self._structured_completion(
+                messages, output_model, tool_name, temperature, max_retries, timeout
+            )
+            outcome = "ok"
+            if cache_key and complete:
+                await llm_cache.put(cache_key, tool_name, result.model_dump_json())
+            return result
+        except LLMProcessingError as e:
+            outcome = e.code.lower()
+            raise
+        finally:
+            LLM_CALL_DURATION.labels(tool_name, outcome).observe(asyncio.get_running_loop().time() - start_time)
+
+    async def _structured_completion(
+        self,
+        messages: List[Dict[str, Any]],
+        output_model: Type[T],
+        tool_name: str,
+        temperature: float,
+        max_retries: int,
+        timeout: int
+    ) -> Tuple[T, bool]:
+        """
+        (result, complete). complete is False if the answer was cut off by max_tokens or only
+        parsed after a structural repair: such a result may lack data and is not cached.
+        A repair that would drop text is not used (the model is asked again) unless the
+        answer was cut off anyway.
+        """
+        schema, schema_json = output_schema(output_model)
+        guided = self._guided_mode()
+        current_messages = self._with_schema_instruction(messages, None if guided != "off" else schema_json)
 
         last_exception = None
 
         for attempt in range(max_retries):
             try:
-                logger.info(f"Requesting '{tool_name}' [Attempt {attempt+1}/{max_retries}] (JSON Mode)")
+                logger.info(f"Requesting '{tool_name}' [Attempt {attempt+1}/{max_retries}] (JSON Mode, guided={guided})")
                 
                 # Debug: Log input messages (truncated)
                 debug_msgs = json.dumps(current_messages, ensure_ascii=False, default=str)
                 logger.debug(f"LLM Input Messages len: {len(debug_msgs)}")
 
-                start_time = asyncio.get_event_loop().time()
+                start_time = asyncio.get_running_loop().time()
                 
-                response = await asyncio.to_thread(
-                    self._client.chat.completions.create,
-                    model=self.model_name,
+                response = await self._create(
+                    timeout,
                     messages=current_messages,
-                    # Removing tools/tool_choice to avoid "tools param requires --jinja flag" error
-                    response_format={"type": "json_object"},
                     temperature=temperature,
-                    max_tokens=8192, # Increased for larger JSONs
-                    timeout=timeout
+                    max_tokens=LLM_MAX_TOKENS, # Increased for larger JSONs
+                    # Removing tools/tool_choice to avoid "tools param requires --jinja flag" error
+                    **self._structured_output_params(guided, tool_name, schema)
                 )
                 
-                elapsed = asyncio.get_event_loop().time() - start_time
+                elapsed = asyncio.get_running_loop().time() - start_time
                 logger.info(f"LLM Response received in {elapsed:.2f}s")
+                LLM_REQUEST_DURATION.labels(tool_name).observe(elapsed)
+                observe_llm_usage(tool_name, response.usage, elapsed)
 
                 raw_content = response.choices[0].message.content
+                truncated = response.choices[0].finish_reason == "length"
                 if not raw_content:
                     logger.warning("Empty response from LLM.")
                     raise ValueError("LLM returned empty response")
@@ -128,26 +264,27 @@ class LLMService:
                 # Robust parsing
                 cleaned_json = self._clean_json_string(raw_content)
                 
+                # Local repair first: a retry re-sends the whole prompt (a whole document chunk)
                 try:
-                    data = json.loads(cleaned_json)
+                    data, repair = parse_llm_json(cleaned_json, allow_lossy=truncated)
                 except json.JSONDecodeError:
-                    # Attempt simple fix
-                    try:
-                        data = json.loads(cleaned_json, strict=False)
-                    except json.JSONDecodeError:
-                         # Last resort: regex
-                        match = re.search(r'\{.*\}', cleaned_json, re.DOTALL)
-                        if match:
-                             data = json.loads(match.group(0))
-                        else:
-                             raise
+                    LLM_JSON_REPAIRS.labels(tool_name, "failed").inc()
+                    raise
+                if truncated:
+                    logger.warning(f"Response of '{tool_name}' was cut off at max_tokens ({repair or 'parsed as is'})")
+                    LLM_JSON_REPAIRS.labels(tool_name, "truncated").inc()
+                elif repair:
+                    logger.info(f"Repaired malformed JSON from '{tool_name}' locally ({repair})")
+                    LLM_JSON_REPAIRS.labels(tool_name, repair).inc()
 
                 # Pydantic Validation
                 validated_obj = output_model.model_validate(data)
-                return validated_obj
+                return validated_obj, not truncated and repair in LOSSLESS_REPAIRS
 
             except (RateLimitError, APITimeoutError) as e:
                 logger.warning(f"Transient LLM Error: {e}. Retrying in {2**attempt}s...")
+                if attempt < max_retries - 1:
+                    LLM_RETRIES.labels(tool_name, "transient").inc()
                 await asyncio.sleep(2**attempt)
                 last_exception = e
                 
@@ -155,20 +292,33 @@ class LLMService:
                 # 400 Bad Request usually means Context Window Exceeded
                 if e.code == 'context_length_exceeded' or (e.message and 'context' in e.message.lower()):
                      logger.error("Context Window Limit Exceeded.")
+                     LLM_CONTEXT_LIMIT_ERRORS.labels(tool_name).inc()
                      raise LLMProcessingError("Document too large for model context.", "CONTEXT_LIMIT")
+
+                # Server without guided decoding: switch this process to the prompt-inlined schema
+                if guided != "off" and getattr(e, "status_code", None) == 400:
+                    logger.warning(f"Guided JSON ({guided}) rejected by the server, falling back to inlined schema: {e}")
+                    LLMService._guided_unsupported = True
+                    guided = "off"
+                    current_messages = self._with_schema_instruction(messages, schema_json)
+                    last_exception = e
+                    continue
                 
                 # 500 or others could be OOM on server side
                 logger.error(f"API Error: {e}")
                 if attempt < max_retries - 1:
+                    LLM_RETRIES.labels(tool_name, "api_error").inc()
                     await asyncio.sleep(2)
                 last_exception = e
 
             except (ValidationError, json.JSONDecodeError) as e:
                 logger.error(f"Validation/Parsing Error: {e}.")
+                LLM_VALIDATION_FAILURES.labels(tool_name).inc()
                 
                 # Self-correction: Feed error back to the model
                 # NOTE: Do NOT append the full response to avoid exponential context growth
                 if attempt < max_retries - 1:
+                    LLM_RETRIES.labels(tool_name, "validation").inc()
                     logger.info("Feeding error back to model for self-correction...")
                     error_feedback = str(e)[:500]
                     # Instead of appending response + error, just add a simple retry prompt
@@ -183,6 +333,7 @@ class LLMService:
                 logger.error(f"Unexpected LLM Error: {e}")
                 last_exception = e
                 if attempt < max_retries - 1:
+                     LLM_RETRIES.labels(tool_name, "unexpected").inc()
                      await asyncio.sleep(1)
 
         # After retries exhausted, check if we have a specific error to raise
@@ -191,6 +342,7 @@ class LLMService:
             
         error_msg = str(last_exception)
         if "context" in error_msg.lower():
+             LLM_CONTEXT_LIMIT_ERRORS.labels(tool_name).inc()
              raise LLMProcessingError("Context Window Exceeded", "CONTEXT_LIMIT")
         
         raise LLMProcessingError(f"Processing Failed: {error_msg}", "UNKNOWN_ERROR")
@@ -203,20 +355,78 @@ class LLMService:
     ) -> str:
         """
         Standard chat completion with plain text response.
+        Cached like structured completions if "chat" is listed in LLM_CACHE_TOOLS.
         """
+        cache_key = None
+        if llm_cache.is_cacheable("chat"):
+            cache_key = llm_cache.make_key(self.model_name, messages, None, temperature)
+            cached = await llm_cache.get(cache_key, "chat")
+            if cached is not None:
+                return cached
+
         for attempt in range(max_retries):
             try:
-                response = await asyncio.to_thread(
-                    self._client.chat.completions.create,
-                    model=self.model_name,
-                    messages=messages,
-                    temperature=temperature,
-                    timeout=60
-                )
-                return response.choices[0].message.content
+                start_time = asyncio.get_running_loop().time()
+                response = await self._create(60, messages=messages, temperature=temperature)
+                elapsed = asyncio.get_running_loop().time() - start_time
+                LLM_REQUEST_DURATION.labels("chat").observe(elapsed)
+                observe_llm_usage("chat", response.usage, elapsed)
+                content = response.choices[0].message.content
+                if cache_key and content:
+                    await llm_cache.put(cache_key, "chat", content)
+                return content
             except Exception as e:
                 logger.error(f"Chat Completion Error: {e}")
                 if attempt < max_retries - 1:
+                    LLM_RETRIES.labels("chat", "error").inc()
                     await asyncio.sleep(2**attempt)
                 else:
                     raise e
+
+    async def stream_chat_completion(
+        self,
+        messages: List[Dict[str, Any]],
+        tool_name: str = "chat_stream",
+        temperature: float = 0.7,
+        timeout: int = 600
+    ) -> AsyncIterator[str]:
+        """
+        Plain text completion with stream=True: yields text deltas as the model produces them.
+        No retries - tokens already handed to the caller cannot be taken back; the caller decides.
+        """
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        usage = None
+        deltas = 0
+        async with self._semaphore:
+            LLM_REQUESTS_IN_FLIGHT.inc()
+            try:
+                stream = await self._client.chat.completions.create(
+                    model=self.model_name,
+                    messages=messages,
+                    temperature=temperature,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    timeout=httpx.Timeout(timeout, connect=LLM_CONNECT_TIMEOUT)
+                )
+                async with stream:
+                    async for chunk in stream:
+                        usage = chunk.usage or usage
+                        text = chunk.choices[0].delta.content if chunk.choices else None
+                        if text:
+                            if not deltas:
+                                LLM_TIME_TO_FIRST_TOKEN.labels(tool_name).observe(loop.time() - start_time)
+                            deltas += 1
+                            yield text
+            except APIError as e:
+                logger.error(f"Streaming Completion Error: {e}")
+                if e.code == 'context_length_exceeded' or (e.message and 'context' in e.message.lower()):
+                    LLM_CONTEXT_LIMIT_ERRORS.labels(tool_name).inc()
+                    raise LLMProcessingError("Context Window Exceeded", "CONTEXT_LIMIT")
+                raise
+            finally:
+                LLM_REQUESTS_IN_FLIGHT.dec()
+                elapsed = loop.time() - start_time
+                LLM_REQUEST_DURATION.labels(tool_name).observe(elapsed)
+                # Servers without include_usage support: one delta is roughly one token
+                observe_llm_usage(tool_name, usage or SimpleNamespace(prompt_tokens=0, completion_tokens=deltas), elapsed)
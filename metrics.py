@@ -0,0 +1,185 @@
+"""
+Prometheus metrics of the worker process (activities, LLM calls, embeddings).
+
+The API exports HTTP metrics through Instrumentator; the worker has no web app, so
+start_metrics_server() exposes the default registry on WORKER_METRICS_PORT.
+Without prometheus_client every metric is a no-op and the pipeline runs as before.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Any
+
+from temporalio import activity
+from temporalio.worker import ActivityInboundInterceptor, ExecuteActivityInput, Interceptor
+
+try:
+    from prometheus_client import Counter, Gauge, Histogram, start_http_server
+    HAS_PROMETHEUS = True
+except ImportError:
+    HAS_PROMETHEUS = False
+
+logger = logging.getLogger("metrics")
+
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 9464))
+
+# Activities range from milliseconds (merge) to tens of minutes (OCR of a scan)
+ACTIVITY_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+QUEUE_WAIT_BUCKETS = (0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+LLM_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1200)
+TOKENS_PER_SECOND_BUCKETS = (1, 2.5, 5, 10, 15, 20, 30, 40, 50, 75, 100, 150, 200)
+EMBEDDING_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, value=1):
+        pass
+
+    def dec(self, value=1):
+        pass
+
+    def set(self, value):
+        pass
+
+
+def _metric(cls_name: str, *args, **kwargs):
+    if not HAS_PROMETHEUS:
+        return _NoopMetric()
+    return {"counter": Counter, "gauge": Gauge, "histogram": Histogram}[cls_name](*args, **kwargs)
+
+
+# --- Activities ---
+ACTIVITY_DURATION = _metric(
+    "histogram", "kp_activity_duration_seconds", "Activity execution time",
+    ["activity", "task_queue", "outcome"], buckets=ACTIVITY_BUCKETS
+)
+ACTIVITY_QUEUE_WAIT = _metric(
+    "histogram", "kp_activity_queue_wait_seconds", "Time from scheduling to pickup by the worker (Temporal task queue)",
+    ["activity", "task_queue"], buckets=QUEUE_WAIT_BUCKETS
+)
+ACTIVITY_RETRIES = _metric(
+    "counter", "kp_activity_retries_total", "Activity attempts after the first one",
+    ["activity", "task_queue"]
+)
+ACTIVITY_IN_PROGRESS = _metric(
+    "gauge", "kp_activity_in_progress", "Activities currently executing", ["task_queue"]
+)
+
+# --- GPU fair scheduler (fair_scheduler.py) ---
+GPU_SLOT_WAIT = _metric(
+    "histogram", "kp_gpu_slot_wait_seconds", "Time a gpu-queue activity waits for a fair-share LLM slot",
+    ["activity"], buckets=QUEUE_WAIT_BUCKETS
+)
+GPU_SLOTS_IN_USE = _metric("gauge", "kp_gpu_slots_in_use", "LLM slots held by running activities")
+GPU_SLOTS_WAITING = _metric("gauge", "kp_gpu_slots_waiting", "Activities waiting for an LLM slot")
+
+# --- LLM (llm_service.py) ---
+LLM_REQUEST_DURATION = _metric(
+    "histogram", "kp_llm_request_duration_seconds", "Duration of a single LLM HTTP request",
+    ["tool_name"], buckets=LLM_BUCKETS
+)
+LLM_CALL_DURATION = _metric(
+    "histogram", "kp_llm_call_duration_seconds", "Duration of a completion call including retries",
+    ["tool_name", "outcome"], buckets=LLM_BUCKETS
+)
+LLM_TIME_TO_FIRST_TOKEN = _metric(
+    "histogram", "kp_llm_time_to_first_token_seconds", "Time until the first streamed token arrives",
+    ["tool_name"], buckets=LLM_BUCKETS
+)
+LLM_REQUESTS_IN_FLIGHT = _metric("gauge", "kp_llm_requests_in_flight", "LLM HTTP requests currently in flight")
+LLM_TOKENS = _metric(
+    "counter", "kp_llm_tokens_total", "Tokens reported by the LLM server", ["tool_name", "kind"]
+)
+LLM_TOKENS_PER_SECOND = _metric(
+    "histogram", "kp_llm_tokens_per_second", "Completion tokens per second of a single request",
+    ["tool_name"], buckets=TOKENS_PER_SECOND_BUCKETS
+)
+LLM_RETRIES = _metric(
+    "counter", "kp_llm_retries_total", "LLM requests repeated after a failed attempt", ["tool_name", "reason"]
+)
+LLM_VALIDATION_FAILURES = _metric(
+    "counter", "kp_llm_validation_failures_total", "Responses that were not valid JSON or failed schema validation",
+    ["tool_name"]
+)
+LLM_JSON_REPAIRS = _metric(
+    "counter", "kp_llm_json_repairs_total",
+    "Malformed JSON responses by local repair result (lenient, escaped, structural, lossy, truncated, failed)", ["tool_name", "result"]
+)
+LLM_CONTEXT_LIMIT_ERRORS = _metric(
+    "counter", "kp_llm_context_limit_errors_total", "Requests rejected for exceeding the model context", ["tool_name"]
+)
+LLM_CACHE_REQUESTS = _metric(
+    "counter", "kp_llm_cache_requests_total", "Completion cache lookups (llm_cache.py)", ["tool_name", "result"]
+)
+LLM_CACHE_EVICTIONS = _metric("counter", "kp_llm_cache_evictions_total", "Completion cache entries evicted (size/TTL)")
+
+# --- Embeddings (rag_service.py) ---
+EMBEDDING_DURATION = _metric(
+    "histogram", "kp_embedding_duration_seconds", "Duration of one embed_texts batch", buckets=EMBEDDING_BUCKETS
+)
+EMBEDDING_TEXTS = _metric("counter", "kp_embedding_texts_total", "Texts embedded")
+EMBEDDING_CHARS = _metric("counter", "kp_embedding_chars_total", "Characters of text embedded")
+
+
+def observe_llm_usage(tool_name: str, usage: Any, elapsed: float):
+    """Records token counters and generation speed from an OpenAI-style usage object."""
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    LLM_TOKENS.labels(tool_name, "prompt").inc(prompt_tokens)
+    LLM_TOKENS.labels(tool_name, "completion").inc(completion_tokens)
+    if completion_tokens and elapsed > 0:
+        LLM_TOKENS_PER_SECOND.labels(tool_name).observe(completion_tokens / elapsed)
+
+
+def start_metrics_server(port: int = WORKER_METRICS_PORT):
+    if not HAS_PROMETHEUS:
+        logger.warning("prometheus_client not installed, worker metrics disabled")
+        return
+    start_http_server(port)
+    logger.info(f"Worker metrics on :{port}/metrics")
+
+
+class _MetricsActivityInbound(ActivityInboundInterceptor):
+    async def execute_activity(self, input: ExecuteActivityInput) -> Any:
+        info = activity.info()
+        name, queue = info.activity_type, info.task_queue
+        if info.started_time and info.current_attempt_scheduled_time:
+            wait = (info.started_time - info.current_attempt_scheduled_time).total_seconds()
+            ACTIVITY_QUEUE_WAIT.labels(name, queue).observe(max(wait, 0))
+        if info.attempt > 1:
+            ACTIVITY_RETRIES.labels(name, queue).inc()
+
+        outcome = "failed"
+        start = time.monotonic()
+        ACTIVITY_IN_PROGRESS.labels(queue).inc()
+        try:
+            result = await self.next.execute_activity(input)
+            outcome = "completed"
+            return result
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError) or activity.is_cancelled():
+                outcome = "cancelled"
+            raise
+        finally:
+            ACTIVITY_IN_PROGRESS.labels(queue).dec()
+            ACTIVITY_DURATION.labels(name, queue, outcome).observe(time.monotonic() - start)
+
+
+class ActivityMetricsInterceptor(Interceptor):
+    """Per-activity latency, queue wait and retry metrics.
+
+    On the gpu-queue worker list it after FairShareInterceptor, so durations exclude
+    the wait for an LLM slot (that wait is kp_gpu_slot_wait_seconds).
+    """
+
+    def intercept_activity(self, next: ActivityInboundInterceptor) -> ActivityInboundInterceptor:
+        return _MetricsActivityInbound(next)
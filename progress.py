@@ -0,0 +1,95 @@
+"""
+Wall-clock view of a workflow's progress, behind /api/progress and the "progress" events.
+
+ProposalWorkflow.get_progress only reports facts: stage start/finish timestamps, chunk
+counters, the average chunk latency and the running extraction children. workflow.now()
+inside a query is the time of the last workflow task, not the current time, so elapsed
+time and the ETA are computed here with the API's clock. While a large document is
+extracted by child workflows, their own counters are queried and added, so chunks_done
+moves with every chunk instead of once per child.
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from temporalio.client import Client
+
+# ETA: LLM calls still ahead after each stage (analysis + estimation), each costed
+# at the running average chunk latency (an upper bound: their prompts are smaller)
+REMAINING_LLM_CALLS = {
+    "extraction": 2,
+    "merging": 2,
+    "notes": 2,
+    "analysis": 2,
+    "estimation": 1,
+    "generating": 1,
+}
+
+
+async def query_progress(client: Client, workflow_id: str) -> dict:
+    """get_progress of the workflow (and of its running extraction children) with elapsed times and ETA."""
+    progress = await client.get_workflow_handle(workflow_id).query("get_progress", rpc_timeout=timedelta(seconds=5))
+    await _add_children(client, progress)
+    return with_eta(progress)
+
+
+async def _add_children(client: Client, progress: dict):
+    children = progress.get("children") or []
+    if not children:
+        return
+    results = await asyncio.gather(*(
+        client.get_workflow_handle(child_id).query("get_progress", rpc_timeout=timedelta(seconds=5))
+        for child_id in children
+    ), return_exceptions=True)
+    window_size = 0
+    latencies = []
+    for stats in results:
+        if isinstance(stats, BaseException) or not stats:
+            continue  # Child not started yet or its worker is busy: counted when it finishes
+        progress["chunks_done"] += stats.get("completed", 0)
+        progress["chunks_failed"] += stats.get("failed", 0)
+        window_size += stats.get("size", 0)
+        if stats.get("avg_chunk_seconds"):
+            latencies.append(stats["avg_chunk_seconds"])
+    if window_size:
+        progress["window_size"] = window_size
+    if latencies:
+        progress["avg_chunk_seconds"] = round(sum(latencies) / len(latencies), 1)
+
+
+def _parse_time(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def with_eta(progress: dict, now: Optional[datetime] = None) -> dict:
+    """Adds elapsed_seconds/done to every stage and eta_seconds, measured at `now` (default: current time)."""
+    now = now or datetime.now(timezone.utc)
+    stages = {}
+    for name, times in (progress.get("stages") or {}).items():
+        started = _parse_time(times["started_at"])
+        finished = _parse_time(times["finished_at"]) if times.get("finished_at") else None
+        stages[name] = {
+            **times,
+            "elapsed_seconds": round(max(0.0, ((finished or now) - started).total_seconds()), 1),
+            "done": finished is not None
+        }
+    progress["stages"] = stages
+    progress["eta_seconds"] = _eta_seconds(progress)
+    return progress
+
+
+def _eta_seconds(progress: dict) -> Optional[float]:
+    stage = progress.get("stage")
+    per_call = progress.get("avg_chunk_seconds")
+    if stage not in REMAINING_LLM_CALLS or not per_call:
+        return None
+    if stage == "extraction":
+        window_size = max(1, progress.get("window_size") or 1)
+        remaining_chunks = progress.get("chunks_total", 0) - progress.get("chunks_done", 0)
+        # Chunks already in flight are partly done; count them as half
+        eta = max(0.0, remaining_chunks - window_size / 2) * per_call / window_size
+        return round(eta + REMAINING_LLM_CALLS["extraction"] * per_call, 1)
+    elapsed = progress["stages"][stage]["elapsed_seconds"]
+    eta = REMAINING_LLM_CALLS[stage] * per_call - min(elapsed, per_call)
+    return round(max(0.0, eta), 1)
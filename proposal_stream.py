@@ -0,0 +1,135 @@
+"""
+Live text of the proposal being generated, shared between the worker and the API.
+
+generate_proposal_activity streams the LLM answer into PROPOSAL_STREAMS_DIR/{workflow_id}.md
+(ProposalStreamWriter); the API's status watcher tails that file while the workflow is
+GENERATING (ProposalStreamReader) and forwards new text over /api/events. The finished
+text still comes back as the activity result and lands in the workflow state as before.
+
+Every opening of the file (a new activity attempt) starts it with a fresh attempt id line;
+the reader starts over when the id changes, whatever the size of the new attempt's text.
+"""
+import asyncio
+import codecs
+import os
+import time
+import uuid
+from typing import Optional, Tuple
+
+PROPOSAL_STREAMS_DIR = os.getenv("PROPOSAL_STREAMS_DIR", "/shared_data/streams")
+# Writer flushes buffered tokens at most this often (one small write per interval)
+PROPOSAL_STREAM_FLUSH_INTERVAL = float(os.getenv("PROPOSAL_STREAM_FLUSH_INTERVAL", 0.25))
+# Stream files of workflows nobody watched to the end are removed after this long
+PROPOSAL_STREAM_TTL_HOURS = int(os.getenv("PROPOSAL_STREAM_TTL_HOURS", 24))
+# First line of a stream file: uuid4 hex of the attempt that wrote it
+ATTEMPT_HEADER_SIZE = 33
+
+
+def stream_path(workflow_id: str) -> str:
+    return os.path.join(PROPOSAL_STREAMS_DIR, f"{workflow_id}.md")
+
+
+def _cleanup_stale_streams():
+    cutoff = time.time() - PROPOSAL_STREAM_TTL_HOURS * 3600
+    for name in os.listdir(PROPOSAL_STREAMS_DIR):
+        path = os.path.join(PROPOSAL_STREAMS_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _open_stream(path: str):
+    os.makedirs(PROPOSAL_STREAMS_DIR, exist_ok=True)
+    _cleanup_stale_streams()
+    f = open(path, "w", encoding="utf-8")
+    _write_flush(f, uuid.uuid4().hex + "\n")
+    return f
+
+
+def _write_flush(f, text: str):
+    f.write(text)
+    f.flush()
+
+
+def remove_stream(workflow_id: str):
+    try:
+        os.remove(stream_path(workflow_id))
+    except OSError:
+        pass
+
+
+class ProposalStreamWriter:
+    """Buffers streamed tokens and appends them to the stream file from a thread."""
+
+    def __init__(self, workflow_id: str):
+        self.path = stream_path(workflow_id)
+        self._file = None
+        self._buffer = []
+        self._last_flush = 0.0
+
+    async def __aenter__(self) -> "ProposalStreamWriter":
+        # "w": a regenerated proposal replaces the previous attempt's text (new attempt id)
+        self._file = await asyncio.to_thread(_open_stream, self.path)
+        return self
+
+    async def write(self, delta: str):
+        self._buffer.append(delta)
+        if time.monotonic() - self._last_flush >= PROPOSAL_STREAM_FLUSH_INTERVAL:
+            await self.flush()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        text, self._buffer = "".join(self._buffer), []
+        self._last_flush = time.monotonic()
+        await asyncio.to_thread(_write_flush, self._file, text)
+
+    async def __aexit__(self, *exc_info):
+        try:
+            await self.flush()
+        finally:
+            await asyncio.to_thread(self._file.close)
+
+
+class ProposalStreamReader:
+    """Reads what was appended to a stream file since the last call (UTF-8 safe across reads)."""
+
+    def __init__(self, workflow_id: str):
+        self.path = stream_path(workflow_id)
+        self.text = ""
+        self._attempt: Optional[bytes] = None
+        self._offset = ATTEMPT_HEADER_SIZE
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+
+    def _read_new(self) -> Tuple[bool, str]:
+        """(restarted, new text) since the previous read; restarted = file rewritten by a new attempt."""
+        try:
+            with open(self.path, "rb") as f:
+                attempt = f.read(ATTEMPT_HEADER_SIZE)
+                if len(attempt) < ATTEMPT_HEADER_SIZE:
+                    return False, ""  # Just reopened, header not written yet
+                restarted = self._attempt is not None and attempt != self._attempt
+                if attempt != self._attempt:
+                    self._attempt = attempt
+                    self._offset = ATTEMPT_HEADER_SIZE
+                    self._decoder.reset()
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return False, ""
+        self._offset += len(data)
+        return restarted, self._decoder.decode(data)
+
+    async def read_new(self) -> Optional[dict]:
+        """{"offset", "text"} of the new text (offset 0 = replace everything), None if nothing new."""
+        restarted, delta = await asyncio.to_thread(self._read_new)
+        if restarted:
+            self.text = delta
+            return {"offset": 0, "text": delta}
+        if not delta:
+            return None
+        offset = len(self.text)
+        self.text += delta
+        return {"offset": offset, "text": delta}
@@ -2,9 +2,12 @@
 import os
 import shutil
 import logging
+import time
 from typing import List, Dict, Optional, Any
 import numpy as np
 
+from metrics import EMBEDDING_CHARS, EMBEDDING_DURATION, EMBEDDING_TEXTS
+
 try:
     import lancedb
     from sentence_transformers import SentenceTransformer
@@ -75,7 +78,11 @@ class RAGService:
              return []
         
         # BGE-M3 can support passing instructions, but standard usage is fine for dense retrieval
+        start = time.monotonic()
         embeddings = self.model.encode(texts, normalize_embeddings=True)
+        EMBEDDING_DURATION.observe(time.monotonic() - start)
+        EMBEDDING_TEXTS.inc(len(texts))
+        EMBEDDING_CHARS.inc(sum(len(t) for t in texts))
         return embeddings.tolist()
 
     def create_index(self, chunks: List[Dict[str, Any]], table_name: str = "requirements"):
@@ -0,0 +1,205 @@
+"""
+Shared per-workflow status watchers behind /api/events (Server-Sent Events).
+
+One WorkflowWatcher per workflow, however many tabs are subscribed. It long-polls the
+workflow history (fetch_history_events with wait_new_event), so Temporal is queried only
+after something actually happened in the workflow: get_progress on every new batch of
+events (and every STREAM_CHILD_POLL_INTERVAL while extraction child workflows run),
+get_data only when the status changes; elapsed times and the ETA come from progress.py.
+Subscribers receive "progress" and "state" events; "end" once the workflow is finished. While the workflow is GENERATING the
+watcher also tails the proposal stream file (proposal_stream.py) and sends the new text as
+"proposal" events ({"offset", "text"}).
+"""
+import asyncio
+import logging
+import os
+from datetime import timedelta
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+from temporalio.client import Client
+
+from progress import query_progress
+from proposal_stream import ProposalStreamReader, remove_stream
+
+logger = logging.getLogger("kp-api")
+
+# At most one progress query per this many seconds while events keep coming
+STREAM_MIN_INTERVAL = float(os.getenv("STREAM_MIN_INTERVAL", 0.5))
+# Retry delay after a failed query (worker busy, query timed out)
+STREAM_RETRY_INTERVAL = float(os.getenv("STREAM_RETRY_INTERVAL", 2))
+# Comment line sent on idle streams so proxies keep the connection open
+STREAM_KEEPALIVE = int(os.getenv("STREAM_KEEPALIVE", 15))
+# Progress poll interval while extraction runs in child workflows
+STREAM_CHILD_POLL_INTERVAL = float(os.getenv("STREAM_CHILD_POLL_INTERVAL", 5))
+# How often the proposal stream file is checked for new text while GENERATING
+STREAM_TOKEN_INTERVAL = float(os.getenv("STREAM_TOKEN_INTERVAL", 0.2))
+
+FINAL_STATUSES = ("COMPLETED",)
+
+Event = Optional[Tuple[str, Any]]  # (name, payload); None closes the stream
+
+
+def is_final_status(status: Optional[str]) -> bool:
+    return status in FINAL_STATUSES or (status or "").startswith("ERROR")
+
+
+class WorkflowWatcher:
+    """Follows one workflow and fans its state transitions out to subscriber queues."""
+
+    def __init__(self, hub: "StatusHub", client: Client, workflow_id: str):
+        self.hub = hub
+        self.client = client
+        self.handle = client.get_workflow_handle(workflow_id)
+        self.workflow_id = workflow_id
+        self.subscribers: Set[asyncio.Queue] = set()
+        self.last_progress: Optional[dict] = None
+        self.last_state: Optional[dict] = None
+        self._changed = asyncio.Event()
+        self._changed.set()  # Initial snapshot
+        self._history_closed = False
+        self._not_found = False
+        self._history_task: Optional[asyncio.Task] = None
+        self._emit_task: Optional[asyncio.Task] = None
+        self._proposal: Optional[ProposalStreamReader] = None
+        self._proposal_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._history_task = asyncio.create_task(self._follow_history())
+        self._emit_task = asyncio.create_task(self._emit_loop())
+
+    def stop(self):
+        self._history_task.cancel()
+        self._emit_task.cancel()
+        self._stop_proposal()
+
+    def subscribe(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        # Late subscribers start from the latest known snapshot
+        if self.last_state is not None:
+            queue.put_nowait(("state", self.last_state))
+        if self.last_progress is not None:
+            queue.put_nowait(("progress", self.last_progress))
+        if self._proposal is not None and self._proposal.text:
+            queue.put_nowait(("proposal", {"offset": 0, "text": self._proposal.text}))
+        self.subscribers.add(queue)
+        return queue
+
+    def _publish(self, event: Event):
+        for queue in self.subscribers:
+            queue.put_nowait(event)
+
+    async def _follow_history(self):
+        try:
+            # Ends after the workflow's close event
+            async for _ in self.handle.fetch_history_events(wait_new_event=True, skip_archival=True):
+                self._changed.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if "not found" in str(e).lower():
+                self._not_found = True
+            else:
+                logger.warning(f"Events: history stream for {self.workflow_id} failed: {e}")
+        self._history_closed = True
+        self._changed.set()
+
+    async def _tail_proposal(self):
+        while True:
+            try:
+                chunk = await self._proposal.read_new()
+            except OSError as e:
+                logger.debug(f"Events: proposal stream for {self.workflow_id} unreadable: {e}")
+                chunk = None
+            if chunk is not None:
+                self._publish(("proposal", chunk))
+            await asyncio.sleep(STREAM_TOKEN_INTERVAL)
+
+    def _start_proposal(self):
+        if self._proposal_task is None:
+            self._proposal = ProposalStreamReader(self.workflow_id)
+            self._proposal_task = asyncio.create_task(self._tail_proposal())
+
+    def _stop_proposal(self):
+        if self._proposal_task is not None:
+            self._proposal_task.cancel()
+        self._proposal_task = None
+        self._proposal = None
+
+    async def _emit_loop(self):
+        try:
+            while True:
+                if self.last_progress and self.last_progress.get("children"):
+                    # Chunks of child workflows leave no events in this history: poll while they run
+                    try:
+                        await asyncio.wait_for(self._changed.wait(), timeout=STREAM_CHILD_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    await self._changed.wait()
+                self._changed.clear()
+                if self._not_found:
+                    self._publish(("error", {"detail": "Workflow not found"}))
+                    break
+                try:
+                    progress = await query_progress(self.client, self.workflow_id)
+                    status = progress.get("status")
+                    if self.last_state is None or status != self.last_state.get("status"):
+                        state = await self.handle.query("get_data", rpc_timeout=timedelta(seconds=10))
+                        self.last_state = state
+                        self.hub.on_state(self.workflow_id, state)
+                        self._publish(("state", state))
+                        if status == "GENERATING":
+                            self._start_proposal()
+                        else:
+                            # The finished text arrives with the state (final_proposal)
+                            self._stop_proposal()
+                    self.last_progress = progress
+                    self._publish(("progress", progress))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # Query timeout = worker busy with an LLM call; try again shortly
+                    logger.debug(f"Events: query for {self.workflow_id} failed: {e}")
+                    await asyncio.sleep(STREAM_RETRY_INTERVAL)
+                    self._changed.set()
+                    continue
+                if is_final_status(status) or self._history_closed:
+                    if status == "COMPLETED":
+                        await asyncio.to_thread(remove_stream, self.workflow_id)
+                    break
+                await asyncio.sleep(STREAM_MIN_INTERVAL)
+            self._publish(("end", {"status": (self.last_state or {}).get("status")}))
+        finally:
+            self._publish(None)
+            self.hub.forget(self)
+            self._history_task.cancel()
+            self._stop_proposal()
+
+
+class StatusHub:
+    """workflow_id -> WorkflowWatcher; watchers live while they have subscribers."""
+
+    def __init__(self, on_state: Callable[[str, dict], None] = lambda workflow_id, state: None):
+        self.on_state = on_state
+        self._watchers: Dict[str, WorkflowWatcher] = {}
+
+    def subscribe(self, client: Client, workflow_id: str) -> asyncio.Queue:
+        watcher = self._watchers.get(workflow_id)
+        if watcher is None:
+            watcher = WorkflowWatcher(self, client, workflow_id)
+            self._watchers[workflow_id] = watcher
+            watcher.start()
+        return watcher.subscribe()
+
+    def unsubscribe(self, workflow_id: str, queue: asyncio.Queue):
+        watcher = self._watchers.get(workflow_id)
+        if watcher is None:
+            return
+        watcher.subscribers.discard(queue)
+        if not watcher.subscribers:
+            self.forget(watcher)
+            watcher.stop()
+
+    def forget(self, watcher: WorkflowWatcher):
+        if self._watchers.get(watcher.workflow_id) is watcher:
+            del self._watchers[watcher.workflow_id]
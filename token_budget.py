@@ -0,0 +1,100 @@
+"""
+Context budget of document chunks, counted in tokens of the model's tokenizer.
+
+A chunk sent to the LLM shares the context window with the system prompt, the inlined
+JSON schema and the reserved completion (LLM_MAX_TOKENS). chunk_token_budget() is what
+is left, times DOC_CHUNK_FILL_RATIO (headroom for chat template tokens and tokenizer
+drift). The tokenizer is only loaded from LLM_TOKENIZER (a local directory in the offline
+deployment, see docker-compose.yml). Without it, without transformers, or if it cannot be
+loaded, tokens are estimated from UTF-8 bytes, conservatively for Cyrillic (logged once
+as an error: chunks are then sized less precisely).
+"""
+import logging
+import os
+import threading
+from typing import List, Optional
+
+from llm_service import LLM_GUIDED_JSON, LLM_MAX_TOKENS
+
+try:
+    from transformers import AutoTokenizer
+    HAS_TRANSFORMERS = True
+except ImportError:
+    HAS_TRANSFORMERS = False
+
+logger = logging.getLogger("token_budget")
+
+# Local path (or HF id, if the hub is reachable) of the served model's tokenizer
+# (Qwen2.5 sizes share one tokenizer). Empty: byte estimate
+LLM_TOKENIZER = os.getenv("LLM_TOKENIZER", "")
+# Context window the LLM server was started with (vLLM --max-model-len)
+LLM_CONTEXT_TOKENS = int(os.getenv("LLM_CONTEXT_TOKENS", 32768))
+# Share of the free context a chunk may fill
+DOC_CHUNK_FILL_RATIO = float(os.getenv("DOC_CHUNK_FILL_RATIO", 0.85))
+# Without a tokenizer: UTF-8 bytes per token (Cyrillic is 2 bytes per letter, ~3 bytes per token)
+FALLBACK_BYTES_PER_TOKEN = float(os.getenv("FALLBACK_BYTES_PER_TOKEN", 3))
+# Chat template, role markers, user message framing around the chunk
+_MESSAGE_OVERHEAD_TOKENS = 64
+
+_tokenizer = None
+_tokenizer_failed = False
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer():
+    """Thread-safe lazy tokenizer singleton; None if unavailable (byte estimate is used)."""
+    global _tokenizer, _tokenizer_failed
+    with _tokenizer_lock:
+        if _tokenizer is None and not _tokenizer_failed:
+            if not LLM_TOKENIZER:
+                logger.error("LLM_TOKENIZER not set, token counts are estimated from bytes")
+                _tokenizer_failed = True
+            elif not HAS_TRANSFORMERS:
+                logger.error("transformers not installed, token counts are estimated from bytes")
+                _tokenizer_failed = True
+            else:
+                try:
+                    _tokenizer = AutoTokenizer.from_pretrained(LLM_TOKENIZER)
+                    logger.info(f"Tokenizer loaded: {LLM_TOKENIZER}")
+                except Exception as e:
+                    logger.error(f"Tokenizer {LLM_TOKENIZER} unavailable, token counts are estimated from bytes: {e}")
+                    _tokenizer_failed = True
+        return _tokenizer
+
+
+def _estimate_tokens(text: str) -> int:
+    return int(len(text.encode("utf-8")) / FALLBACK_BYTES_PER_TOKEN) + 1
+
+
+def count_tokens_batch(texts: List[str]) -> List[int]:
+    if not texts:
+        return []
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return [_estimate_tokens(t) for t in texts]
+    return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+
+def count_tokens(text: str) -> int:
+    return count_tokens_batch([text])[0]
+
+
+def chunk_token_budget(system_prompts: List[str], schemas_json: Optional[List[str]] = None) -> int:
+    """
+    Tokens a document chunk may take so that every given prompt (with its schema, unless the
+    server decodes by schema) plus the reserved completion fits into the context window.
+    """
+    schemas_json = schemas_json or [""] * len(system_prompts)
+    reserved = 0
+    for prompt, schema in zip(system_prompts, schemas_json):
+        prompt_tokens = count_tokens(prompt)
+        if LLM_GUIDED_JSON == "off" and schema:
+            prompt_tokens += count_tokens(schema) + _MESSAGE_OVERHEAD_TOKENS  # + schema instruction text
+        reserved = max(reserved, prompt_tokens)
+    free = LLM_CONTEXT_TOKENS - LLM_MAX_TOKENS - reserved - _MESSAGE_OVERHEAD_TOKENS
+    if free <= 0:
+        raise ValueError(
+            f"No context left for the document: context {LLM_CONTEXT_TOKENS}, "
+            f"max_tokens {LLM_MAX_TOKENS}, prompt {reserved}"
+        )
+    return int(free * DOC_CHUNK_FILL_RATIO)
@@ -0,0 +1,251 @@
+"""
+Upload handling that does not block the event loop.
+
+- save_upload(): streams a multipart UploadFile to disk in chunks (writes in a thread),
+  computing SHA-256 in the same pass and enforcing MAX_UPLOAD_MB as bytes arrive.
+- Resumable uploads for large scans: a session directory under UPLOAD_SESSIONS_DIR holds
+  the partial file and meta.json; the client PUTs chunks at the current offset and can
+  ask for that offset after a dropped connection.
+"""
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from fastapi import HTTPException, UploadFile
+
+MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", 200))
+MAX_UPLOAD_BYTES = MAX_UPLOAD_MB * 1024 * 1024
+# Whole multipart body of /api/start_batch (ТЗ + appendices); each file is still held to MAX_UPLOAD_MB
+MAX_BATCH_MB = int(os.getenv("MAX_BATCH_MB", 1024))
+MAX_BATCH_BYTES = MAX_BATCH_MB * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MB read/write unit
+# Chunk size suggested to resumable clients (one PUT each)
+RESUMABLE_CHUNK_SIZE = int(os.getenv("RESUMABLE_CHUNK_MB", 8)) * 1024 * 1024
+UPLOAD_SESSIONS_DIR = os.getenv("UPLOAD_SESSIONS_DIR", "/shared_data/upload_sessions")
+# Unfinished sessions older than this are removed on the next session creation
+UPLOAD_SESSION_TTL_HOURS = int(os.getenv("UPLOAD_SESSION_TTL_HOURS", 24))
+
+
+def _too_large() -> HTTPException:
+    return HTTPException(status_code=413, detail=f"Файл больше {MAX_UPLOAD_MB} МБ")
+
+
+def check_content_length(content_length: Optional[str], batch: bool = False):
+    """Early reject before reading the body (multipart framing adds a little on top of the files)."""
+    limit = MAX_BATCH_BYTES if batch else MAX_UPLOAD_BYTES
+    if content_length and content_length.isdigit() and int(content_length) > limit + UPLOAD_CHUNK_SIZE:
+        if batch:
+            raise HTTPException(status_code=413, detail=f"Файлы вместе больше {MAX_BATCH_MB} МБ")
+        raise _too_large()
+
+
+def _write_chunk(f, hasher, chunk: bytes):
+    # hashlib releases the GIL on large buffers, so hashing runs in the thread too
+    hasher.update(chunk)
+    f.write(chunk)
+
+
+async def _write_stream(chunks: AsyncIterator[bytes], f, hasher) -> int:
+    size = 0
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        size += len(chunk)
+        if size > MAX_UPLOAD_BYTES:
+            raise _too_large()
+        await asyncio.to_thread(_write_chunk, f, hasher, chunk)
+    return size
+
+
+async def _iter_upload(upload: UploadFile) -> AsyncIterator[bytes]:
+    while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+        yield chunk
+
+
+async def save_upload(upload: UploadFile, dest_path: str) -> Tuple[str, int]:
+    """Streams an UploadFile to dest_path. Returns (sha256 hex, size). Removes the file on failure."""
+    hasher = hashlib.sha256()
+    try:
+        f = await asyncio.to_thread(open, dest_path, "wb")
+        try:
+            size = await _write_stream(_iter_upload(upload), f, hasher)
+        finally:
+            await asyncio.to_thread(f.close)
+    except BaseException:
+        await asyncio.to_thread(_remove_quietly, dest_path)
+        raise
+    return hasher.hexdigest(), size
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _hash_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+# --- Resumable sessions ---
+
+def _session_dir(upload_id: str) -> str:
+    # upload_id is a server-generated uuid4 hex; anything else is rejected
+    if len(upload_id) != 32 or any(c not in "0123456789abcdef" for c in upload_id):
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return os.path.join(UPLOAD_SESSIONS_DIR, upload_id)
+
+
+def _read_meta(upload_id: str) -> dict:
+    path = os.path.join(_session_dir(upload_id), "meta.json")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+
+
+def _write_meta(upload_id: str, meta: dict):
+    path = os.path.join(_session_dir(upload_id), "meta.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _data_path(upload_id: str) -> str:
+    return os.path.join(_session_dir(upload_id), "data")
+
+
+def _received(upload_id: str) -> int:
+    try:
+        return os.path.getsize(_data_path(upload_id))
+    except FileNotFoundError:
+        return 0
+
+
+def _cleanup_stale_sessions():
+    if not os.path.isdir(UPLOAD_SESSIONS_DIR):
+        return
+    cutoff = time.time() - UPLOAD_SESSION_TTL_HOURS * 3600
+    for name in os.listdir(UPLOAD_SESSIONS_DIR):
+        path = os.path.join(UPLOAD_SESSIONS_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+def _create_session_sync(user: str, filename: str, size: int) -> dict:
+    _cleanup_stale_sessions()
+    upload_id = uuid.uuid4().hex
+    os.makedirs(_session_dir(upload_id), exist_ok=True)
+    open(_data_path(upload_id), "wb").close()
+    meta = {"user": user, "filename": filename, "size": size, "created_at": time.time()}
+    _write_meta(upload_id, meta)
+    return {"upload_id": upload_id, "chunk_size": RESUMABLE_CHUNK_SIZE, "received": 0, "size": size}
+
+
+async def create_session(user: str, filename: str, size: int) -> dict:
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="Empty file")
+    if size > MAX_UPLOAD_BYTES:
+        raise _too_large()
+    return await asyncio.to_thread(_create_session_sync, user, filename, size)
+
+
+async def _session_for(upload_id: str, user: str) -> dict:
+    meta = await asyncio.to_thread(_read_meta, upload_id)
+    if meta["user"] != user:
+        raise HTTPException(status_code=403, detail="Access denied")
+    return meta
+
+
+async def session_status(upload_id: str, user: str) -> dict:
+    meta = await _session_for(upload_id, user)
+    received = await asyncio.to_thread(_received, upload_id)
+    return {
+        "upload_id": upload_id,
+        "filename": meta["filename"],
+        "received": received,
+        "size": meta["size"],
+        "chunk_size": RESUMABLE_CHUNK_SIZE
+    }
+
+
+# One writer per session (the API is a single process): a client retrying a PUT while the
+# first request is still streaming would otherwise pass the same offset check and interleave
+_session_locks: Dict[str, asyncio.Lock] = {}
+_session_lock_holders: Dict[str, int] = {}
+
+
+@contextlib.asynccontextmanager
+async def _session_lock(upload_id: str):
+    lock = _session_locks.setdefault(upload_id, asyncio.Lock())
+    _session_lock_holders[upload_id] = _session_lock_holders.get(upload_id, 0) + 1
+    try:
+        async with lock:
+            yield
+    finally:
+        _session_lock_holders[upload_id] -= 1
+        if not _session_lock_holders[upload_id]:
+            del _session_lock_holders[upload_id]
+            del _session_locks[upload_id]
+
+
+async def append_chunk(upload_id: str, user: str, offset: int, chunks: AsyncIterator[bytes]) -> dict:
+    """Appends a request body at offset; offset must equal the bytes received so far (else 409)."""
+    meta = await _session_for(upload_id, user)
+    async with _session_lock(upload_id):
+        received = await asyncio.to_thread(_received, upload_id)
+        if offset != received:
+            raise HTTPException(status_code=409, detail={"message": "Offset mismatch", "received": received})
+
+        f = await asyncio.to_thread(open, _data_path(upload_id), "ab")
+        try:
+            size = received
+            async for chunk in chunks:
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if size > meta["size"]:
+                    raise HTTPException(status_code=413, detail="Chunk exceeds declared file size")
+                await asyncio.to_thread(f.write, chunk)
+        except BaseException:
+            # Rejected or dropped mid-chunk: drop the partial chunk so the client can retry from the same offset
+            await asyncio.to_thread(f.truncate, received)
+            raise
+        finally:
+            await asyncio.to_thread(f.close)
+    return {"upload_id": upload_id, "received": size, "size": meta["size"]}
+
+
+def _finish_session_sync(upload_id: str, dest_path: str) -> Tuple[str, int]:
+    data_path = _data_path(upload_id)
+    sha256 = _hash_file(data_path)
+    size = os.path.getsize(data_path)
+    shutil.move(data_path, dest_path)
+    shutil.rmtree(_session_dir(upload_id), ignore_errors=True)
+    return sha256, size
+
+
+async def finish_session(upload_id: str, user: str, dest_path: str) -> Tuple[str, int]:
+    """Moves a fully received upload to dest_path. Returns (sha256 hex, size)."""
+    meta = await _session_for(upload_id, user)
+    async with _session_lock(upload_id):
+        received = await asyncio.to_thread(_received, upload_id)
+        if received != meta["size"]:
+            raise HTTPException(status_code=409, detail={"message": "Upload incomplete", "received": received})
+        return await asyncio.to_thread(_finish_session_sync, upload_id, dest_path)
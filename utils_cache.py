@@ -0,0 +1,55 @@
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache:
+    """
+    In-process LRU cache bounded by item count and, optionally, by total size
+    (sizeof(value), bytes for byte strings). Not thread-safe: use from one event loop.
+    """
+
+    def __init__(self, max_items: int = 1024, max_bytes: Optional[int] = None, sizeof: Callable[[Any], int] = len):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[Hashable, Any]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._items
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if key not in self._items:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def put(self, key: Hashable, value: Any):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return  # Larger than the whole cache: never stored
+        self.pop(key)
+        self._items[key] = value
+        self.total_bytes += size
+        while len(self._items) > self.max_items or (self.max_bytes is not None and self.total_bytes > self.max_bytes):
+            self._evict_oldest()
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        if key not in self._items:
+            return default
+        value = self._items.pop(key)
+        if self.max_bytes is not None:
+            self.total_bytes -= self.sizeof(value)
+        return value
+
+    def _evict_oldest(self):
+        _, value = self._items.popitem(last=False)
+        if self.max_bytes is not None:
+            self.total_bytes -= self.sizeof(value)
@@ -49,6 +49,12 @@ def markdown_to_docx(md_text: str) -> io.BytesIO:
     buffer.seek(0)
     return buffer
 
+def markdown_to_docx_bytes(md_text: str) -> bytes:
+    """
+    markdown_to_docx returning plain bytes (picklable: used from a process pool).
+    """
+    return markdown_to_docx(md_text).getvalue()
+
 def _add_table(doc, table_tag):
     """
     Helper to add a table from HTML tag to DOCX.
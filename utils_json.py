@@ -0,0 +1,166 @@
+import json
+from typing import Any, List, Optional, Tuple
+
+# Closing bracket for each opening one
+_CLOSERS = {"{": "}", "[": "]"}
+_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}
+# First characters of a JSON value
+_VALUE_STARTS = set('"{[-0123456789tfn')
+# parse_llm_json results that keep every character of the answer (safe to cache)
+LOSSLESS_REPAIRS = (None, "lenient", "escaped")
+
+
+def parse_llm_json(text: str, allow_lossy: bool = False) -> Tuple[Any, Optional[str]]:
+    """
+    Parses JSON produced by an LLM, repairing it locally if needed.
+    Returns (data, repair): repair is None for valid JSON, otherwise the step that worked
+    ("lenient" - control characters / text around the object; "escaped", "structural",
+    "lossy" - see repair_json). Only None, "lenient" and "escaped" keep every character.
+    Lossy candidates are only used with allow_lossy (the answer was cut off at max_tokens,
+    asking again gives the same cut); otherwise they would silently drop text.
+    Raises json.JSONDecodeError if nothing helps (then it is worth asking the model again).
+    """
+    try:
+        return json.loads(text), None
+    except json.JSONDecodeError as e:
+        error = e
+
+    start = _find_start(text)
+    if start is None:
+        raise error
+
+    # Raw newlines/tabs inside strings, explanations before or after the object
+    try:
+        data, _ = json.JSONDecoder(strict=False).raw_decode(text, start)
+        return data, "lenient"
+    except json.JSONDecodeError:
+        pass
+
+    for candidate, repair in repair_json(text[start:]):
+        if repair == "lossy" and not allow_lossy:
+            continue
+        try:
+            return json.loads(candidate, strict=False), repair
+        except json.JSONDecodeError:
+            continue
+    raise error
+
+
+def _find_start(text: str) -> Optional[int]:
+    positions = [p for p in (text.find("{"), text.find("[")) if p != -1]
+    return min(positions) if positions else None
+
+
+def _close(chars: List[str], stack: List[str]) -> str:
+    """Text so far plus closing brackets for everything still open."""
+    text = "".join(chars).rstrip()
+    while text.endswith(","):
+        text = text[:-1].rstrip()
+    if text.endswith(":"):
+        # Truncated right after a key
+        text += " null"
+    return text + "".join(reversed(stack))
+
+
+def _ends_string(text: str, i: int, is_key: bool, in_object: bool) -> bool:
+    """
+    Whether the quote at text[i] closes the current string: it must be followed by what
+    may come next in the document - ":" after a key; "}", "]", the end, or a comma followed
+    by the start of the next key (object) / value (array) after a value.
+    """
+    rest = text[i + 1:].lstrip()
+    if not rest:
+        return True
+    if is_key:
+        return rest[0] == ":"
+    if rest[0] in "}]":
+        return True
+    if rest[0] != ",":
+        return False
+    following = rest[1:].lstrip()[:1]
+    if not following:
+        return True  # Truncated right after the comma
+    return following == '"' if in_object else following in _VALUE_STARTS
+
+
+def repair_json(text: str) -> List[Tuple[str, str]]:
+    """
+    Structural fix-ups of broken JSON, as (candidate, kind) pairs to try in order:
+    - trailing commas before } and ] are dropped;
+    - quotes inside strings that do not end the string (see _ends_string) are escaped,
+      raw newlines/tabs in strings are escaped;
+    - a truncated document is closed: open string, dangling comma/colon, open brackets;
+    - second candidate: cut back to the last complete element (truncated mid-key or mid-value).
+    kind: "escaped" - only the fix-ups of the first two points, nothing is lost;
+    "structural" - the document had to be closed; "lossy" - text was dropped (the cut back,
+    or text after a top-level value that ended early).
+    """
+    chars: List[str] = []
+    stack: List[str] = []
+    in_string = False
+    is_key = False
+    expect_key = False  # Next string in the current object is a key
+    escaped = False
+    # (len(chars), stack) at the last comma: everything before it is complete
+    last_complete: Optional[Tuple[int, List[str]]] = None
+
+    rest_start = len(text)
+
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+                chars.append(ch)
+            elif ch == "\\":
+                escaped = True
+                chars.append(ch)
+            elif ch == '"':
+                if _ends_string(text, i, is_key, bool(stack) and stack[-1] == "}"):
+                    in_string = False
+                    chars.append(ch)
+                else:
+                    # Not followed by what may come next: a quote inside the text
+                    chars.append('\\"')
+            else:
+                chars.append(_ESCAPES.get(ch, ch))
+            continue
+
+        if ch == '"':
+            in_string = True
+            is_key, expect_key = expect_key, False
+            chars.append(ch)
+        elif ch in _CLOSERS:
+            stack.append(_CLOSERS[ch])
+            expect_key = ch == "{"
+            chars.append(ch)
+        elif ch in "}]":
+            while chars and chars[-1] in " \t\r\n,":
+                chars.pop()
+            if stack:
+                # A mismatched bracket is replaced by the one that is actually open
+                chars.append(stack.pop())
+            if not stack:
+                rest_start = i + 1
+                break
+        elif ch == ",":
+            last_complete = (len(chars), list(stack))
+            expect_key = bool(stack) and stack[-1] == "}"
+            chars.append(ch)
+        else:
+            chars.append(ch)
+
+    closed = in_string or bool(stack)
+    if in_string:
+        if escaped:
+            chars.pop()
+        chars.append('"')
+
+    if text[rest_start:].strip():
+        kind = "lossy"
+    else:
+        kind = "structural" if closed else "escaped"
+    candidates = [(_close(chars, stack), kind)]
+    if last_complete is not None:
+        length, open_brackets = last_complete
+        candidates.append((_close(chars[:length], open_brackets), "lossy"))
+    return candidates
@@ -1,6 +1,6 @@
 
 import re
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 from schemas import ExtractedTZData, KeyFeaturesDetails, SourceText
 
 def split_markdown(text: str, max_chars: int = 15000, overlap: int = 0) -> List[str]:
@@ -70,91 +70,223 @@ def split_markdown(text: str, max_chars: int = 15000, overlap: int = 0) -> List[
         
     return chunks
 
+# Paths of the SourceText lists inside ExtractedTZData ("key_features.<category>" for nested ones)
+LIST_FIELDS = ["business_goals", "tech_stack", "client_integrations"]
+KEY_FEATURE_FIELDS = ["modules", "screens", "reports", "integrations", "nfr"]
+LIST_PATHS = LIST_FIELDS + [f"key_features.{c}" for c in KEY_FEATURE_FIELDS]
+
+BAD_CLIENT_NAMES = ["Unknown Client", "Unknown", "Не указан", "Нет", "N/A", "Client Name"]
+BAD_PROJECT_TYPES = ["Other", "Unknown", ""]
+BAD_ESSENCES = ["Unknown Essence", "", "N/A"]
+
+
+class ExtractionAccumulator:
+    """
+    Running merge of ExtractedTZData chunks (Reduce phase as a fold).
+
+    Gives the same result as merging the whole list at once, but chunks can be
+    added one by one as they arrive, and two accumulators can be combined
+    (associative: partial merges of chunk ranges can be joined later).
+    List items are only ever appended, so a folded item's position is stable.
+    """
+
+    def __init__(self):
+        self.chunks_count = 0
+        # text -> {"count": votes, "item": first SourceText seen with that text}
+        self._votes: Dict[str, Dict[str, Dict[str, Any]]] = {"client_name": {}, "project_type": {}}
+        self._essence: Optional[SourceText] = None
+        self._lists: Dict[str, List[SourceText]] = {path: [] for path in LIST_PATHS}
+        self._seen: Dict[str, set] = {path: set() for path in LIST_PATHS}
+
+    @staticmethod
+    def _get_list(data: ExtractedTZData, path: str) -> List[SourceText]:
+        if path.startswith("key_features."):
+            return getattr(data.key_features, path.split(".", 1)[1])
+        return getattr(data, path)
+
+    def _vote(self, field: str, text: str, count: int, item: SourceText):
+        votes = self._votes[field]
+        if text in votes:
+            votes[text]["count"] += count
+        else:
+            votes[text] = {"count": count, "item": item}
+
+    def _offer_essence(self, item: SourceText):
+        # Longest essence wins (most descriptive); earlier one wins ties
+        if item.text in BAD_ESSENCES:
+            return
+        if self._essence is None or len(item.text) > len(self._essence.text):
+            self._essence = item
+
+    def _append_items(self, path: str, items: List[SourceText]) -> int:
+        added = 0
+        for item in items:
+            key = item.text.strip().lower()
+            if not key or key in self._seen[path]:
+                continue
+            self._seen[path].add(key)
+            self._lists[path].append(item)
+            added += 1
+        return added
+
+    def add(self, data: ExtractedTZData) -> Dict[str, Tuple[int, int]]:
+        """Folds one chunk result in. Returns {path: (start, end)} of newly added list items."""
+        self.chunks_count += 1
+        for field, invalid in (("client_name", BAD_CLIENT_NAMES), ("project_type", BAD_PROJECT_TYPES)):
+            item = getattr(data, field)
+            if item.text and item.text.strip() not in invalid:
+                self._vote(field, item.text.strip(), 1, item)
+        self._offer_essence(data.project_essence)
+
+        new_ranges = {}
+        for path in LIST_PATHS:
+            start = len(self._lists[path])
+            if self._append_items(path, self._get_list(data, path)):
+                new_ranges[path] = (start, len(self._lists[path]))
+        return new_ranges
+
+    def combine(self, other: "ExtractionAccumulator") -> Dict[str, Tuple[int, int]]:
+        """Folds another accumulator (a later range of chunks) into this one."""
+        self.chunks_count += other.chunks_count
+        for field, votes in other._votes.items():
+            for text, vote in votes.items():
+                self._vote(field, text, vote["count"], vote["item"])
+        if other._essence is not None:
+            self._offer_essence(other._essence)
+
+        new_ranges = {}
+        for path in LIST_PATHS:
+            start = len(self._lists[path])
+            if self._append_items(path, other._lists[path]):
+                new_ranges[path] = (start, len(self._lists[path]))
+        return new_ranges
+
+    def _best_vote(self, field: str) -> Optional[SourceText]:
+        best = None
+        for vote in self._votes[field].values():
+            if best is None or vote["count"] > best["count"]:
+                best = vote
+        return best["item"] if best else None
+
+    def items(self, ranges: Dict[str, Tuple[int, int]]) -> Dict[str, Any]:
+        """Dumps list items in the given ranges as a partial ExtractedTZData-shaped dict."""
+        partial: Dict[str, Any] = {"key_features": {}}
+        for path, (start, end) in ranges.items():
+            dumped = [item.model_dump() for item in self._lists[path][start:end]]
+            if path.startswith("key_features."):
+                partial["key_features"][path.split(".", 1)[1]] = dumped
+            else:
+                partial[path] = dumped
+        return partial
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Compact serializable state (no per-chunk reasoning), e.g. a child workflow result."""
+        return {
+            "chunks_count": self.chunks_count,
+            "votes": {
+                field: [{"text": text, "count": v["count"], "item": v["item"].model_dump()} for text, v in votes.items()]
+                for field, votes in self._votes.items()
+            },
+            "essence": self._essence.model_dump() if self._essence is not None else None,
+            "lists": {path: [item.model_dump() for item in items] for path, items in self._lists.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, state: Dict[str, Any]) -> "ExtractionAccumulator":
+        accumulator = cls()
+        accumulator.chunks_count = state.get("chunks_count", 0)
+        for field, votes in state.get("votes", {}).items():
+            for vote in votes:
+                accumulator._vote(field, vote["text"], vote["count"], SourceText(**vote["item"]))
+        if state.get("essence"):
+            accumulator._essence = SourceText(**state["essence"])
+        for path, items in state.get("lists", {}).items():
+            accumulator._append_items(path, [SourceText(**item) for item in items])
+        return accumulator
+
+    def result(self) -> ExtractedTZData:
+        merged = ExtractedTZData()
+        best_client = self._best_vote("client_name")
+        if best_client:
+            merged.client_name = best_client
+        if self._essence is not None:
+            merged.project_essence = self._essence
+        best_type = self._best_vote("project_type")
+        if best_type:
+            merged.project_type = best_type
+
+        for field in LIST_FIELDS:
+            setattr(merged, field, list(self._lists[field]))
+        merged.key_features = KeyFeaturesDetails(**{
+            c: list(self._lists[f"key_features.{c}"]) for c in KEY_FEATURE_FIELDS
+        })
+        return merged
+
+
+def list_at(data: Dict[str, Any], path: str) -> List[Any]:
+    """Returns the list at a LIST_PATHS path of an ExtractedTZData-shaped dict (empty if missing)."""
+    if path.startswith("key_features."):
+        return (data.get("key_features") or {}).get(path.split(".", 1)[1]) or []
+    return data.get(path) or []
+
+
+def overlay_list_items(data: Dict[str, Any], items: Dict[str, Dict[int, dict]]) -> Dict[str, Any]:
+    """Replaces list items in an ExtractedTZData dict by {path: {index: item}} (e.g. RAG-enriched copies)."""
+    for path, by_index in items.items():
+        target = list_at(data, path)
+        for index, item in by_index.items():
+            if index < len(target):
+                target[index] = item
+    return data
+
+
 def merge_extracted_data(data_list: List[ExtractedTZData]) -> ExtractedTZData:
     """
     Merges multiple ExtractedTZData objects into one.
-    Improvements:
-    - Client Name: Filter 'Unknown', pick most frequent or longest.
+    - Client Name: Filter 'Unknown', pick most frequent.
+    - Project Essence: Longest (most descriptive).
     - Project Type: Most frequent.
+    - Lists: Deduplicated (case-insensitive), first occurrence wins.
     """
-    start_data = ExtractedTZData()
-    
-    # Helper for voting
-    from collections import Counter
-    
-    def get_best_value(items, invalid_values=None):
-        if invalid_values is None: 
-            invalid_values = []
-        
-        # Filter
-        valid_items = [
-            item for item in items 
-            if item.text and item.text.strip() not in invalid_values
-        ]
-        
-        if not valid_items:
-            return None
-            
-        # Count occurrences of normalized text
-        values = [i.text.strip() for i in valid_items]
-        counts = Counter(values)
-        
-        # Get most common
-        most_common_text, _ = counts.most_common(1)[0]
-        
-        # Find the original object that matches this text (prefer one with source if possible)
-        for item in valid_items:
-            if item.text.strip() == most_common_text:
-                return item
-        return valid_items[0]
-
-    # 1. Merge Client Name
-    bad_names = ["Unknown Client", "Unknown", "Не указан", "Нет", "N/A", "Client Name"]
-    best_client = get_best_value([d.client_name for d in data_list], bad_names)
-    if best_client:
-        start_data.client_name = best_client
-        
-    # 2. Merge Project Essence (Select longest as it's likely most descriptive)
-    candidates_essence = [d.project_essence for d in data_list if d.project_essence.text not in ["Unknown Essence", "", "N/A"]]
-    if candidates_essence:
-        start_data.project_essence = max(candidates_essence, key=lambda x: len(x.text))
-        
-    # 3. Merge Project Type (Voting)
-    candidates_type = [d.project_type for d in data_list]
-    best_type = get_best_value(candidates_type, ["Other", "Unknown", ""])
-    if best_type:
-        start_data.project_type = best_type
-
-    # 4. Merge Lists (business_goals, tech_stack, client_integrations)
-    def merge_source_text_lists(lists: List[List[SourceText]]) -> List[SourceText]:
-        seen_map = {} # text -> index in merged list
-        merged = []
-        
-        for l in lists:
-            for item in l:
-                clean_text = item.text.strip() # Case sensitive or insensitive? Let's keep sensitive for now but strip
-                if not clean_text:
-                    continue
-                
-                key = clean_text.lower()
-                if key not in seen_map:
-                    seen_map[key] = len(merged)
-                    merged.append(item)
-                    
-        return merged
+    accumulator = ExtractionAccumulator()
+    for data in data_list:
+        accumulator.add(data)
+    return accumulator.result()
 
-    start_data.business_goals = merge_source_text_lists([d.business_goals for d in data_list])
-    start_data.tech_stack = merge_source_text_lists([d.tech_stack for d in data_list])
-    start_data.client_integrations = merge_source_text_lists([d.client_integrations for d in data_list])
-    
-    # 5. Merge Key Features (KeyFeaturesDetails)
-    kf_merged = KeyFeaturesDetails(
-        modules=merge_source_text_lists([d.key_features.modules for d in data_list]),
-        screens=merge_source_text_lists([d.key_features.screens for d in data_list]),
-        reports=merge_source_text_lists([d.key_features.reports for d in data_list]),
-        integrations=merge_source_text_lists([d.key_features.integrations for d in data_list]),
-        nfr=merge_source_text_lists([d.key_features.nfr for d in data_list]),
+
+def _item_texts(value: Any) -> List[str]:
+    """Texts of a list field in either shape: backend list of {text, ...}/str, or the UI's newline-joined string."""
+    if isinstance(value, str):
+        lines = value.split("\n")
+    elif isinstance(value, list):
+        lines = [v.get("text", "") if isinstance(v, dict) else str(v) for v in value]
+    elif isinstance(value, dict):
+        # key_features by category (the UI flattens categories in the same order)
+        lines = [text for items in value.values() for text in _item_texts(items)]
+    else:
+        lines = []
+    return [line.strip() for line in lines if line and line.strip()]
+
+
+def proposal_inputs(data: Dict[str, Any], budget_matrix: Dict[str, Dict[str, Any]], rates: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Canonical view of what generate_proposal_activity reads from its inputs.
+    Equal for extracted_data and the same data after the UI's formatting round trip,
+    so it tells whether a proposal drafted from the suggestions is still valid after approval.
+    """
+    essence = (data or {}).get("project_essence") or ""
+    if isinstance(essence, dict):
+        essence = essence.get("text", "")
+    budget_rows = sorted(
+        (stage, role, float(hours), float((rates or {}).get(role, 0) or 0))
+        for stage, roles_hours in (budget_matrix or {}).items()
+        for role, hours in (roles_hours or {}).items()
+        if float(hours or 0) > 0
     )
-    start_data.key_features = kf_merged
-    
-    return start_data
+    return {
+        "project_essence": str(essence).strip(),
+        "business_goals": _item_texts((data or {}).get("business_goals")),
+        "key_features": _item_texts((data or {}).get("key_features")),
+        "tech_stack": _item_texts((data or {}).get("tech_stack")),
+        "budget": [list(row) for row in budget_rows],
+    }
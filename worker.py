@@ -7,36 +7,54 @@ from activities import (
     generate_proposal_activity,
     save_budget_stub,
     ocr_document_activity,
-    index_document_activity, # Replaced split_text
+    split_document_activity,
+    index_document_activity,
+    index_documents_activity,
     extract_chunk_activity,
     merge_data_activity,
     analyze_project_activity,
     analyze_requirements_chunk_activity, # New
     refine_requirements_activity, # New
     enrich_with_rag_activity, # RAG enrichment
-    classify_manager_notes_activity # Manager notes classification
+    classify_manager_notes_activity, # Manager notes classification
+    load_cached_analysis_activity,
+    store_cached_analysis_activity,
+    gpu_backlog_activity
 )
-from workflows import ProposalWorkflow
+from workflows import ProposalWorkflow, ExtractionWorkflow
+from fair_scheduler import FairShareInterceptor, UserHeaderInterceptor, GPU_WORKER_SLOTS
+from metrics import ActivityMetricsInterceptor, start_metrics_server
+from llm_service import LLMService
 
 async def main():
     client = await Client.connect("temporal-server:7233") #подключение к темпорал серверу
+    start_metrics_server() # Prometheus: /metrics на WORKER_METRICS_PORT
 #добавить 2 воркера: 1 для обычной очереди другой для gpu
     worker_cpu = Worker(
         client,
         task_queue="proposal-queue",
-        workflows=[ProposalWorkflow],
+        workflows=[ProposalWorkflow, ExtractionWorkflow],
+        interceptors=[UserHeaderInterceptor(), ActivityMetricsInterceptor()], # Stamps the uploading user onto activity headers
         activities=[
             parse_file_activity, 
             save_budget_stub, 
-            index_document_activity, # Replaced split_text
-            merge_data_activity
+            split_document_activity, # Fast split, returns chunk defs
+            index_document_activity, # RAG indexing, runs in parallel with extraction
+            index_documents_activity, # Same for a batch upload: all files into one table
+            merge_data_activity,
+            load_cached_analysis_activity, # Content-addressed analysis cache
+            store_cached_analysis_activity,
+            gpu_backlog_activity # Speculative draft skips a backed-up GPU
         ]
     )
     
     worker_gpu = Worker(
         client,
         task_queue="gpu-queue",
-        max_concurrent_activities=5,
+        # Worker holds many tasks; FairScheduler admits GPU_CONCURRENCY of them to the LLM, round-robin per user
+        max_concurrent_activities=GPU_WORKER_SLOTS,
+        # Metrics go after the fair scheduler: activity durations exclude the wait for an LLM slot
+        interceptors=[FairShareInterceptor(), ActivityMetricsInterceptor()],
         # workflow тут не нужен, только активности
         activities=[
             ocr_document_activity, 
@@ -51,7 +69,10 @@ async def main():
         ]
     )
     print("Workers started")
-    await asyncio.gather(worker_cpu.run(), worker_gpu.run())
+    try:
+        await asyncio.gather(worker_cpu.run(), worker_gpu.run())
+    finally:
+        await LLMService().close() # Pooled keep-alive connections to the LLM server
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -1,20 +1,333 @@
 
 from datetime import timedelta
 import asyncio
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from temporalio import workflow
+from temporalio.common import SearchAttributeKey
+from temporalio.exceptions import ActivityError, ChildWorkflowError
 from activities import (
     parse_file_activity,
     estimate_hours_activity,
     generate_proposal_activity,
     save_budget_stub,
     ocr_document_activity,
+    split_document_activity,
     index_document_activity,
+    index_documents_activity,
     extract_chunk_activity,
     merge_data_activity,
     enrich_with_rag_activity,
     analyze_project_activity,
-    classify_manager_notes_activity
+    classify_manager_notes_activity,
+    load_cached_analysis_activity,
+    store_cached_analysis_activity,
+    gpu_backlog_activity,
+    EXTRACT_SECONDS_KEY
 )
+from schemas import ExtractedTZData
+from utils_text import ExtractionAccumulator, list_at, overlay_list_items, proposal_inputs
+
+# --- Extraction concurrency (sliding window over gpu-queue) ---
+# Read once at import time (env access is only restricted at workflow runtime by the sandbox)
+EXTRACT_WINDOW_INITIAL = int(os.getenv("EXTRACT_WINDOW_INITIAL", 2))
+EXTRACT_WINDOW_MIN = int(os.getenv("EXTRACT_WINDOW_MIN", 1))
+EXTRACT_WINDOW_MAX = int(os.getenv("EXTRACT_WINDOW_MAX", 4))
+# Shrink the window when chunk latency grows beyond this factor of the best observed latency
+EXTRACT_LATENCY_SLOWDOWN = float(os.getenv("EXTRACT_LATENCY_SLOWDOWN", 1.5))
+
+# Large documents: extraction fans out to ExtractionWorkflow children, each owning a range
+# of chunks and returning a compact merged summary, so parent history stays bounded
+EXTRACT_CHILD_THRESHOLD = int(os.getenv("EXTRACT_CHILD_THRESHOLD", 24))
+EXTRACT_CHUNKS_PER_CHILD = int(os.getenv("EXTRACT_CHUNKS_PER_CHILD", 8))
+# Children running at once; they split the EXTRACT_WINDOW_MAX budget, so the next child's
+# chunks keep the LLM busy while the previous child drains its last ones
+EXTRACT_CHILD_CONCURRENCY = int(os.getenv("EXTRACT_CHILD_CONCURRENCY", 2))
+
+# Long activities heartbeat every ~15s (activities.heartbeating); a worker crash is
+# detected after this timeout instead of the full start_to_close_timeout
+HEARTBEAT_TIMEOUT = timedelta(seconds=int(os.getenv("ACTIVITY_HEARTBEAT_TIMEOUT", 60)))
+# gpu-queue activities wait for a fair LLM slot inside the activity (fair_scheduler.py),
+# and that wait counts against start_to_close_timeout: it is added on top of the run time.
+# Waiting activities heartbeat, so a lost worker is still detected by HEARTBEAT_TIMEOUT
+GPU_QUEUE_WAIT = timedelta(minutes=int(os.getenv("GPU_QUEUE_MAX_WAIT_MINUTES", 120)))
+
+# Status published as search attributes, so /api/history is one visibility list call.
+# Both must be registered on the namespace (see temporal-server in docker-compose.yml)
+SEARCH_ATTRIBUTES_ENABLED = os.getenv("KP_SEARCH_ATTRIBUTES", "true").lower() == "true"
+KP_STATUS_ATTR = SearchAttributeKey.for_keyword("KpStatus")
+KP_USER_ATTR = SearchAttributeKey.for_keyword("KpUser")
+
+# Admission control (admission.py): a queued document waits for the admit signal;
+# after this long it starts anyway, so a stalled dispatcher cannot strand uploads
+ADMISSION_MAX_QUEUE_WAIT = timedelta(hours=int(os.getenv("ADMISSION_MAX_QUEUE_HOURS", 6)))
+
+# Marker of the current pipeline in workflow histories. Workflows started before it (parse ->
+# index -> one-by-one extraction -> merge activity, no cache/admission/draft commands) replay
+# on ProposalWorkflow._run_legacy. Drop the legacy path (workflow.deprecate_patch) once none are left
+PIPELINE_PATCH = "kp-pipeline-v2"
+
+# Speculative draft: while waiting for approval, generate the proposal from the suggested
+# budget; approval with unchanged data/budget/rates returns it without another LLM call
+SPECULATIVE_DRAFT = os.getenv("SPECULATIVE_DRAFT", "true").lower() == "true"
+# The draft is a full GPU generation the user may never approve: skip it when the gpu-queue
+# backlog is above this. While it runs, KpStatus is DRAFTING, so admission counts it as active
+DRAFT_MAX_GPU_BACKLOG = int(os.getenv("DRAFT_MAX_GPU_BACKLOG", 8))
+DRAFTING_STATUS = "DRAFTING"
+# Workflows that reached WAITING_FOR_HUMAN before the backlog check/DRAFTING status replay without them
+DRAFT_ADMISSION_PATCH = "kp-draft-admission"
+# Must match defaultRates in frontend/src/AgentKP.jsx (the rates the approval form starts with)
+DEFAULT_ROLE_RATES = {
+    "Менеджер проекта": 2500, "Системный аналитик": 2800,
+    "Дизайнер UI/UX": 2800, "Frontend-разработчик": 3000,
+    "Backend-разработчик": 3000, "Fullstack-разработчик": 3200,
+    "ML-инженер": 3500, "DevOps-инженер": 3200, "QA-инженер": 2200,
+}
+DEFAULT_ROLE_RATE = 2500
+
+class AdaptiveWindow:
+    """
+    AIMD controller for the number of chunk extractions in flight.
+
+    - Failed chunk (activity error or empty result): halve the window.
+    - Latency (seconds per KB of chunk) above slowdown x best observed: shrink by one,
+      the LLM server is saturated and extra parallelism only queues up.
+    - Otherwise grow by one after a full window of healthy completions.
+
+    Durations come from activity results (time after the fair GPU slot was taken), or
+    workflow.now() for results recorded without one, so it is replay-safe.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, slowdown: float):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.size = min(max(initial, self.minimum), self.maximum)
+        self.slowdown = slowdown
+        self.avg_latency: Optional[float] = None  # EWMA, seconds per KB
+        self.avg_chunk_seconds: Optional[float] = None  # EWMA, seconds per chunk (for ETA)
+        self.best_latency: Optional[float] = None
+        self.completed = 0
+        self.failed = 0
+        self._healthy_streak = 0
+
+    def record(self, elapsed: float, size_kb: float, ok: bool, wall: Optional[float] = None):
+        """elapsed: model time of the chunk (latency control); wall: including queueing (ETA), default elapsed."""
+        self.completed += 1
+        wall = elapsed if wall is None else wall
+        if self.avg_chunk_seconds is None:
+            self.avg_chunk_seconds = wall
+        else:
+            self.avg_chunk_seconds = 0.7 * self.avg_chunk_seconds + 0.3 * wall
+        if not ok:
+            self.failed += 1
+            self._healthy_streak = 0
+            self.size = max(self.minimum, self.size // 2)
+            return
+
+        latency = elapsed / size_kb
+        if self.avg_latency is None:
+            self.avg_latency = latency
+        else:
+            self.avg_latency = 0.7 * self.avg_latency + 0.3 * latency
+        # Baseline drifts up slowly so a permanently slower server (longer chunks,
+        # other tenants) is not treated as saturation forever
+        if self.best_latency is None:
+            self.best_latency = self.avg_latency
+        else:
+            self.best_latency = min(self.avg_latency, self.best_latency * 1.05)
+
+        if self.avg_latency > self.best_latency * self.slowdown:
+            self._healthy_streak = 0
+            self.size = max(self.minimum, self.size - 1)
+            return
+
+        self._healthy_streak += 1
+        if self._healthy_streak >= self.size and self.size < self.maximum:
+            self._healthy_streak = 0
+            self.size += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "completed": self.completed,
+            "failed": self.failed,
+            "size": self.size,
+            "avg_chunk_seconds": self.avg_chunk_seconds
+        }
+
+    def absorb(self, stats: Dict[str, Any]):
+        """Takes over counters and the final window size reported by a child workflow."""
+        self.completed += stats.get("completed", 0)
+        self.failed += stats.get("failed", 0)
+        self.size = min(max(stats.get("size", self.size), self.minimum), self.maximum)
+        if stats.get("avg_chunk_seconds") is not None:
+            self.avg_chunk_seconds = stats["avg_chunk_seconds"]
+
+
+async def extract_chunks_windowed(
+    chunks_defs: List[Dict[str, Any]],
+    window: AdaptiveWindow,
+    on_result: Optional[Callable[[int, Optional[dict]], None]] = None
+) -> List[Optional[dict]]:
+    """
+    Runs extract_chunk_activity over all chunks with at most window.size in flight.
+    A new chunk starts as soon as any running one finishes. Results keep chunk order;
+    on_result(index, result) is called as each chunk completes.
+    """
+    results: List[Optional[dict]] = [None] * len(chunks_defs)
+    in_flight = 0
+
+    async def _extract_one(index: int, chunk_def: Dict[str, Any]):
+        nonlocal in_flight
+        started = workflow.now()
+        result = None
+        try:
+            result = await workflow.execute_activity(
+                extract_chunk_activity,
+                args=[chunk_def],
+                task_queue="gpu-queue",
+                start_to_close_timeout=GPU_QUEUE_WAIT + timedelta(minutes=60),
+                heartbeat_timeout=HEARTBEAT_TIMEOUT
+            )
+        except ActivityError as e:
+            workflow.logger.warning(f"Chunk {index} extraction failed: {e}")
+        finally:
+            in_flight -= 1
+
+        wall = (workflow.now() - started).total_seconds()
+        elapsed = wall
+        if result is not None:
+            # Without the wait for a fair GPU slot: queueing behind other users is not saturation
+            elapsed = result.pop(EXTRACT_SECONDS_KEY, wall)
+        size_kb = max(1.0, (chunk_def["end"] - chunk_def["start"]) / 1024)
+        window.record(elapsed, size_kb, result is not None, wall)
+        results[index] = result
+        if on_result is not None:
+            on_result(index, result)
+
+    tasks = []
+    for index, chunk_def in enumerate(chunks_defs):
+        await workflow.wait_condition(lambda: in_flight < window.size)
+        in_flight += 1
+        tasks.append(asyncio.create_task(_extract_one(index, chunk_def)))
+
+    await asyncio.gather(*tasks)
+    return results
+
+
+class StreamingMerge:
+    """
+    Streaming Reduce phase: folds chunk results into an ExtractionAccumulator in chunk
+    order as they complete, and starts RAG enrichment for newly folded list items right
+    away (folded items never change, so they are safe to enrich before the last chunk).
+    Enrichment waits for the vector index task, which runs in parallel with extraction.
+    """
+
+    def __init__(self, index_task: Optional[asyncio.Task] = None, enrich: bool = True):
+        self.accumulator = ExtractionAccumulator()
+        self._index_task = index_task
+        self._enrich_enabled = enrich
+        self._pending: Dict[int, Optional[dict]] = {}
+        self._next_index = 0
+        self._enriched: Dict[str, Dict[int, dict]] = {}
+        self._enrich_tasks: List[asyncio.Task] = []
+
+    def on_result(self, index: int, result: Optional[dict]):
+        self._pending[index] = result
+        # Fold only the contiguous prefix so the merge result does not depend on completion order
+        while self._next_index in self._pending:
+            chunk = self._pending.pop(self._next_index)
+            self._next_index += 1
+            if chunk is None:
+                continue
+            try:
+                new_ranges = self.accumulator.add(ExtractedTZData(**chunk))
+            except Exception as e:
+                workflow.logger.error(f"Merge Failed for chunk {self._next_index - 1}: {e}")
+                continue
+            self._schedule_enrichment(new_ranges)
+
+    def on_partial(self, state: Dict[str, Any]):
+        """Folds a partial merge of the next chunk range (ExtractionAccumulator.to_dict())."""
+        try:
+            new_ranges = self.accumulator.combine(ExtractionAccumulator.from_dict(state))
+        except Exception as e:
+            workflow.logger.error(f"Merge Failed for partial result: {e}")
+            return
+        self._schedule_enrichment(new_ranges)
+
+    def _schedule_enrichment(self, new_ranges: Dict[str, Tuple[int, int]]):
+        if not new_ranges or not self._enrich_enabled:
+            return
+        previous = self._enrich_tasks[-1] if self._enrich_tasks else None
+        self._enrich_tasks.append(asyncio.create_task(self._enrich(new_ranges, previous)))
+
+    async def _index_ready(self) -> bool:
+        if self._index_task is None:
+            return True
+        try:
+            index_info = await self._index_task
+        except ActivityError as e:
+            workflow.logger.warning(f"Indexing failed, skipping RAG enrichment: {e}")
+            return False
+        return bool(index_info) and index_info.get("status") == "indexed"
+
+    async def _enrich(self, ranges: Dict[str, Tuple[int, int]], previous: Optional[asyncio.Task]):
+        # One enrichment at a time: they share gpu-queue slots with extraction
+        if previous is not None:
+            await previous
+        if not await self._index_ready():
+            return
+        try:
+            enriched = await workflow.execute_activity(
+                enrich_with_rag_activity,
+                args=[self.accumulator.items(ranges)],
+                task_queue="gpu-queue",
+                start_to_close_timeout=GPU_QUEUE_WAIT + timedelta(minutes=5),
+                heartbeat_timeout=HEARTBEAT_TIMEOUT
+            )
+        except ActivityError as e:
+            workflow.logger.warning(f"RAG enrichment failed for {list(ranges)}: {e}")
+            return
+        for path, (start, _end) in ranges.items():
+            for offset, item in enumerate(list_at(enriched, path)):
+                self._enriched.setdefault(path, {})[start + offset] = item
+
+    async def result(self) -> dict:
+        """Waits for indexing and outstanding enrichments, returns the merged, enriched data dict."""
+        await self._index_ready()
+        await asyncio.gather(*self._enrich_tasks)
+        merged = self.accumulator.result().model_dump()
+        return overlay_list_items(merged, self._enriched)
+
+
+@workflow.defn
+class ExtractionWorkflow:
+    """
+    Child workflow for large documents: extracts one range of chunks and returns only a
+    compact merged summary (no per-chunk dumps or reasoning) plus window statistics.
+    """
+
+    def __init__(self):
+        self._window: Optional[AdaptiveWindow] = None
+
+    @workflow.run
+    async def run(
+        self,
+        chunks_defs: List[Dict[str, Any]],
+        initial_window: int = EXTRACT_WINDOW_INITIAL,
+        max_window: int = EXTRACT_WINDOW_MAX
+    ) -> dict:
+        window = AdaptiveWindow(initial_window, EXTRACT_WINDOW_MIN, max_window, EXTRACT_LATENCY_SLOWDOWN)
+        self._window = window
+        merge = StreamingMerge(enrich=False)
+        await extract_chunks_windowed(chunks_defs, window, on_result=merge.on_result)
+        return {"merge": merge.accumulator.to_dict(), "stats": window.stats()}
+
+    @workflow.query
+    def get_progress(self) -> dict:
+        """Window statistics so far; the API adds them to the parent's progress (progress.py)."""
+        return self._window.stats() if self._window else {}
+
 
 @workflow.defn
 class ProposalWorkflow:
@@ -31,6 +344,17 @@ class ProposalWorkflow:
         self.suggested_stages = None  # AI Suggestions
         self.suggested_roles = None  # AI Suggestions
         self.additional_notes = ""  # Free-text user notes
+        self.version = 0  # Bumped on every visible state change (ETag of /api/status)
+        self.queued_until = None  # Estimated start (ISO) while QUEUED by admission control
+        self.is_admitted = False
+        # Progress tracking (see get_progress)
+        self.current_stage = None
+        self.stage_times = {}  # stage -> {"started_at": datetime, "finished_at": datetime | None}
+        self.chunks_total = 0
+        self._window: Optional[AdaptiveWindow] = None
+        self._extract_children: List[str] = []  # Running ExtractionWorkflow ids (queried for progress)
+        # False if any step fell back (skipped file, failed chunk, failed analysis): not cached then
+        self._analysis_complete = True
     
     @workflow.query
     def get_data(self):
@@ -43,118 +367,371 @@ class ProposalWorkflow:
             "suggested_hours": self.suggested_hours,
             "suggested_stages": self.suggested_stages,
             "suggested_roles": self.suggested_roles,
-            "additional_notes": self.additional_notes
+            "additional_notes": self.additional_notes,
+            "queued_until": self.queued_until,
+            "version": self.version
         }
+
+    @workflow.query
+    def get_status_version(self) -> dict:
+        """Cheap check before get_data: the payload only changes when version moves."""
+        return {"status": self.status, "version": self.version}
     
+    @workflow.query
+    def get_progress(self) -> dict:
+        """
+        Lightweight progress (no data payload): stage timestamps, chunk counters, running
+        extraction children. workflow.now() is frozen at the last workflow task inside a
+        query, so elapsed time and the ETA are computed by the API (progress.py).
+        """
+        stages = {
+            name: {
+                "started_at": times["started_at"].isoformat(),
+                "finished_at": times["finished_at"].isoformat() if times["finished_at"] else None
+            }
+            for name, times in self.stage_times.items()
+        }
+        window = self._window
+        return {
+            "status": self.status,
+            "stage": self.current_stage,
+            "stages": stages,
+            "chunks_total": self.chunks_total,
+            "chunks_done": window.completed if window else 0,
+            "chunks_failed": window.failed if window else 0,
+            "window_size": window.size if window else 0,
+            "avg_chunk_seconds": round(window.avg_chunk_seconds, 1) if window and window.avg_chunk_seconds else None,
+            "children": list(self._extract_children)
+        }
+
+    def _set_status(self, status: str):
+        self.status = status
+        self.version += 1
+        self._publish_status(status)
+
+    def _publish_status(self, status: str):
+        if SEARCH_ATTRIBUTES_ENABLED:
+            workflow.upsert_search_attributes([KP_STATUS_ATTR.value_set(status)])
+
+    def _enter_stage(self, stage: str):
+        """Marks the start of a pipeline stage (and the end of the previous one)."""
+        now = workflow.now()
+        if self.current_stage in self.stage_times:
+            self.stage_times[self.current_stage]["finished_at"] = now
+        self.current_stage = stage
+        self.stage_times[stage] = {"started_at": now, "finished_at": None}
+        # Data fields (preview, extracted data, suggestions) are written right before a stage change
+        self.version += 1
+
     @workflow.signal
     def user_approve_signal(self, payload: dict):
         self.extracted_data = payload.get("updated_data")
         self.budget = payload.get("budget")
         self.rates = payload.get("rates")
         self.is_approved = True
+        self.version += 1
+
+    @workflow.signal
+    def admit_signal(self):
+        self.is_admitted = True
+
+    async def _wait_for_admission(self, queued_until: str):
+        """Admission control queued this upload: wait for a GPU slot (admit signal from the API)."""
+        self.queued_until = queued_until
+        self._set_status("QUEUED")
+        self._enter_stage("queued")
+        try:
+            await workflow.wait_condition(lambda: self.is_admitted, timeout=ADMISSION_MAX_QUEUE_WAIT)
+        except asyncio.TimeoutError:
+            workflow.logger.warning("Not admitted within ADMISSION_MAX_QUEUE_HOURS, starting anyway")
+        self.queued_until = None
+        self._set_status("PROCESSING")
         
-    @workflow.run
-    async def run(self, file_path: str, file_name: str, convert_to_pdf_for_pages: bool = True, additional_notes: str = ""):
-        self.additional_notes = additional_notes
+    def _analysis_snapshot(self) -> dict:
+        """Part of the state that is reusable for an identical document (content-addressed cache)."""
+        return {
+            "extracted_data": self.extracted_data,
+            "raw_text_length": self.raw_text_length,
+            "suggested_hours": self.suggested_hours,
+            "suggested_stages": self.suggested_stages,
+            "suggested_roles": self.suggested_roles
+        }
+
+    def _restore_analysis(self, snapshot: dict):
+        self.extracted_data = snapshot.get("extracted_data")
+        self.raw_text_length = snapshot.get("raw_text_length", 0)
+        self.suggested_hours = snapshot.get("suggested_hours")
+        self.suggested_stages = snapshot.get("suggested_stages")
+        self.suggested_roles = snapshot.get("suggested_roles")
+        self.raw_text_preview = "Reused analysis of an identical document"
+
+    async def _start_draft(self) -> Optional[Tuple[dict, asyncio.Task]]:
+        """
+        Starts generating a proposal from the suggested hours and default rates (what the
+        approval form shows), unless the GPU is already backed up. KpStatus is DRAFTING
+        while the draft runs; self.status stays WAITING_FOR_HUMAN for the UI.
+        """
+        if not self.suggested_hours or not self.extracted_data:
+            return None
+        roles = self.suggested_roles or sorted({r for hours in self.suggested_hours.values() for r in hours})
+        stages = self.suggested_stages or list(self.suggested_hours)
+        budget = {s: {r: (self.suggested_hours.get(s) or {}).get(r, 0) or 0 for r in roles} for s in stages}
+        rates = {r: DEFAULT_ROLE_RATES.get(r, DEFAULT_ROLE_RATE) for r in roles}
+        args = [self.extracted_data, budget, rates, self.additional_notes]
+        if not workflow.patched(DRAFT_ADMISSION_PATCH):
+            task = workflow.start_activity(
+                generate_proposal_activity,
+                args=args,
+                task_queue="gpu-queue",
+                start_to_close_timeout=GPU_QUEUE_WAIT + timedelta(minutes=10),
+                heartbeat_timeout=HEARTBEAT_TIMEOUT
+            )
+            return proposal_inputs(self.extracted_data, budget, rates), task
+
+        try:
+            backlog = await workflow.execute_activity(
+                gpu_backlog_activity,
+                task_queue="proposal-queue",
+                start_to_close_timeout=timedelta(seconds=10)
+            )
+        except ActivityError:
+            backlog = None  # Unknown: same as admission, draft anyway
+        if backlog is not None and backlog > DRAFT_MAX_GPU_BACKLOG:
+            workflow.logger.info(f"gpu-queue backlog {backlog} > {DRAFT_MAX_GPU_BACKLOG}, no speculative draft")
+            return None
+
+        self._publish_status(DRAFTING_STATUS)
+        task = asyncio.create_task(self._run_draft(args))
+        return proposal_inputs(self.extracted_data, budget, rates), task
+
+    async def _run_draft(self, args: list) -> str:
+        try:
+            return await workflow.execute_activity(
+                generate_proposal_activity,
+                args=args,
+                task_queue="gpu-queue",
+                start_to_close_timeout=GPU_QUEUE_WAIT + timedelta(minutes=10),
+                heartbeat_timeout=HEARTBEAT_TIMEOUT
+            )
+        finally:
+            # Draft done (or failed) before approval: the document no longer holds the GPU
+            if self.status == "WAITING_FOR_HUMAN":
+                self._publish_status("WAITING_FOR_HUMAN")
+
+    async def _take_draft(self, draft: Tuple[dict, asyncio.Task]) -> Optional[str]:
+        """Returns the draft if the approved inputs match it; otherwise cancels it (None -> regenerate)."""
+        draft_inputs, task = draft
+        if proposal_inputs(self.extracted_data, self.budget, self.rates) != draft_inputs:
+            workflow.logger.info("Approved data differs from the suggestions, regenerating proposal")
+            task.cancel()
+            return None
+        try:
+            proposal = await task
+        except ActivityError as e:
+            workflow.logger.warning(f"Draft proposal failed, regenerating: {e}")
+            return None
+        if proposal == "Error generating proposal.":
+            return None
+        workflow.logger.info("Approved data matches the suggestions, using draft proposal")
+        return proposal
+
+    async def _extract_with_children(self, chunks_defs: List[Dict[str, Any]], window: AdaptiveWindow, merge: StreamingMerge):
+        """
+        Large documents: one ExtractionWorkflow child per EXTRACT_CHUNKS_PER_CHILD chunks.
+        Up to EXTRACT_CHILD_CONCURRENCY children run at once, each with an equal share of
+        the EXTRACT_WINDOW_MAX window budget; a new child starts as soon as one finishes,
+        from the window size that child ended with. Summaries are folded in chunk order,
+        and only they enter this workflow's history.
+        """
+        ranges = list(range(0, len(chunks_defs), EXTRACT_CHUNKS_PER_CHILD))
+        parallel = max(1, min(EXTRACT_CHILD_CONCURRENCY, len(ranges)))
+        share = max(EXTRACT_WINDOW_MIN, EXTRACT_WINDOW_MAX // parallel)
+        workflow.logger.info(
+            f"Large document ({len(chunks_defs)} chunks): extracting in {len(ranges)} child workflows, {parallel} at a time"
+        )
+        pending: Dict[int, dict] = {}
+        next_number = 0
+        running = 0
+
+        async def _run_child(number: int, start: int):
+            nonlocal next_number, running
+            child_id = f"{workflow.info().workflow_id}-extract-{number}"
+            child_chunks = chunks_defs[start:start + EXTRACT_CHUNKS_PER_CHILD]
+            self._extract_children.append(child_id)
+            try:
+                summary = await workflow.execute_child_workflow(
+                    ExtractionWorkflow.run,
+                    args=[child_chunks, min(window.size, share), share],
+                    id=child_id,
+                    task_queue="proposal-queue"
+                )
+                window.absorb(summary["stats"])
+                pending[number] = summary["merge"]
+            except ChildWorkflowError as e:
+                # Like a failed chunk: the range is missing from the analysis, the rest goes on
+                workflow.logger.warning(f"Extraction child {child_id} failed, its {len(child_chunks)} chunks are skipped: {e}")
+                window.absorb({"completed": len(child_chunks), "failed": len(child_chunks)})
+                self._analysis_complete = False
+                pending[number] = None
+            finally:
+                self._extract_children.remove(child_id)
+                running -= 1
+            # Fold only the contiguous prefix so the merge result does not depend on completion order
+            while next_number in pending:
+                partial = pending.pop(next_number)
+                next_number += 1
+                if partial is not None:
+                    merge.on_partial(partial)
+
+        tasks = []
+        for number, start in enumerate(ranges):
+            await workflow.wait_condition(lambda: running < parallel)
+            running += 1
+            tasks.append(asyncio.create_task(_run_child(number, start)))
+        await asyncio.gather(*tasks)
+
+    async def _parse_file(self, file_path: str, file_name: str, convert_to_pdf_for_pages: bool, batch: bool) -> Optional[str]:
+        """Docling parse with OCR fallback. Returns the path to the MD file (empty if both failed)."""
         # 1. Parsing (CPU/Docling) - Returns Path to MD file now
         md_file_path = await workflow.execute_activity(
             parse_file_activity,
             args=[file_path, file_name, convert_to_pdf_for_pages],
             task_queue="proposal-queue",
-            start_to_close_timeout=timedelta(minutes=10) # Increased for larger files
+            start_to_close_timeout=timedelta(minutes=30), # Large PDFs are parsed in checkpointed page ranges
+            heartbeat_timeout=HEARTBEAT_TIMEOUT
         )
         
         # 2. OCR Fallback (if needed)
         if not md_file_path:
              workflow.logger.info(f"Parsing failed or empty. Trying OCR for {file_path}")
+             if not batch:  # Batch: other files are still parsing, the stage stays "parsing"
+                 self._enter_stage("ocr")
              md_file_path = await workflow.execute_activity(
                 ocr_document_activity,
                 args=[file_path],
                 task_queue="gpu-queue",
-                start_to_close_timeout=timedelta(minutes=10)
+                start_to_close_timeout=GPU_QUEUE_WAIT + timedelta(minutes=10),
+                heartbeat_timeout=HEARTBEAT_TIMEOUT
             )
+        return md_file_path
 
-        if not md_file_path:
-             self.status = "ERROR: Failed to parse document"
+    async def _analyze_document(self, files: List[Tuple[str, str]], convert_to_pdf_for_pages: bool) -> Optional[str]:
+        """
+        Parsing -> Extraction -> Analysis -> Estimation.
+        files: (path, name) of the ТЗ followed by its appendices (batch upload). All files are
+        parsed in parallel, indexed into one RAG table and extracted as one union of chunks,
+        so a tender gets a single analysis/estimation pass and a single proposal.
+        Returns None on success, or the workflow result for an early exit.
+        """
+        batch = len(files) > 1
+        self._enter_stage("parsing")
+        parsed = await asyncio.gather(*(
+            self._parse_file(path, name, convert_to_pdf_for_pages, batch) for path, name in files
+        ))
+        md_file_paths = [md for md in parsed if md]
+        for (path, name), md in zip(files, parsed):
+            if not md and batch:
+                workflow.logger.warning(f"Batch: skipping unparseable file {name}")
+                self._analysis_complete = False
+
+        if not md_file_paths:
+             self._set_status("ERROR: Failed to parse document")
+             self._enter_stage("failed")
              return "Extraction Failed"
 
         # Set placeholder preview
-        self.raw_text_preview = f"File processed successfully. Path: {md_file_path}"
+        self.raw_text_preview = f"File processed successfully. Path: {', '.join(md_file_paths)}"
         
-        # 3. Indexing & Splitting - Returns list of ChunkDefs (dicts) AND creates LanceDB index
-        chunks_defs = await workflow.execute_activity(
-            index_document_activity,
-            args=[md_file_path],
-            task_queue="proposal-queue",
-            start_to_close_timeout=timedelta(minutes=5)
-        )
+        # 3. Splitting (fast) - Returns list of ChunkDefs (dicts); LLM extraction can start right away
+        self._enter_stage("splitting")
+        split_results = await asyncio.gather(*(
+            workflow.execute_activity(
+                split_document_activity,
+                args=[md_file_path],
+                task_queue="proposal-queue",
+                start_to_close_timeout=timedelta(minutes=2)
+            )
+            for md_file_path in md_file_paths
+        ))
+        # Chunk defs carry their own file_path: extraction runs over the union as over one document
+        chunks_defs = [chunk for file_chunks in split_results for chunk in file_chunks]
         
         if not chunks_defs:
-             self.status = "ERROR: No text content found"
+             self._set_status("ERROR: No text content found")
+             self._enter_stage("failed")
              return "No Content"
 
-        self.raw_text_length = len(chunks_defs) * 12000 # Approx
-        
-        # 4. Parallel Extraction (Map Phase) - BATCHED
-        # User requested speedup but GPU is at 96% load.
-        # BATCH_SIZE = 3 (Safe start)
-        # Optimization: With larger chunks (50k chars), we lower concurrency to avoid OOM.
-        BATCH_SIZE = 1
-        partial_results = []
-        
-        
-        for i in range(0, len(chunks_defs), BATCH_SIZE):
-            batch_chunks = chunks_defs[i : i + BATCH_SIZE]
-            
-            # Phase 1: Basic Extraction
-            extract_futures = [
-                workflow.execute_activity(
-                    extract_chunk_activity,
-                    args=[chunk_def],
-                    task_queue="gpu-queue", 
-                    start_to_close_timeout=timedelta(minutes=60)
-                )
-                for chunk_def in batch_chunks
-            ]
+        # Chunk defs are byte ranges of the markdown files; the last one of each file ends at its size
+        self.raw_text_length = sum(file_chunks[-1]["end"] for file_chunks in split_results if file_chunks)
+        self.chunks_total = len(chunks_defs)
 
-            results_extract = await asyncio.gather(*extract_futures)
-            partial_results.extend(results_extract)
-        
-        # 5. Merge (Reduce Phase)
-        partial_results = [r for r in partial_results if r is not None]
+        # 3.5 Vector Indexing (BGE-M3 + LanceDB) in parallel with extraction,
+        # joined only before RAG enrichment. A batch shares one table.
+        if batch:
+            index_call = workflow.execute_activity(
+                index_documents_activity,
+                args=[md_file_paths, chunks_defs],
+                task_queue="proposal-queue",
+                start_to_close_timeout=timedelta(minutes=30),
+                heartbeat_timeout=HEARTBEAT_TIMEOUT
+            )
+        else:
+            index_call = workflow.execute_activity(
+                index_document_activity,
+                args=[md_file_paths[0], chunks_defs],
+                task_queue="proposal-queue",
+                start_to_close_timeout=timedelta(minutes=15),
+                heartbeat_timeout=HEARTBEAT_TIMEOUT
+            )
+        index_task = asyncio.create_task(index_call)
         
-        merged_data_dict = await workflow.execute_activity(
-            merge_data_activity,
-            args=[partial_results],
-            task_queue="proposal-queue",
-            start_to_close_timeout=timedelta(minutes=2)
+        # 4. Parallel Extraction (Map Phase) - adaptive sliding window
+        # Window starts small (large context-filling chunks, shared Qwen box) and adapts to
+        # observed latency / failures instead of a fixed batch size.
+        self._enter_stage("extraction")
+        window = AdaptiveWindow(
+            EXTRACT_WINDOW_INITIAL, EXTRACT_WINDOW_MIN, EXTRACT_WINDOW_MAX, EXTRACT_LATENCY_SLOWDOWN
         )
-        
-        # 5.5 RAG Enrichment (NotebookLM-style)
-        # Enriches all fields with source quotes from vector search
-        merged_data_dict = await workflow.execute_activity(
-            enrich_with_rag_activity,
-            args=[merged_data_dict],
-            task_queue="gpu-queue",
-            start_to_close_timeout=timedelta(minutes=5)
+        self._window = window
+        # 5. Merge (Reduce Phase) + 5.5 RAG Enrichment (NotebookLM-style)
+        # Streaming: each finished chunk is folded into the running merge and its new
+        # items are enriched with source quotes while the remaining chunks are extracted.
+        merge = StreamingMerge(index_task)
+        if len(chunks_defs) > EXTRACT_CHILD_THRESHOLD:
+            await self._extract_with_children(chunks_defs, window, merge)
+        else:
+            await extract_chunks_windowed(chunks_defs, window, on_result=merge.on_result)
+        workflow.logger.info(
+            f"Extraction finished: {window.completed} chunks, {window.failed} failed, final window {window.size}"
         )
+        if window.failed:
+            self._analysis_complete = False
+        self._enter_stage("merging")
+        merged_data_dict = await merge.result()
         
         # 5.6 Classify & Merge Manager Notes (dedicated LLM call, runs ONCE)
         if self.additional_notes:
+            self._enter_stage("notes")
             merged_data_dict = await workflow.execute_activity(
                 classify_manager_notes_activity,
                 args=[self.additional_notes, merged_data_dict],
                 task_queue="gpu-queue",
-                start_to_close_timeout=timedelta(minutes=3)
+                start_to_close_timeout=GPU_QUEUE_WAIT + timedelta(minutes=3),
+                heartbeat_timeout=HEARTBEAT_TIMEOUT
             )
         
         # 6. Analysis (Phase 2 - using Aggregated Data)
+        self._enter_stage("analysis")
         self.extracted_data = await workflow.execute_activity(
             analyze_project_activity,
             args=[merged_data_dict, self.additional_notes],
             task_queue="gpu-queue",
-            start_to_close_timeout=timedelta(minutes=10)
+            start_to_close_timeout=GPU_QUEUE_WAIT + timedelta(minutes=10),
+            heartbeat_timeout=HEARTBEAT_TIMEOUT
         )
+        if self.extracted_data.pop("analysis_failed", False):
+            workflow.logger.warning("Project analysis failed, continuing with the merged extraction")
+            self._analysis_complete = False
         
         # 7. Post-Processing (Suggestions)
         self.suggested_stages = self.extracted_data.get(
@@ -167,24 +744,201 @@ class ProposalWorkflow:
         )
         
         # 8. Budget Estimation Matrix
+        self._enter_stage("estimation")
         self.suggested_hours = await workflow.execute_activity(
             estimate_hours_activity,
             args=[self.extracted_data, self.suggested_stages, self.suggested_roles, self.additional_notes],
             task_queue="gpu-queue",
-            start_to_close_timeout=timedelta(minutes=10)
+            start_to_close_timeout=GPU_QUEUE_WAIT + timedelta(minutes=10),
+            heartbeat_timeout=HEARTBEAT_TIMEOUT
         )
+        # estimate_hours_activity answers an all-zero matrix when the LLM call fails
+        if not any(hours for roles in (self.suggested_hours or {}).values() for hours in roles.values()):
+            self._analysis_complete = False
         
-        self.status = "WAITING_FOR_HUMAN"
+        return None
+
+    @workflow.run
+    async def run(
+        self,
+        file_path: str,
+        file_name: str,
+        convert_to_pdf_for_pages: bool = True,
+        additional_notes: str = "",
+        cache_key: str = "",
+        queued_until: str = "",
+        extra_files: Optional[List[Dict[str, str]]] = None
+    ):
+        """extra_files: appendices of a batch upload, [{"file_path", "file_name"}] (see _analyze_document)."""
+        self.additional_notes = additional_notes
+        if not workflow.patched(PIPELINE_PATCH):
+            return await self._run_legacy(file_path, file_name, convert_to_pdf_for_pages)
+
+        # 0. Content-addressed cache: identical bytes + options already analysed
+        cached_analysis = None
+        if cache_key:
+            self._enter_stage("cache_lookup")
+            cached_analysis = await workflow.execute_activity(
+                load_cached_analysis_activity,
+                args=[cache_key],
+                task_queue="proposal-queue",
+                start_to_close_timeout=timedelta(seconds=30)
+            )
+
+        if cached_analysis:
+            workflow.logger.info(f"Reusing cached analysis {cache_key[:12]} for {file_name}")
+            self._restore_analysis(cached_analysis)
+        else:
+            if queued_until:
+                await self._wait_for_admission(queued_until)
+            files = [(file_path, file_name)] + [(f["file_path"], f["file_name"]) for f in extra_files or []]
+            early_result = await self._analyze_document(files, convert_to_pdf_for_pages)
+            if early_result is not None:
+                return early_result
+            if cache_key and self._analysis_complete:
+                await workflow.execute_activity(
+                    store_cached_analysis_activity,
+                    args=[cache_key, self._analysis_snapshot()],
+                    task_queue="proposal-queue",
+                    start_to_close_timeout=timedelta(seconds=30)
+                )
+            elif cache_key:
+                workflow.logger.warning("Analysis incomplete (fallbacks were used), not caching it")
+        
+        self._set_status("WAITING_FOR_HUMAN")
+        self._enter_stage("waiting_for_human")
+
+        draft = await self._start_draft() if SPECULATIVE_DRAFT else None
 
         await workflow.wait_condition(lambda: self.is_approved)
 
+        self._set_status("GENERATING")
+        self._enter_stage("generating")
+
+        self.final_proposal = await self._take_draft(draft) if draft else None
+        if self.final_proposal is None:
+            # Streamed under the workflow id: the API tails it for the live view while GENERATING
+            self.final_proposal = await workflow.execute_activity(
+                generate_proposal_activity,
+                args=[self.extracted_data, self.budget, self.rates, self.additional_notes, workflow.info().workflow_id],
+                task_queue="gpu-queue",
+                start_to_close_timeout=GPU_QUEUE_WAIT + timedelta(minutes=10),
+                heartbeat_timeout=HEARTBEAT_TIMEOUT
+            )
+        await workflow.execute_activity(
+            save_budget_stub,
+            args=[self.extracted_data],
+            task_queue="proposal-queue",
+            start_to_close_timeout=timedelta(seconds=10)
+        )
+        
+        self._set_status("COMPLETED")
+        self._enter_stage("completed")
+        return self.final_proposal
+
+    async def _run_legacy(self, file_path: str, file_name: str, convert_to_pdf_for_pages: bool):
+        """
+        Command sequence of workflows started before PIPELINE_PATCH, kept so that their histories
+        replay deterministically (e.g. one waiting for approval). Status is not upserted as a
+        search attribute here: that would be a new command too.
+        """
+        md_file_path = await workflow.execute_activity(
+            parse_file_activity,
+            args=[file_path, file_name, convert_to_pdf_for_pages],
+            task_queue="proposal-queue",
+            start_to_close_timeout=timedelta(minutes=10)
+        )
+        if not md_file_path:
+            workflow.logger.info(f"Parsing failed or empty. Trying OCR for {file_path}")
+            md_file_path = await workflow.execute_activity(
+                ocr_document_activity,
+                args=[file_path],
+                task_queue="gpu-queue",
+                start_to_close_timeout=GPU_QUEUE_WAIT + timedelta(minutes=10)
+            )
+        if not md_file_path:
+            self.status = "ERROR: Failed to parse document"
+            return "Extraction Failed"
+        self.raw_text_preview = f"File processed successfully. Path: {md_file_path}"
+
+        # By name: recorded results are chunk lists, the current activity is typed to return a dict
+        chunks_defs = await workflow.execute_activity(
+            "index_document_activity",
+            args=[md_file_path],
+            task_queue="proposal-queue",
+            start_to_close_timeout=timedelta(minutes=5)
+        )
+        if isinstance(chunks_defs, dict):
+            # Not in the history yet: the current activity only indexes, ask for the chunks
+            chunks_defs = await workflow.execute_activity(
+                split_document_activity,
+                args=[md_file_path],
+                task_queue="proposal-queue",
+                start_to_close_timeout=timedelta(minutes=5)
+            )
+        if not chunks_defs:
+            self.status = "ERROR: No text content found"
+            return "No Content"
+        self.raw_text_length = len(chunks_defs) * 12000
+
+        partial_results = []
+        for chunk_def in chunks_defs:
+            partial_results.append(await workflow.execute_activity(
+                extract_chunk_activity,
+                args=[chunk_def],
+                task_queue="gpu-queue",
+                start_to_close_timeout=GPU_QUEUE_WAIT + timedelta(minutes=60)
+            ))
+        merged_data_dict = await workflow.execute_activity(
+            merge_data_activity,
+            args=[[r for r in partial_results if r is not None]],
+            task_queue="proposal-queue",
+            start_to_close_timeout=timedelta(minutes=2)
+        )
+        merged_data_dict = await workflow.execute_activity(
+            enrich_with_rag_activity,
+            args=[merged_data_dict],
+            task_queue="gpu-queue",
+            start_to_close_timeout=GPU_QUEUE_WAIT + timedelta(minutes=5)
+        )
+        if self.additional_notes:
+            merged_data_dict = await workflow.execute_activity(
+                classify_manager_notes_activity,
+                args=[self.additional_notes, merged_data_dict],
+                task_queue="gpu-queue",
+                start_to_close_timeout=GPU_QUEUE_WAIT + timedelta(minutes=3)
+            )
+        self.extracted_data = await workflow.execute_activity(
+            analyze_project_activity,
+            args=[merged_data_dict, self.additional_notes],
+            task_queue="gpu-queue",
+            start_to_close_timeout=GPU_QUEUE_WAIT + timedelta(minutes=10)
+        )
+        self.extracted_data.pop("analysis_failed", None)
+        self.suggested_stages = self.extracted_data.get(
+            "suggested_stages", ["Сбор данных", "Прототип", "Разработка", "Тестирование"]
+        )
+        self.suggested_roles = self.extracted_data.get(
+            "suggested_roles", ["Менеджер", "Frontend", "Backend", "Дизайнер"]
+        )
+        self.suggested_hours = await workflow.execute_activity(
+            estimate_hours_activity,
+            args=[self.extracted_data, self.suggested_stages, self.suggested_roles, self.additional_notes],
+            task_queue="gpu-queue",
+            start_to_close_timeout=GPU_QUEUE_WAIT + timedelta(minutes=10)
+        )
+
+        self.status = "WAITING_FOR_HUMAN"
+        self.version += 1
+        await workflow.wait_condition(lambda: self.is_approved)
         self.status = "GENERATING"
+        self.version += 1
 
         self.final_proposal = await workflow.execute_activity(
             generate_proposal_activity,
             args=[self.extracted_data, self.budget, self.rates, self.additional_notes],
             task_queue="gpu-queue",
-            start_to_close_timeout=timedelta(minutes=10)
+            start_to_close_timeout=GPU_QUEUE_WAIT + timedelta(minutes=10)
         )
         await workflow.execute_activity(
             save_budget_stub,
@@ -192,6 +946,6 @@ class ProposalWorkflow:
             task_queue="proposal-queue",
             start_to_close_timeout=timedelta(seconds=10)
         )
-        
         self.status = "COMPLETED"
+        self.version += 1
         return self.final_proposal